@@ -163,6 +163,12 @@ class AbstractCommands:
     def set_stage_move_stop(self):
         """This command stops stage motion if sent during stage is moving."""
 
+    def set_scan_freeze_immediately(self):
+        """This command stops the scan at any position."""
+
+    def set_HV_off_immediately(self):
+        """This command turns the HV off."""
+
     def set_detectors(self, list_of_signals):
         """This command sets signal name for image screens.
             kwargs: any parameters needed to select signals
@@ -199,10 +205,14 @@ class AbstractCommands:
         """This command runs image capturing and save captured image(s)."""
         return ''
 
+    def set_capture_and_save_signals(self, project_name='', newFileName=''):
+        """This command captures all screens and saves the image of each signal in its folder."""
+        return {}
+
     def set_alignment_set(self, mode, x_value, y_value):
        """This command sets axial alignment data. Alignment current is set and electron optical column axis will be changed."""
 
-    def set_stigma(self, x_value, y_value):
+    def set_stigma_current(self, x_value, y_value):
         """This command sets stigma current."""
 
     def set_raster_rotation(self, onoff, angle):
@@ -3,6 +3,7 @@ import socket
 import shutil
 import os
 import logging
+from internalProject.microscopeControl.tracing import TRACE_RECORDER
 
 """
 Using TCP/I.P. protocol, python socket connection
@@ -15,11 +16,17 @@ class AbstractExternalCommunication:
     LAPTOP_IP = socket.gethostbyname(socket.gethostname())
     SEM_PORT = 3000
     BUFF_SIZE = 1024
+    # Delay before sending and receiving each command, can be reduced with a simulated SEM
+    COMMAND_DELAY_S = 2
+    # Commands can be sent from several threads at once, one blocking socket is shared otherwise
+    SUPPORTS_CONCURRENT_COMMANDS = False
 
     def __init__(self):
         self.connection = None
         self.socket = None
         self.pc_sem_dir_temp = ''
+        # Latency statistics per command (main, sub and ext code) : count, total, min, max in s
+        self.commandLatencies = {}
 
     def set_sem_dir_temp(self, sem_dir_temp):
         self.pc_sem_dir_temp = sem_dir_temp
@@ -36,6 +43,60 @@ class AbstractExternalCommunication:
     def set_socket(self, socket):
         self.socket = socket
 
+    def supports_concurrent_commands(self):
+        return self.SUPPORTS_CONCURRENT_COMMANDS
+
+    @staticmethod
+    def get_command_key(command_string):
+        # Main code, sub code and ext code of the command
+        return ' '.join(command_string.split()[:3])
+
+    def record_command_latency(self, key, duration_s):
+        count, total, minimum, maximum = self.commandLatencies.get(key, (0, 0.0, duration_s, duration_s))
+        self.commandLatencies[key] = (count + 1, total + duration_s, min(minimum, duration_s),
+                                      max(maximum, duration_s))
+
+    def get_mean_command_latency(self, key, default=None):
+        if key not in self.commandLatencies:
+            return default
+
+        count, total, _, _ = self.commandLatencies[key]
+        return total / count
+
+    def get_mean_latency_for_main_code(self, main_code, default=None, excluded_keys=()):
+        # Average over all the commands of a main code (Get or Set)
+        values = [value for key, value in self.commandLatencies.items()
+                  if key.split()[0] == main_code and key not in excluded_keys]
+        if len(values) == 0:
+            return default
+
+        return sum(value[1] for value in values) / sum(value[0] for value in values)
+
+    def record_command_trace(self, command_string, times, dictDecodedMessage, receiveDelay_s=0):
+        """Timeline of a command on its command track : connect, command delay, send, wait for the reply (first byte)
+        and wait for the SEM to be idle
+            times : perf_counter values at start, connected, delayed (end of the command delay), sent, replied and idle
+            receiveDelay_s : command delay slept after sending, before reading the reply
+        """
+        start, connected, delayed, sent, replied, idle = times
+        firstByte = replied
+        status = None
+        if dictDecodedMessage is not None:
+            firstByte = dictDecodedMessage.get('receive_time', replied)
+            status = dictDecodedMessage.get('return_status')
+
+        key = self.get_command_key(command_string)
+        track = TRACE_RECORDER.get_command_track(start, idle)
+        TRACE_RECORDER.record_span(key, 'command', start, idle, {'command': command_string, 'status': status}, track)
+        TRACE_RECORDER.record_span('connect', 'command', start, connected, threadId=track)
+        if self.COMMAND_DELAY_S > 0 and delayed > connected:
+            TRACE_RECORDER.record_span('command delay', 'command', connected, delayed, threadId=track)
+        TRACE_RECORDER.record_span('send', 'command', delayed, sent, threadId=track)
+        if receiveDelay_s > 0:
+            TRACE_RECORDER.record_span('command delay', 'command', sent, sent + receiveDelay_s, threadId=track)
+        TRACE_RECORDER.record_span('wait reply', 'command', sent + receiveDelay_s, firstByte, threadId=track)
+        TRACE_RECORDER.record_span('wait idle', 'command', replied, idle, threadId=track)
+
     def clear_savedir_pc_sem(self):
         if os.path.exists(self.pc_sem_dir_temp):
             shutil.rmtree(self.pc_sem_dir_temp)
@@ -46,6 +107,8 @@ class AbstractExternalCommunication:
     def initiate_connection(self):
         logging.info("Connecting to PC-SEM ...")
         su8230_socket = socket.socket(socket.AF_INET)
+        # PC side closes first, allow binding again while the previous connection is in TIME_WAIT
+        su8230_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         su8230_socket.bind((self.LAPTOP_IP, self.SEM_PORT))
         su8230_socket.listen()
         su8230_socket.settimeout(20)  # Timeout to close the connection after a while if it didnt work
@@ -64,6 +127,7 @@ class AbstractExternalCommunication:
     def validate_connection(self, command_string):
         logging.info("Start")
         su8230_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        su8230_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         su8230_socket.bind((self.LAPTOP_IP, self.SEM_PORT))
 
         su8230_socket.listen()
@@ -96,8 +160,9 @@ class AbstractExternalCommunication:
             su8230_socket.close()
             logging.info("Connection closed")
 
-    def send_command(self, send_command_string, log=True):
-        time.sleep(2)
+    def send_command(self, send_command_string, log=True, delay=True):
+        if delay:
+            time.sleep(self.COMMAND_DELAY_S)
         connection = self.get_connection()
         while connection is None:
             self.initiate_connection()
@@ -114,7 +179,7 @@ class AbstractExternalCommunication:
         pass
 
     def receive_command(self, log=True):
-        time.sleep(2)
+        time.sleep(self.COMMAND_DELAY_S)
         connection = self.get_connection()
         return self.receive_text_command(connection, log)
 
@@ -125,12 +190,22 @@ class AbstractExternalCommunication:
         pass
 
     def process_get_command(self, command_string):
+        startTime = time.perf_counter()
         self.initiate_connection()
-        self.send_command(command_string)
+        connectedTime = time.perf_counter()
+        time.sleep(self.COMMAND_DELAY_S)
+        delayedTime = time.perf_counter()
+        self.send_command(command_string, delay=False)
+        sentTime = time.perf_counter()
         dictDecodedMessage = self.receive_command()
+        repliedTime = time.perf_counter()
 
         # Wait for SEM to be idle
         isComplete = self.wait_command_complete()
+        idleTime = time.perf_counter()
+        self.record_command_latency(self.get_command_key(command_string), idleTime - startTime)
+        self.record_command_trace(command_string, (startTime, connectedTime, delayedTime, sentTime, repliedTime,
+                                                   idleTime), dictDecodedMessage, self.COMMAND_DELAY_S)
         if isComplete:
             self.close_connection()
             return dictDecodedMessage
@@ -138,15 +213,29 @@ class AbstractExternalCommunication:
         return None
 
     def process_set_command(self, command_string):
+        startTime = time.perf_counter()
         self.initiate_connection()
-        self.send_command(command_string)
+        connectedTime = time.perf_counter()
+        time.sleep(self.COMMAND_DELAY_S)
+        delayedTime = time.perf_counter()
+        self.send_command(command_string, delay=False)
+        sentTime = time.perf_counter()
         dictDecodedMessage = self.receive_command()
+        repliedTime = time.perf_counter()
         # Wait for SEM to be idle
         isComplete = self.wait_command_complete()
+        idleTime = time.perf_counter()
+        self.record_command_latency(self.get_command_key(command_string), idleTime - startTime)
+        self.record_command_trace(command_string, (startTime, connectedTime, delayedTime, sentTime, repliedTime,
+                                                   idleTime), dictDecodedMessage, self.COMMAND_DELAY_S)
         if isComplete:
             self.close_connection()
 
         self.validate_return_status(dictDecodedMessage)
 
+    def process_safety_command(self, command_string):
+        """Set command of an explicit stop or freeze request, sent before the commands waiting to be sent"""
+        return self.process_set_command(command_string)
+
     def validate_return_status(self, dictDecodedMessage):
         pass
\ No newline at end of file
@@ -1,5 +1,8 @@
+import os
 import logging
 from .abstract_commands import AbstractCommands
+from internalProject.microscopeControl.tracing import TRACE_RECORDER
+from internalProject.microscopeControl.state_restore import read_state_snapshot, restore_state
 
 class AbstractImpl:
     def __init__(self):
@@ -41,54 +44,24 @@ class AbstractImpl:
         if commands is None:
             return
 
-        self.currentState['hv_status'] = commands.get_HV_status()
-        self.currentState['v_acc'] = commands.get_HV_control()[0]
-        self.currentState['emission_current_values'] = commands.get_emission_current()
-        self.currentState['magnification'] = commands.get_magnification()
-        self.currentState['WD'] = commands.get_WD()
-        self.currentState['focus_coarse_fine'] = commands.get_focus_value()
-        self.currentState['stage_position'] = commands.get_stage_position()
-        self.currentState['detectors_signals'] = commands.get_detector_signal()
-        self.currentState['scan_status'] = commands.get_scan_status()
-        self.currentState['scan_speed'] = commands.get_scan_speed_status()
-        self.currentState['scan_mode'] = commands.get_scan_mode()
-        self.currentState['selected_screen'] = commands.get_selected_screen()
-        self.currentState['stigma_current'] = commands.get_stigma_current()
-        self.currentState['raster_rotation'] = commands.get_raster_rotation()
-        self.currentState['probe_current_cond1'] = commands.get_probe_current_and_cond1()
+        self.currentState = read_state_snapshot(commands)
 
     def update_current_state(self,  key, get_command):
         pass
 
     def reset_to_last_saved_state(self):
+        """Sends only the setters of the values that changed since save_current_state"""
         commands = self.get_microscope_commands()
-        if commands is None:
+        if commands is None or len(self.currentState) == 0:
             return
 
-        commands.set_HV_status(on_off=self.currentState['hv_status'])
-        commands.set_HV_control(vacc=self.currentState['v_acc'])
-        commands.set_emission_current(emission_current=self.currentState['emission_current_values'])
-        commands.set_magnification_mode(mag_mode=self.currentState['magnification'][0])
-        commands.set_magnification(magnification=self.currentState['magnification'][1])
-        commands.set_WD(wd=self.currentState['WD'])
-        commands.set_focus_value(coarse_value=self.currentState['focus_coarse_fine'][0],
-                             fine_value=self.currentState['focus_coarse_fine'][1])
-        commands.set_stage_position(x=self.currentState['stage_position'][0],
-                                y=self.currentState['stage_position'][1],
-                                z=self.currentState['stage_position'][2],
-                                t=self.currentState['stage_position'][3],
-                                r=self.currentState['stage_position'][4])
-        commands.set_detectors(list(self.currentState['detectors_signals']))
-        commands.set_scan_status(self.currentState['scan_status'])
-        commands.set_scan_speed(self.currentState['scan_speed'])
-        commands.set_scan_mode(self.currentState['scan_mode'])
-        commands.set_selected_screen(self.currentState['selected_screen'])
-        commands.set_stigma(x_value=self.currentState['stigma_current'][0],
-                        y_value=self.currentState['stigma_current'][1])
-        commands.set_raster_rotation(onoff=self.currentState['raster_rotation'][0],
-                                 angle=self.currentState['raster_rotation'][1])
-        commands.set_probe_current_and_cond1(probe_current=self.currentState['probe_current_cond1'][0],
-                                             cond1=self.currentState['probe_current_cond1'][1])
+        restore_state(commands, self.currentState)
+
+    def exportTimeline(self, fileName):
+        """Chrome trace-event json of the commands, transfers and stitching since the start of the run"""
+        filePath = TRACE_RECORDER.export_chrome_trace(os.path.join(self._filePath, fileName))
+        logging.info(f'Timeline exported to {filePath}')
+        return filePath
 
     def getCurrentState(self):
         return self.currentState
@@ -0,0 +1,235 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from internalProject.microscopeControl.abstract_external_communication import AbstractExternalCommunication
+from internalProject.microscopeControl.command_executor import PRIORITY_NORMAL, PRIORITY_TELEMETRY, \
+    CommandAbortedError
+
+"""
+asyncio version of the external communication. The PC listens on (LAPTOP_IP, SEM_PORT) and keeps the connection opened
+by the SEM. A single reader task per connection matches the replies to the commands in the order they were sent, so
+several coroutines can have commands in flight on the same connection. If the SEM closes the connection, the next
+command waits for it to connect again.
+
+Abstract class is not specific to command format, the microscope class implements format_command, decode_reply,
+wait_command_complete and validate_return_status.
+"""
+
+
+class EventLoopThread:
+    """Event loop running in a daemon thread, blocking code and other event loops run coroutines on it"""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine, timeout=None):
+        """Blocks until the coroutine is done, not to be called from the loop thread"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def submit(self, coroutine):
+        """Awaitable from any event loop"""
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=2)
+        if not self.loop.is_running():
+            self.loop.close()
+
+
+class AbstractAsyncExternalCommunication(AbstractExternalCommunication):
+    CONNECT_TIMEOUT_S = 20
+    REPLY_TIMEOUT_S = 20
+
+    def __init__(self):
+        super().__init__()
+        self.server = None
+        self.writer = None
+        self.readerTask = None
+        self.connectedEvent = None
+        # Reply futures of the current connection, in the order the commands were sent
+        self.pendingReplies = deque()
+        # Set commands waiting for the SEM to be idle
+        self.commandsInProgress = 0
+        # Set to abort the waits for the SEM to be idle in progress, replaced after each abort
+        self.abortEvent = asyncio.Event()
+
+    async def start(self):
+        if self.server is None:
+            self.connectedEvent = asyncio.Event()
+            self.server = await asyncio.start_server(self.accept_connection, self.LAPTOP_IP, self.SEM_PORT,
+                                                     reuse_address=True)
+            logging.info(f'Listening for PC-SEM on {self.LAPTOP_IP}:{self.SEM_PORT}')
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.readerTask is not None:
+            self.readerTask.cancel()
+            self.readerTask = None
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            logging.info("Connection closed")
+
+    def accept_connection(self, reader, writer):
+        """Server callback, the latest connection of the SEM replaces the previous one"""
+        logging.info(f'Connected by {writer.get_extra_info("peername")}')
+        if self.writer is not None:
+            self.writer.close()
+
+        self.writer = writer
+        self.pendingReplies = deque()
+        self.readerTask = asyncio.ensure_future(self.read_replies(reader, self.pendingReplies))
+        self.connectedEvent.set()
+
+    async def read_replies(self, reader, pendingReplies):
+        """Reader task of a connection, each reply resolves the oldest command waiting on this connection"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                receiveTime = time.perf_counter()
+                if len(pendingReplies) == 0:
+                    logging.info(f'Unexpected reply : {line}')
+                    continue
+
+                future = pendingReplies.popleft()
+                if future.done():
+                    # Command timed out or was cancelled, its reply is dropped
+                    continue
+
+                try:
+                    dictDecodedMessage = self.decode_reply(line.decode('UTF-8'))
+                    dictDecodedMessage['receive_time'] = receiveTime
+                    future.set_result(dictDecodedMessage)
+                except (ValueError, IndexError):
+                    future.set_exception(ConnectionError(f'Malformed reply : {line}'))
+        except OSError:
+            pass
+        finally:
+            if self.pendingReplies is pendingReplies:
+                self.writer = None
+                self.connectedEvent.clear()
+            while len(pendingReplies) > 0:
+                future = pendingReplies.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError('PC-SEM closed the connection'))
+
+    async def wait_for_connection(self):
+        await self.start()
+        if self.writer is None:
+            logging.info("Connecting to PC-SEM ...")
+        try:
+            await asyncio.wait_for(self.connectedEvent.wait(), self.CONNECT_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f'Connection to PC SEM failed. Verify that Ethernet on SEM PC is set to '
+                                  f'{self.LAPTOP_IP} and firewall is authorised for all Python processes.')
+
+    async def send_command(self, send_command_string, log=True, delay=True):
+        """Writes the command on the connection, returns the future of its reply
+            delay : waits COMMAND_DELAY_S before sending, a Set is not sent if a safety command aborts the wait
+        """
+        if delay:
+            await self.wait_command_delay(send_command_string)
+        await self.wait_for_connection()
+        future = asyncio.get_running_loop().create_future()
+        # No await between queuing the future and writing, replies stay in the order of the commands
+        self.pendingReplies.append(future)
+        self.writer.write(self.format_command(send_command_string).encode('UTF-8'))
+        if log:
+            logging.info(f"Sent command : {send_command_string}")
+        await self.writer.drain()
+        return future
+
+    async def receive_command(self, future, log=True):
+        dictDecodedMessage = await asyncio.wait_for(future, self.REPLY_TIMEOUT_S)
+        if log:
+            logging.info(f"Received command : {dictDecodedMessage}")
+        return dictDecodedMessage
+
+    async def request(self, command_string, log=True):
+        """Sends a command and waits for its reply, without waiting for the SEM to be idle"""
+        future = await self.send_command(command_string, log)
+        return await self.receive_command(future, log)
+
+    def get_command_priority(self, command_string):
+        return PRIORITY_NORMAL
+
+    def abort_wait_command_complete(self):
+        """Commands waiting for the SEM to be idle return without waiting, to be called on the event loop thread"""
+        self.abortEvent.set()
+        self.abortEvent = asyncio.Event()
+
+    @staticmethod
+    async def wait_for_abort(abortEvent, timeout):
+        """Sleeps for timeout, return : True if aborted meanwhile"""
+        try:
+            await asyncio.wait_for(abortEvent.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def wait_command_delay(self, command_string):
+        """Waits COMMAND_DELAY_S, raises CommandAbortedError for a Set if a safety command is sent meanwhile"""
+        if self.COMMAND_DELAY_S <= 0:
+            return
+
+        if not command_string.startswith('Set'):
+            await asyncio.sleep(self.COMMAND_DELAY_S)
+        elif await self.wait_for_abort(self.abortEvent, self.COMMAND_DELAY_S):
+            raise CommandAbortedError(f'{command_string} not sent, a safety command was sent meanwhile')
+
+    async def process_command(self, command_string, waitIdle=True, delay=True):
+        startTime = time.perf_counter()
+        await self.wait_for_connection()
+        connectedTime = time.perf_counter()
+        if delay:
+            await self.wait_command_delay(command_string)
+        delayedTime = time.perf_counter()
+        future = await self.send_command(command_string, delay=False)
+        sentTime = time.perf_counter()
+        dictDecodedMessage = await self.receive_command(future)
+        repliedTime = time.perf_counter()
+        isComplete = await self.wait_command_complete() if waitIdle else True
+        idleTime = time.perf_counter()
+        dictDecodedMessage['is_complete'] = isComplete
+        if not isComplete:
+            logging.info(f'Stopped waiting for {command_string} to finish')
+        self.record_command_latency(self.get_command_key(command_string), idleTime - startTime)
+        self.record_command_trace(command_string, (startTime, connectedTime, delayedTime, sentTime, repliedTime,
+                                                   idleTime), dictDecodedMessage)
+        return dictDecodedMessage
+
+    async def process_get_command(self, command_string):
+        # A Set in progress already waits for the SEM to be idle, a Get sent meanwhile returns with its reply, so do
+        # telemetry reads
+        waitIdle = self.commandsInProgress == 0 and self.get_command_priority(command_string) != PRIORITY_TELEMETRY
+        return await self.process_command(command_string, waitIdle=waitIdle)
+
+    async def process_set_command(self, command_string, delay=True):
+        """delay : False for the safety commands, sent as soon as they are submitted"""
+        self.commandsInProgress += 1
+        try:
+            dictDecodedMessage = await self.process_command(command_string, delay=delay)
+        finally:
+            self.commandsInProgress -= 1
+
+        self.validate_return_status(dictDecodedMessage)
+        return dictDecodedMessage
+
+    def format_command(self, command_string):
+        return command_string
+
+    def decode_reply(self, reply):
+        pass
+
+    async def wait_command_complete(self):
+        return True
@@ -0,0 +1,136 @@
+import time
+import asyncio
+import itertools
+import logging
+
+"""
+Executor of the commands sent to the SEM, running on the event loop thread of the asyncio external communication.
+Commands wait in priority queues, Get and Set commands in separate lanes so a Get is not held behind a Set waiting for
+the SEM to be idle. Gets are pipelined, Sets are sent one at a time. Safety commands (explicit stage stop, scan freeze
+and HV off requests, submitted with PRIORITY_SAFETY) skip the queues and the command delay, abort the IDLE polls of the
+commands in progress and cancel the Sets still waiting to be sent, so no move queued before a stop runs after it.
+"""
+PRIORITY_SAFETY = 0
+PRIORITY_NORMAL = 1
+PRIORITY_TELEMETRY = 2
+PRIORITY_NAMES = {PRIORITY_SAFETY: 'safety', PRIORITY_NORMAL: 'normal', PRIORITY_TELEMETRY: 'telemetry'}
+
+
+class CommandAbortedError(Exception):
+    """Set command not sent because a safety command was sent before it"""
+
+
+class CommandExecutor:
+    # Gets in flight at the same time on the connection, Sets are sent one at a time
+    GET_PIPELINE_DEPTH = 16
+
+    def __init__(self, communication, eventLoopThread):
+        self.communication = communication
+        self.eventLoopThread = eventLoopThread
+        self.queues = None
+        self.workers = []
+        # Commands of the same priority run in the order they were submitted
+        self.sequence = itertools.count()
+        # Time spent in queue per priority : count, total, max in s
+        self.waitTimes = {priority: (0, 0.0, 0.0) for priority in PRIORITY_NAMES}
+        self.maxQueueDepth = 0
+
+    def submit(self, command_string, priority=None):
+        """Thread safe, returns a concurrent.futures.Future of the decoded reply"""
+        if priority is None:
+            priority = self.communication.get_command_priority(command_string)
+        return asyncio.run_coroutine_threadsafe(self.execute(command_string, priority), self.eventLoopThread.loop)
+
+    def start_workers(self):
+        if self.queues is None:
+            self.queues = {'Get': asyncio.PriorityQueue(), 'Set': asyncio.PriorityQueue()}
+            self.workers = [asyncio.ensure_future(self.run_lane(self.queues['Get'], self.GET_PIPELINE_DEPTH)),
+                            asyncio.ensure_future(self.run_lane(self.queues['Set'], 1))]
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        self.queues = None
+
+    async def execute(self, command_string, priority):
+        if priority == PRIORITY_SAFETY:
+            logging.info(f'Safety command {command_string}, aborting commands waiting for the SEM')
+            self.flush_queued_sets(command_string)
+            self.communication.abort_wait_command_complete()
+            return await self.run_command(command_string, priority, time.perf_counter())
+
+        self.start_workers()
+        future = asyncio.get_running_loop().create_future()
+        lane = 'Get' if command_string.startswith('Get') else 'Set'
+        self.queues[lane].put_nowait((priority, next(self.sequence), command_string, time.perf_counter(), future))
+        self.maxQueueDepth = max(self.maxQueueDepth, self.get_queue_depth())
+        return await future
+
+    def flush_queued_sets(self, safety_command_string):
+        """Sets waiting in queue fail with CommandAbortedError, return : number of Sets flushed"""
+        if self.queues is None:
+            return 0
+
+        flushed = 0
+        queue = self.queues['Set']
+        while not queue.empty():
+            _, _, command_string, _, future = queue.get_nowait()
+            if not future.done():
+                future.set_exception(CommandAbortedError(f'{command_string} not sent, {safety_command_string} was '
+                                                         f'sent before it'))
+                flushed += 1
+        if flushed > 0:
+            logging.info(f'{flushed} queued Set commands cancelled by {safety_command_string}')
+        return flushed
+
+    async def run_lane(self, queue, depth):
+        """Dispatches the commands of a lane by priority, up to depth commands in flight"""
+        inFlight = asyncio.Semaphore(depth)
+        while True:
+            await inFlight.acquire()
+            priority, _, command_string, queuedTime, future = await queue.get()
+            if future.done():
+                # Cancelled while queued
+                inFlight.release()
+                continue
+
+            task = asyncio.ensure_future(self.complete(future, command_string, priority, queuedTime))
+            task.add_done_callback(lambda _: inFlight.release())
+            if depth == 1:
+                await task
+
+    async def complete(self, future, command_string, priority, queuedTime):
+        try:
+            dictDecodedMessage = await self.run_command(command_string, priority, queuedTime)
+            if not future.done():
+                future.set_result(dictDecodedMessage)
+        except Exception as error:
+            if not future.done():
+                future.set_exception(error)
+
+    async def run_command(self, command_string, priority, queuedTime):
+        self.record_wait_time(priority, time.perf_counter() - queuedTime)
+        if command_string.startswith('Get'):
+            return await self.communication.process_get_command(command_string)
+
+        # Safety commands are sent without the delay between commands
+        return await self.communication.process_set_command(command_string, delay=priority != PRIORITY_SAFETY)
+
+    def record_wait_time(self, priority, wait_s):
+        count, total, maximum = self.waitTimes[priority]
+        self.waitTimes[priority] = (count + 1, total + wait_s, max(maximum, wait_s))
+
+    def get_queue_depth(self):
+        if self.queues is None:
+            return 0
+
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    def get_statistics(self):
+        """Queue depth and wait time in queue (s) per priority"""
+        statistics = {'queue_depth': self.get_queue_depth(), 'max_queue_depth': self.maxQueueDepth}
+        for priority, (count, total, maximum) in self.waitTimes.items():
+            statistics[PRIORITY_NAMES[priority]] = {'count': count, 'mean_wait_s': total / count if count else 0.0,
+                                                    'max_wait_s': maximum}
+        return statistics
@@ -0,0 +1,63 @@
+import time
+import logging
+import cv2
+import numpy as np
+from PIL import Image
+
+"""
+CPU denoising of the tiles after their transfer, so grids can be captured at faster scan settings and still be
+segmented. The noise level of each tile is estimated from the tile itself (Immerkaer's Laplacian estimator), the
+filter strength follows it, and a tile from a slow scan is left almost untouched.
+    nlmeans : non-local means (cv2.fastNlMeansDenoising), best on particles and edges
+    bilateral : edge preserving bilateral filter, several times faster, weaker on strong noise
+"""
+METHODS = ('nlmeans', 'bilateral')
+# Laplacian kernel of the noise estimator, flat and linear regions give 0
+NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+
+
+def estimate_noise_sigma(image):
+    """Standard deviation of additive gaussian noise of a 2d image, in gray levels"""
+    image = np.asarray(image, dtype=np.float32)
+    height, width = image.shape
+    laplacian = cv2.filter2D(image, cv2.CV_32F, NOISE_KERNEL)[1:-1, 1:-1]
+    return float(np.sqrt(np.pi / 2) * np.abs(laplacian).sum() / (6 * (width - 2) * (height - 2)))
+
+
+class TileDenoiser:
+    def __init__(self, method='nlmeans', strength=1.0, templateWindowSize=7, searchWindowSize=21):
+        """strength : filter strength relative to the estimated noise (h of non-local means, sigma color of bilateral)
+        """
+        if method not in METHODS:
+            raise ValueError(f'Denoising method {method} is not one of {METHODS}')
+
+        self.method = method
+        self.strength = strength
+        self.templateWindowSize = templateWindowSize
+        self.searchWindowSize = searchWindowSize
+        self.totalTime_s = 0.0
+        self.tiles = 0
+
+    def denoise(self, image):
+        """Denoised copy of a 2d image with 0 - 255 values, as uint8"""
+        startTime = time.perf_counter()
+        image = np.clip(np.round(np.asarray(image, dtype=np.float32)), 0, 255).astype(np.uint8)
+        sigma = estimate_noise_sigma(image)
+        if self.method == 'nlmeans':
+            denoised = cv2.fastNlMeansDenoising(image, None, max(self.strength * sigma, 1.0), self.templateWindowSize,
+                                                self.searchWindowSize)
+        else:
+            denoised = cv2.bilateralFilter(image, 9, max(2 * self.strength * sigma, 1.0), 3)
+        self.totalTime_s += time.perf_counter() - startTime
+        self.tiles += 1
+        return denoised
+
+    def denoise_file(self, filePath):
+        """Replaces the tile saved at filePath by its denoised version"""
+        image = np.asarray(Image.open(filePath).convert('L'))
+        Image.fromarray(self.denoise(image)).convert('RGB').save(filePath, format='TIFF', compression='tiff_lzw')
+
+    def report(self):
+        if self.tiles > 0:
+            logging.info(f'Denoising ({self.method}) : {self.tiles} tiles, {round(self.totalTime_s / self.tiles, 3)} '
+                         f's per tile')
@@ -0,0 +1,53 @@
+import cv2
+
+"""
+Keypoint detection and descriptor matching with OpenCV, used by stitching and by the overview descriptor index. No
+Dragonfly dependency.
+"""
+
+
+# open cv stitching https://colab.research.google.com/drive/11Md7HWh2ZV6_g3iCYSUw76VNr4HzxcX5#scrollTo=Mb0_FCAIE9gO
+def detectAndDescribe(image, method=None):
+    """
+    Compute key points and feature descriptors using an specific method
+    """
+
+    if method is None:
+        return
+
+    # detect and extract features from the image
+    if method == 'sift':
+        descriptor = cv2.SIFT_create()
+    # elif method == 'surf':
+    #     descriptor = cv2.xfeatures2d.SURF_create()
+    elif method == 'brisk':
+        descriptor = cv2.BRISK_create()
+    elif method == 'orb':
+        descriptor = cv2.ORB_create()
+
+    # get keypoints and descriptors
+    (kps, features) = descriptor.detectAndCompute(image, None)
+
+    return (kps, features)
+
+def createMatcher(method, crossCheck):
+    "Create and return a Matcher Object"
+
+    if method == 'sift' or method == 'surf':
+        bf = cv2.BFMatcher(cv2.NORM_L2, crossCheck=crossCheck)
+    elif method == 'orb' or method == 'brisk':
+        bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=crossCheck)
+    return bf
+
+
+def matchKeyPointsBF(featuresA, featuresB, method):
+    bf = createMatcher(method, crossCheck=True)
+
+    # Match descriptors.
+    best_matches = bf.match(featuresA, featuresB)
+
+    # Sort the features in order of distance.
+    # The points with small distance (more similarity) are ordered first in the vector
+    rawMatches = sorted(best_matches, key=lambda x: x.distance)
+    print("Raw matches (Brute force):", len(rawMatches))
+    return rawMatches
@@ -0,0 +1,67 @@
+import logging
+import cv2
+import numpy as np
+
+"""
+Software frame averaging : fast frames of the same field of view are registered to the running average by sub-pixel
+phase correlation and accumulated, so the drift between the frames does not blur the tile as it does during a long
+hardware integration. Each frame is resampled at its measured offset and added with a weight map, the pixels shifted in
+from outside of the frame do not count. Frames without a clear correlation peak are dropped.
+"""
+# Phase correlation peak under which a frame is not registered
+MIN_RESPONSE = 0.02
+
+
+class FrameAverager:
+    def __init__(self, minResponse=MIN_RESPONSE):
+        self.minResponse = minResponse
+        self.sum = None
+        self.weight = None
+        self.window = None
+        # Offset (x, y) in pixels of each accumulated frame from the first one
+        self.shifts = []
+        self.rejected = 0
+
+    @property
+    def frameCount(self):
+        return len(self.shifts)
+
+    def get_average(self):
+        average = np.zeros_like(self.sum)
+        np.divide(self.sum, self.weight, out=average, where=self.weight > 0)
+        return average
+
+    def measure_shift(self, frame):
+        """Offset (x, y) in pixels of the frame from the average and the phase correlation peak"""
+        # phaseCorrelate applies the window to its inputs in place
+        (dx, dy), response = cv2.phaseCorrelate(self.get_average(), frame.copy(), self.window)
+        return (dx, dy), response
+
+    def add(self, frame, shift=None):
+        """Accumulates the frame, registered to the average unless its shift is given (other signal of the same scan)
+            return : shift (x, y) of the frame in pixels, None if the frame was dropped
+        """
+        frame = np.asarray(frame, dtype=np.float32)
+        if self.sum is None:
+            self.sum = frame.copy()
+            self.weight = np.ones_like(frame)
+            self.window = cv2.createHanningWindow(frame.shape[::-1], cv2.CV_32F)
+            self.shifts.append((0.0, 0.0))
+            return self.shifts[-1]
+
+        if shift is None:
+            shift, response = self.measure_shift(frame)
+            if response < self.minResponse:
+                self.rejected += 1
+                logging.info(f'Frame averaging : frame dropped, phase correlation peak {round(response, 3)}')
+                return None
+
+        height, width = frame.shape
+        # Frame content at x + shift is moved to x
+        matrix = np.float32([[1, 0, -shift[0]], [0, 1, -shift[1]]])
+        self.sum += cv2.warpAffine(frame, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                                   borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        self.weight += cv2.warpAffine(np.ones_like(frame), matrix, (width, height), flags=cv2.INTER_LINEAR,
+                                      borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        self.shifts.append((float(shift[0]), float(shift[1])))
+        return self.shifts[-1]
@@ -0,0 +1,83 @@
+import logging
+import cv2
+import numpy as np
+from PIL import Image
+from internalProject.microscopeControl.tracing import traced
+
+"""
+Check that two neighbour grid tiles overlap enough to be stitched, on the arrays of the tiles. The overlap strip of one
+tile is correlated, downsampled, with the edge strip of the other on both sides of the shift axis. A clear correlation
+peak validates the pair and a flat one rejects it within milliseconds, full feature matching only runs in between.
+A rejected tile is recaptured with more overlap, with a growing image shift and a bounded number of retries.
+"""
+VALID = 'valid'
+INVALID = 'invalid'
+INCONCLUSIVE = 'inconclusive'
+
+
+def load_tile(filePath):
+    return np.asarray(Image.open(filePath).convert('L'), dtype=np.float32)
+
+
+class OverlapValidator:
+    def __init__(self, overlapFraction=1 / 11, downsample=2, acceptScore=0.6, rejectScore=0.25, maxRetries=3,
+                 initialShift=50, shiftGrowth=2, maxShift=127, fullMatcher=None):
+        """overlapFraction : nominal overlap of the tiles, fraction of the image along the shift axis
+            acceptScore, rejectScore : NCC peak over which the overlap is valid, under which it is not
+            initialShift, shiftGrowth, maxShift : image shift of the retries, multiplied at each retry
+            fullMatcher : function(array1, array2) returning True if the tiles match, for inconclusive checks
+        """
+        self.overlapFraction = overlapFraction
+        self.downsample = downsample
+        self.acceptScore = acceptScore
+        self.rejectScore = rejectScore
+        self.maxRetries = maxRetries
+        self.initialShift = initialShift
+        self.shiftGrowth = shiftGrowth
+        self.maxShift = maxShift
+        self.fullMatcher = fullMatcher
+
+    def get_retry_shifts(self):
+        """Image shift of each retry, the overlap grows faster when the first retries fail"""
+        return [min(round(self.initialShift * self.shiftGrowth ** retry), self.maxShift)
+                for retry in range(self.maxRetries)]
+
+    def get_strip_score(self, image1, image2, isYShift):
+        """Best NCC peak between the overlap strip of image2 and the edge strips of image1, both sides of the axis"""
+        if isYShift:
+            image1, image2 = image1.T, image2.T
+        image1 = cv2.resize(image1, None, fx=1 / self.downsample, fy=1 / self.downsample, interpolation=cv2.INTER_AREA)
+        image2 = cv2.resize(image2, None, fx=1 / self.downsample, fy=1 / self.downsample, interpolation=cv2.INTER_AREA)
+        height, width = image1.shape
+        overlap = max(2, int(round(width * self.overlapFraction)))
+        # Search band twice the nominal overlap, template cropped by 10% across the axis for misalignment
+        band = min(width, 2 * overlap)
+        margin = max(1, height // 10)
+        score = -1.0
+        for edge1, edge2 in ((image1[:, width - band:], image2[margin:height - margin, :overlap]),
+                             (image1[:, :band], image2[margin:height - margin, width - overlap:])):
+            if float(edge2.std()) < 1e-6 or float(edge1.std()) < 1e-6:
+                continue
+
+            correlation = cv2.matchTemplate(edge1, edge2, cv2.TM_CCOEFF_NORMED)
+            score = max(score, float(correlation.max()))
+        return score
+
+    @traced('stitching')
+    def check_overlap(self, image1, image2, isYShift):
+        """return : VALID, INVALID or INCONCLUSIVE, NCC score of the overlap strips"""
+        score = self.get_strip_score(np.asarray(image1, dtype=np.float32), np.asarray(image2, dtype=np.float32),
+                                     isYShift)
+        if score >= self.acceptScore:
+            return VALID, score
+        if score < self.rejectScore:
+            return INVALID, score
+        return INCONCLUSIVE, score
+
+    def validate(self, image1, image2, isYShift):
+        """Cheap check first, full matching only if inconclusive"""
+        status, score = self.check_overlap(image1, image2, isYShift)
+        if status == INCONCLUSIVE and self.fullMatcher is not None:
+            status = VALID if self.fullMatcher(image1, image2) else INVALID
+            logging.info(f'Overlap check inconclusive (NCC {round(score, 3)}), full matching : {status}')
+        return status != INVALID
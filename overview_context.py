@@ -0,0 +1,118 @@
+import logging
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+
+"""
+Low mag overview data shared by all the tile registrations of a run : the normalized overview (zero mean, unit variance),
+its gradient magnitude and the pyramids of both, built once. Arrays can be placed in one shared memory block so parallel
+registration workers attach to it instead of each receiving a copy of the overview. Windows read by the registrations
+are kept in a bounded crop cache, revisits of the same position reuse them.
+"""
+
+
+def get_gradient_magnitude(image):
+    gradientX = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=3)
+    gradientY = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=3)
+    return cv2.magnitude(gradientX, gradientY)
+
+
+class OverviewContext:
+    def __init__(self, arrays, pixelSize_nm, sharedMemory=None, layout=None, isOwner=False, maxCachedCrops=256):
+        """arrays : dict of image_<level> and gradient_<level> arrays, use build or attach"""
+        self.arrays = arrays
+        self.pixelSize_nm = pixelSize_nm
+        self.levels = len([name for name in arrays if name.startswith('image_')])
+        self.sharedMemory = sharedMemory
+        # (name, shape, dtype, offset) of the arrays in the shared memory block
+        self.layout = layout
+        self.isOwner = isOwner
+        self.maxCachedCrops = maxCachedCrops
+        self.crops = OrderedDict()
+        self.cacheHits = 0
+        self.cacheMisses = 0
+
+    @classmethod
+    def build(cls, overview, pixelSize_nm, minSize=32, shared=False):
+        """overview : 2d array of the low mag image, pixelSize_nm : its pixel size
+            minSize : pyramid levels are built down to this size in pixels
+            shared : arrays are placed in shared memory, see get_descriptor
+        """
+        image = np.asarray(overview, dtype=np.float32)
+        if image.ndim == 3:
+            image = image.mean(axis=2)
+        image = (image - image.mean()) / max(float(image.std()), 1e-6)
+        levels = [image]
+        while min(levels[-1].shape) >= 2 * minSize:
+            levels.append(cv2.pyrDown(levels[-1]))
+        arrays = {}
+        for level, levelImage in enumerate(levels):
+            arrays[f'image_{level}'] = levelImage
+            arrays[f'gradient_{level}'] = get_gradient_magnitude(levelImage)
+        if not shared:
+            return cls(arrays, pixelSize_nm)
+
+        layout = []
+        offset = 0
+        for name, array in arrays.items():
+            layout.append((name, array.shape, str(array.dtype), offset))
+            offset += array.nbytes
+        sharedMemory = shared_memory.SharedMemory(create=True, size=offset)
+        sharedArrays = cls.get_views(sharedMemory, layout)
+        for name, array in arrays.items():
+            sharedArrays[name][...] = array
+        logging.info(f'Overview context of {len(levels)} levels in shared memory {sharedMemory.name} ({offset} bytes)')
+        return cls(sharedArrays, pixelSize_nm, sharedMemory, layout, isOwner=True)
+
+    @staticmethod
+    def get_views(sharedMemory, layout):
+        return {name: np.ndarray(shape, dtype=dtype, buffer=sharedMemory.buf, offset=offset)
+                for name, shape, dtype, offset in layout}
+
+    def get_descriptor(self):
+        """Picklable description of a shared context, passed to the workers to attach"""
+        if self.sharedMemory is None:
+            raise ValueError('Overview context is not in shared memory')
+        return self.sharedMemory.name, self.layout, self.pixelSize_nm
+
+    @classmethod
+    def attach(cls, descriptor):
+        name, layout, pixelSize_nm = descriptor
+        sharedMemory = shared_memory.SharedMemory(name=name)
+        return cls(cls.get_views(sharedMemory, layout), pixelSize_nm, sharedMemory, layout)
+
+    def close(self):
+        """Releases the shared memory, removed by the context that created it"""
+        if self.sharedMemory is None:
+            return
+
+        self.arrays = {}
+        self.crops.clear()
+        self.sharedMemory.close()
+        if self.isOwner:
+            self.sharedMemory.unlink()
+        self.sharedMemory = None
+
+    def get_level(self, level, kind='image'):
+        return self.arrays[f'{kind}_{level}']
+
+    def get_shape(self, level=0):
+        return self.arrays[f'image_{level}'].shape
+
+    def get_crop(self, level, left, top, width, height, kind='image'):
+        """Window of a level, clipped to the level, from the crop cache"""
+        key = (kind, level, left, top, width, height)
+        crop = self.crops.get(key)
+        if crop is not None:
+            self.crops.move_to_end(key)
+            self.cacheHits += 1
+            return crop
+
+        self.cacheMisses += 1
+        array = self.get_level(level, kind)
+        crop = np.ascontiguousarray(array[max(top, 0):max(top + height, 0), max(left, 0):max(left + width, 0)])
+        self.crops[key] = crop
+        if len(self.crops) > self.maxCachedCrops:
+            self.crops.popitem(last=False)
+        return crop
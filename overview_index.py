@@ -0,0 +1,130 @@
+import time
+import logging
+import cv2
+import numpy as np
+from internalProject.microscopeControl.feature_matching import detectAndDescribe
+from internalProject.microscopeControl.overview_context import OverviewContext
+from internalProject.microscopeControl.tile_localizer import PyramidNccLocalizer
+from internalProject.microscopeControl.tracing import traced
+
+"""
+Descriptor index of the low mag overview, built once, to find where a high mag tile sits without a good prediction of
+its position. Keypoints of the overview are indexed in a FLANN kd-tree (SIFT) or LSH table (ORB, BRISK). The tile is
+scaled to the pixel size of the overview before its keypoints are detected, its matches are verified by RANSAC on a
+similarity transform and the tile center is mapped on the overview.
+When the tile has too few keypoints or inliers, the position falls back to the NCC localizer around the predicted
+position, or None without prediction.
+"""
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+
+def to_uint8(image):
+    """Contrast stretched 8 bit image for the feature detectors"""
+    image = np.asarray(image, dtype=np.float32)
+    if image.ndim == 3:
+        image = image.mean(axis=2)
+    low, high = np.percentile(image, (0.5, 99.5))
+    return np.clip((image - low) / max(high - low, 1e-6) * 255, 0, 255).astype(np.uint8)
+
+
+def create_index_matcher(method):
+    if method in ('orb', 'brisk'):
+        indexParams = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+    else:
+        indexParams = dict(algorithm=FLANN_INDEX_KDTREE, trees=4)
+    return cv2.FlannBasedMatcher(indexParams, dict(checks=64))
+
+
+class OverviewDescriptorIndex:
+    def __init__(self, overview, overviewPixelSize_nm, method='sift', ratio=0.75, minInliers=6,
+                 reprojectionThreshold_px=3):
+        """overview : 2d array of the low mag image
+            minInliers : RANSAC inliers needed to accept a position, fallback otherwise
+        """
+        startTime = time.perf_counter()
+        self.overview = overview
+        self.overviewPixelSize_nm = overviewPixelSize_nm
+        self.overviewShape = np.asarray(overview).shape[:2]
+        self.method = method
+        self.ratio = ratio
+        self.minInliers = minInliers
+        self.reprojectionThreshold_px = reprojectionThreshold_px
+        self.localizer = None
+        keypoints, descriptors = detectAndDescribe(to_uint8(overview), method)
+        self.points = np.array([keypoint.pt for keypoint in keypoints], dtype=np.float32).reshape(-1, 2)
+        self.matcher = create_index_matcher(method)
+        if descriptors is not None and len(descriptors) >= 2:
+            self.matcher.add([descriptors])
+            self.matcher.train()
+        logging.info(f'Overview index of {len(self.points)} {method} keypoints built in '
+                     f'{round(time.perf_counter() - startTime, 3)} s')
+
+    def get_fallback_localizer(self):
+        if self.localizer is None:
+            self.localizer = PyramidNccLocalizer.from_context(
+                OverviewContext.build(self.overview, self.overviewPixelSize_nm))
+        return self.localizer
+
+    @traced('stitching')
+    def query(self, tile, tilePixelSize_nm):
+        """Position of the tile from the index only
+            return : tile center (x, y) in overview pixels and RANSAC inliers, None and the inliers if not found
+        """
+        if len(self.points) < self.minInliers:
+            return None, 0
+
+        tile = np.asarray(tile, dtype=np.float32)
+        scale = tilePixelSize_nm / self.overviewPixelSize_nm
+        size = (max(1, int(round(tile.shape[1] * scale))), max(1, int(round(tile.shape[0] * scale))))
+        template = cv2.resize(to_uint8(tile), size, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+        keypoints, descriptors = detectAndDescribe(template, self.method)
+        if descriptors is None or len(keypoints) < self.minInliers:
+            return None, 0
+
+        goodMatches = []
+        for match in self.matcher.knnMatch(descriptors, k=2):
+            # LSH returns less than 2 neighbours for some queries
+            if len(match) == 2 and match[0].distance < self.ratio * match[1].distance:
+                goodMatches.append(match[0])
+        if len(goodMatches) < self.minInliers:
+            return None, 0
+
+        tilePoints = np.array([keypoints[match.queryIdx].pt for match in goodMatches], dtype=np.float32)
+        overviewPoints = self.points[[match.trainIdx for match in goodMatches]]
+        transformation, inliers = cv2.estimateAffinePartial2D(tilePoints, overviewPoints, method=cv2.RANSAC,
+                                                              ransacReprojThreshold=self.reprojectionThreshold_px)
+        inlierCount = int(inliers.sum()) if inliers is not None else 0
+        if transformation is None or inlierCount < self.minInliers:
+            return None, inlierCount
+
+        # Tiles are captured at the calibrated magnification, a scale far from 1 is a wrong match
+        scaleFound = np.hypot(transformation[0, 0], transformation[1, 0])
+        if not 0.8 < scaleFound < 1.25:
+            return None, inlierCount
+
+        center = transformation @ np.array([size[0] / 2, size[1] / 2, 1.0])
+        return (float(center[0]), float(center[1])), inlierCount
+
+    def locate_nm(self, tile, tilePixelSize_nm, predictedOffset_nm=None, searchRadius_nm=500):
+        """Tile center in nm from the overview center
+            predictedOffset_nm : expected position, used by the NCC fallback within searchRadius_nm
+            return : offset (x, y) in nm from the overview center or None, confidence, method used (index, ncc, None)
+        """
+        center, inlierCount = self.query(tile, tilePixelSize_nm)
+        height, width = self.overviewShape
+        if center is not None:
+            return ((center[0] - width / 2) * self.overviewPixelSize_nm,
+                    (center[1] - height / 2) * self.overviewPixelSize_nm), inlierCount, 'index'
+
+        if predictedOffset_nm is None:
+            logging.info(f'Tile not found in the overview index ({inlierCount} inliers)')
+            return None, 0, None
+
+        logging.info(f'Tile not found in the overview index ({inlierCount} inliers), NCC search around prediction')
+        offset, confidence = self.get_fallback_localizer().locate_nm(tile, tilePixelSize_nm, predictedOffset_nm,
+                                                                     searchRadius_nm)
+        if offset is None:
+            return None, confidence, None
+
+        return (predictedOffset_nm[0] + offset[0], predictedOffset_nm[1] + offset[1]), confidence, 'ncc'
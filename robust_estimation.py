@@ -0,0 +1,155 @@
+import numpy as np
+from math import log, ceil
+
+"""
+RANSAC for the translation and rigid (rotation + translation) models of stitching, on matched keypoints.
+Candidate models are drawn and scored in vectorized batches. The number of trials adapts to the best inlier ratio found
+so far : sampling stops once an all-inlier sample has been drawn with the requested confidence. The preemptive mode
+scores a fixed set of hypotheses on growing blocks of points and keeps the best half after each block, for a bounded
+time whatever the inlier ratio. The best model is refit on its inliers by least squares.
+"""
+MODELS = {'translation': 1, 'rigid': 2}
+
+
+class RobustEstimate:
+    def __init__(self, rotation, translation, inliers, residuals, trials):
+        # Model maps src to dst : dst = R(rotation) @ src + translation
+        self.rotation = rotation
+        self.translation = translation
+        self.inliers = inliers
+        self.residuals = residuals
+        self.trials = trials
+
+    @property
+    def inlierCount(self):
+        return int(self.inliers.sum())
+
+    def __repr__(self):
+        return f'RobustEstimate(rotation={self.rotation}, translation={self.translation}, ' \
+               f'inliers={self.inlierCount}/{len(self.inliers)}, trials={self.trials})'
+
+
+def get_required_trials(inlierRatio, sampleSize, confidence):
+    """Trials to draw at least one all-inlier sample with the confidence"""
+    if inlierRatio <= 0:
+        return float('inf')
+
+    allInliers = inlierRatio ** sampleSize
+    if allInliers >= 1:
+        return 1
+
+    return ceil(log(1 - confidence) / log(1 - allInliers))
+
+
+def get_candidate_models(src, dst, samples, model):
+    """Rotations (B,) and translations (B, 2) of the models of a batch of minimal samples (B, sample size)"""
+    if model == 'translation':
+        return np.zeros(len(samples)), dst[samples[:, 0]] - src[samples[:, 0]]
+
+    srcVectors = src[samples[:, 1]] - src[samples[:, 0]]
+    dstVectors = dst[samples[:, 1]] - dst[samples[:, 0]]
+    rotations = np.arctan2(srcVectors[:, 0] * dstVectors[:, 1] - srcVectors[:, 1] * dstVectors[:, 0],
+                           np.sum(srcVectors * dstVectors, axis=1))
+    cos, sin = np.cos(rotations), np.sin(rotations)
+    first = src[samples[:, 0]]
+    rotatedFirst = np.stack([cos * first[:, 0] - sin * first[:, 1], sin * first[:, 0] + cos * first[:, 1]], axis=1)
+    return rotations, dst[samples[:, 0]] - rotatedFirst
+
+
+def get_residuals(src, dst, rotations, translations):
+    """Residuals (B, N) of each point for each model"""
+    cos, sin = np.cos(rotations)[:, None], np.sin(rotations)[:, None]
+    predictedX = cos * src[None, :, 0] - sin * src[None, :, 1] + translations[:, 0:1]
+    predictedY = sin * src[None, :, 0] + cos * src[None, :, 1] + translations[:, 1:2]
+    return np.hypot(predictedX - dst[None, :, 0], predictedY - dst[None, :, 1])
+
+
+def refit(src, dst, inliers, model):
+    """Least squares model on the inliers (2D Kabsch for rigid)"""
+    srcInliers, dstInliers = src[inliers], dst[inliers]
+    srcMean, dstMean = srcInliers.mean(axis=0), dstInliers.mean(axis=0)
+    if model == 'translation':
+        return 0.0, dstMean - srcMean
+
+    srcCentered, dstCentered = srcInliers - srcMean, dstInliers - dstMean
+    rotation = np.arctan2(np.sum(srcCentered[:, 0] * dstCentered[:, 1] - srcCentered[:, 1] * dstCentered[:, 0]),
+                          np.sum(srcCentered * dstCentered))
+    cos, sin = np.cos(rotation), np.sin(rotation)
+    rotatedMean = np.array([cos * srcMean[0] - sin * srcMean[1], sin * srcMean[0] + cos * srcMean[1]])
+    return float(rotation), dstMean - rotatedMean
+
+
+def draw_samples(rng, pointCount, sampleSize, batchSize):
+    samples = rng.integers(0, pointCount, (batchSize, sampleSize))
+    if sampleSize == 2:
+        # Second point different from the first
+        samples[:, 1] = (samples[:, 0] + 1 + rng.integers(0, pointCount - 1, batchSize)) % pointCount
+    return samples
+
+
+def estimate(src, dst, model='rigid', residualThreshold=1.0, confidence=0.999, maxTrials=1000, batchSize=64,
+             preemptive=False, preemptiveBlockSize=32, rng=None):
+    """Robust model mapping src points (N, 2) to dst points (N, 2)
+        return : RobustEstimate, None if there are fewer points than a minimal sample
+    """
+    src = np.asarray(src, dtype=np.float64).reshape(-1, 2)
+    dst = np.asarray(dst, dtype=np.float64).reshape(-1, 2)
+    sampleSize = MODELS[model]
+    pointCount = len(src)
+    if pointCount < sampleSize:
+        return None
+
+    rng = np.random.default_rng() if rng is None else rng
+    if preemptive:
+        bestRotation, bestTranslation, trials = score_preemptive(src, dst, model, residualThreshold, maxTrials,
+                                                                 preemptiveBlockSize, rng)
+    else:
+        bestRotation, bestTranslation, trials = score_adaptive(src, dst, model, residualThreshold, confidence,
+                                                               maxTrials, batchSize, rng)
+
+    inliers = get_residuals(src, dst, np.array([bestRotation]), np.array([bestTranslation]))[0] <= residualThreshold
+    if inliers.sum() >= sampleSize:
+        rotation, translation = refit(src, dst, inliers, model)
+        residuals = get_residuals(src, dst, np.array([rotation]), np.array([translation]))[0]
+        # Keep the refit only if it does not lose inliers
+        if (residuals <= residualThreshold).sum() >= inliers.sum():
+            bestRotation, bestTranslation, inliers = rotation, translation, residuals <= residualThreshold
+    residuals = get_residuals(src, dst, np.array([bestRotation]), np.array([bestTranslation]))[0]
+    return RobustEstimate(float(bestRotation), np.asarray(bestTranslation, dtype=float), inliers, residuals, trials)
+
+
+def score_adaptive(src, dst, model, residualThreshold, confidence, maxTrials, batchSize, rng):
+    """Batches of hypotheses until the trials needed for the best inlier ratio are drawn"""
+    sampleSize = MODELS[model]
+    bestCount = -1
+    bestRotation, bestTranslation = 0.0, np.zeros(2)
+    trials = 0
+    requiredTrials = maxTrials
+    while trials < min(requiredTrials, maxTrials):
+        size = min(batchSize, maxTrials - trials)
+        rotations, translations = get_candidate_models(src, dst, draw_samples(rng, len(src), sampleSize, size), model)
+        counts = (get_residuals(src, dst, rotations, translations) <= residualThreshold).sum(axis=1)
+        best = int(np.argmax(counts))
+        trials += size
+        if counts[best] > bestCount:
+            bestCount = int(counts[best])
+            bestRotation, bestTranslation = rotations[best], translations[best]
+            requiredTrials = get_required_trials(bestCount / len(src), sampleSize, confidence)
+    return bestRotation, bestTranslation, trials
+
+
+def score_preemptive(src, dst, model, residualThreshold, hypothesisCount, blockSize, rng):
+    """Hypotheses scored on blocks of points in random order, the best half is kept after each block"""
+    sampleSize = MODELS[model]
+    rotations, translations = get_candidate_models(src, dst, draw_samples(rng, len(src), sampleSize, hypothesisCount),
+                                                   model)
+    order = rng.permutation(len(src))
+    scores = np.zeros(len(rotations))
+    start = 0
+    while start < len(order) and len(rotations) > 1:
+        block = order[start:start + blockSize]
+        scores += (get_residuals(src[block], dst[block], rotations, translations) <= residualThreshold).sum(axis=1)
+        keep = np.argsort(-scores, kind='stable')[:max(1, len(rotations) // 2)]
+        rotations, translations, scores = rotations[keep], translations[keep], scores[keep]
+        start += blockSize
+    return rotations[0], translations[0], hypothesisCount
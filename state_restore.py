@@ -0,0 +1,151 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Diff-based restore of the microscope state saved by AbstractImpl.save_current_state.
+The present state is read in one snapshot (getters run concurrently when the external communication supports it, their
+Get commands are queued by its command executor, one after the other otherwise), then only the setters whose value
+differs from the saved state are sent, ordered by their dependencies:
+    HV on/off before acceleration voltage and emission current
+    magnification mode before magnification, WD, focus, stigma and probe current (kept per mag mode by the SEM)
+    scan RUN before stage, magnification and focus, the saved scan status is restored last
+"""
+PROBE_CURRENT_MODES = {0: 'Normal', 1: 'High'}
+SCAN_STATUS_VALUES = {'RUN': 0, 'FREEZING': 1, 'FREEZE': 1}
+
+STATE_GETTERS = {'hv_status': lambda commands: commands.get_HV_status(),
+                 'v_acc': lambda commands: commands.get_HV_control()[0],
+                 'emission_current_values': lambda commands: commands.get_emission_current(),
+                 'magnification': lambda commands: commands.get_magnification(),
+                 'WD': lambda commands: commands.get_WD(),
+                 'focus_coarse_fine': lambda commands: commands.get_focus_value(),
+                 'stage_position': lambda commands: commands.get_stage_position(),
+                 'detectors_signals': lambda commands: commands.get_detector_signal(),
+                 'scan_status': lambda commands: commands.get_scan_status(),
+                 'scan_speed': lambda commands: commands.get_scan_speed_status(),
+                 'scan_mode': lambda commands: commands.get_scan_mode(),
+                 'selected_screen': lambda commands: commands.get_selected_screen(),
+                 'stigma_current': lambda commands: commands.get_stigma_current(),
+                 'raster_rotation': lambda commands: commands.get_raster_rotation(),
+                 'probe_current_cond1': lambda commands: commands.get_probe_current_and_cond1()}
+
+# Setters in default order
+#   key : state key, value : part of the state set by the setter, tolerance : difference considered unchanged
+#   after : setters sent before this one when both are needed, needs_scan_run : command fails while scan is frozen
+STATE_SETTERS = {
+    'hv_status': {'key': 'hv_status', 'after': (),
+                  'set': lambda commands, value: commands.set_HV_status(on_off='OFF' if value == 0 else 'ON')},
+    'v_acc': {'key': 'v_acc', 'after': ('hv_status',),
+              'set': lambda commands, value: commands.set_HV_control(vacc=value)},
+    # Actual emission current drifts, only the set value is restored
+    'emission_current': {'key': 'emission_current_values', 'value': lambda state: state[0],
+                         'after': ('hv_status', 'v_acc'),
+                         'set': lambda commands, value: commands.set_emission_current(emission_current=value)},
+    'magnification_mode': {'key': 'magnification', 'value': lambda state: state[0], 'after': (),
+                           'set': lambda commands, value: commands.set_magnification_mode(mag_mode=value)},
+    'magnification': {'key': 'magnification', 'value': lambda state: state[1], 'after': ('magnification_mode',),
+                      'needs_scan_run': True,
+                      'set': lambda commands, value: commands.set_magnification(magnification=value)},
+    'WD': {'key': 'WD', 'after': ('magnification_mode',),
+           'set': lambda commands, value: commands.set_WD(wd=value)},
+    'focus': {'key': 'focus_coarse_fine', 'after': ('magnification_mode', 'WD'), 'needs_scan_run': True,
+              'set': lambda commands, value: commands.set_focus_value(coarse_value=value[0], fine_value=value[1])},
+    'stage_position': {'key': 'stage_position', 'after': (), 'tolerance': (25, 25, 400, 0.0012, 0.009),
+                       'needs_scan_run': True,
+                       'set': lambda commands, value: commands.set_stage_position(x=value[0], y=value[1], z=value[2],
+                                                                                  t=value[3], r=value[4])},
+    'detectors_signals': {'key': 'detectors_signals', 'after': (),
+                          'set': lambda commands, value: commands.set_detectors(list(value))},
+    'scan_speed': {'key': 'scan_speed', 'value': lambda state: state[0], 'after': (),
+                   'set': lambda commands, value: commands.set_scan_speed(value)},
+    # WD, focus and scan speed can't be set in Spot or Area Scan mode
+    'scan_mode': {'key': 'scan_mode', 'after': ('WD', 'focus', 'scan_speed'),
+                  'set': lambda commands, value: commands.set_scan_mode(value)},
+    'selected_screen': {'key': 'selected_screen', 'after': ('detectors_signals',),
+                        'set': lambda commands, value: commands.set_selected_screen(value)},
+    'stigma_current': {'key': 'stigma_current', 'after': ('magnification_mode',),
+                       'set': lambda commands, value: commands.set_stigma_current(x_value=value[0],
+                                                                                  y_value=value[1])},
+    'raster_rotation': {'key': 'raster_rotation', 'after': (),
+                        'set': lambda commands, value: commands.set_raster_rotation(onoff=value[0], angle=value[1])},
+    'probe_current_cond1': {'key': 'probe_current_cond1', 'after': ('magnification_mode',),
+                            'set': lambda commands, value: commands.set_probe_current_and_cond1(
+                                probe_current=PROBE_CURRENT_MODES.get(value[0], value[0]), cond1=value[1])},
+}
+
+
+def read_state_snapshot(commands, max_workers=len(STATE_GETTERS)):
+    """Present state, getters run concurrently only if the external communication supports concurrent commands"""
+    externalCommunication = commands.get_external_communication()
+    if externalCommunication is None or not externalCommunication.supports_concurrent_commands():
+        return {key: getter(commands) for key, getter in STATE_GETTERS.items()}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {key: executor.submit(getter, commands) for key, getter in STATE_GETTERS.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+
+def is_different(saved, present, tolerance=0):
+    if isinstance(saved, (tuple, list)) and isinstance(present, (tuple, list)):
+        if len(saved) != len(present):
+            return True
+
+        tolerances = tolerance if isinstance(tolerance, (tuple, list)) else [tolerance] * len(saved)
+        return any(is_different(savedValue, presentValue, valueTolerance)
+                   for savedValue, presentValue, valueTolerance in zip(saved, present, tolerances))
+
+    try:
+        return abs(float(saved) - float(present)) > tolerance
+    except (TypeError, ValueError):
+        return saved != present
+
+
+def get_setter_value(name, state):
+    setter = STATE_SETTERS[name]
+    value = state[setter['key']]
+    return setter['value'](value) if 'value' in setter else value
+
+
+def order_setters(names):
+    """Dependency order of the setters, default order between independent setters"""
+    remaining = [name for name in STATE_SETTERS if name in names]
+    ordered = []
+    while len(remaining) > 0:
+        for name in remaining:
+            if not any(dependency in remaining for dependency in STATE_SETTERS[name]['after']):
+                ordered.append(name)
+                remaining.remove(name)
+                break
+    return ordered
+
+
+def plan_state_restore(savedState, presentState):
+    """Minimal list of (setter name, value) bringing the present state to the saved state"""
+    changed = [name for name, setter in STATE_SETTERS.items() if setter['key'] in savedState and
+               is_different(get_setter_value(name, savedState), get_setter_value(name, presentState),
+                            setter.get('tolerance', 0))]
+    plan = [(name, get_setter_value(name, savedState)) for name in order_setters(changed)]
+
+    # Scan status : RUN first if needed by a setter, saved status restored last
+    presentScanStatus = presentState.get('scan_status')
+    if presentScanStatus != 'RUN' and any(STATE_SETTERS[name].get('needs_scan_run', False) for name in changed):
+        plan.insert(0, ('scan_status', SCAN_STATUS_VALUES['RUN']))
+        presentScanStatus = 'RUN'
+    savedScanStatus = savedState.get('scan_status')
+    if savedScanStatus in SCAN_STATUS_VALUES and savedScanStatus != presentScanStatus:
+        plan.append(('scan_status', SCAN_STATUS_VALUES[savedScanStatus]))
+    return plan
+
+
+def restore_state(commands, savedState):
+    """Sends the setters of the state that changed, return : list of (setter name, value) sent"""
+    plan = plan_state_restore(savedState, read_state_snapshot(commands))
+    for name, value in plan:
+        logging.info(f'Restoring {name} to {value}')
+        if name == 'scan_status':
+            commands.set_scan_status(value)
+        else:
+            STATE_SETTERS[name]['set'](commands, value)
+
+    logging.info(f'State restored with {len(plan)} setter(s)')
+    return plan
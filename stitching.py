@@ -1,11 +1,10 @@
 from math import ceil, floor
 import cv2
 import math
+import logging
 import os
 from os import listdir
 from tkinter import Tcl
-from skimage.measure import ransac
-from skimage.transform import EuclideanTransform
 import numpy as np
 
 from ORSModel import orsObj, orsVect, Box, ROI, Channel, Vector3, createChannelFromNumpyArray, Graph
@@ -20,68 +19,66 @@ from OrsPythonPlugins.OrsDatasetStitching_a2cacc40fd5a11e7990dc860006dfcdd.layou
 from OrsPythonPlugins.OrsDatasetStitching_a2cacc40fd5a11e7990dc860006dfcdd.stitchers.abstractStitcher import AbstractStitcher
 from OrsPythonPlugins.OrsDatasetStitching_a2cacc40fd5a11e7990dc860006dfcdd.stitchers.application import *
 from OrsPythonPlugins.OrsChannelRegistration.OrsChannelRegistration import OrsChannelRegistration
-from internalProject.microscopeControl.su8230.su8230_calibration import get_image_XY_size_for_magnification
+from internalProject.microscopeControl.su8230.su8230_acquisition_estimator import get_grid_steps_nm
+from internalProject.microscopeControl.su8230.su8230_path_planner import get_snake_index
+from internalProject.microscopeControl.su8230.su8230_field_of_view import get_pixel_size_nm
 from internalProject.microscopeControl.particle_analysis import plotSizeAndEccentricity
-
-# open cv stitching https://colab.research.google.com/drive/11Md7HWh2ZV6_g3iCYSUw76VNr4HzxcX5#scrollTo=Mb0_FCAIE9gO
-def detectAndDescribe(image, method=None):
-    """
-    Compute key points and feature descriptors using an specific method
-    """
-
-    if method is None:
-        return
-
-    # detect and extract features from the image
-    if method == 'sift':
-        descriptor = cv2.SIFT_create()
-    # elif method == 'surf':
-    #     descriptor = cv2.xfeatures2d.SURF_create()
-    elif method == 'brisk':
-        descriptor = cv2.BRISK_create()
-    elif method == 'orb':
-        descriptor = cv2.ORB_create()
-
-    # get keypoints and descriptors
-    (kps, features) = descriptor.detectAndCompute(image, None)
-
-    return (kps, features)
-
-def createMatcher(method, crossCheck):
-    "Create and return a Matcher Object"
-
-    if method == 'sift' or method == 'surf':
-        bf = cv2.BFMatcher(cv2.NORM_L2, crossCheck=crossCheck)
-    elif method == 'orb' or method == 'brisk':
-        bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=crossCheck)
-    return bf
-
-
-def matchKeyPointsBF(featuresA, featuresB, method):
-    bf = createMatcher(method, crossCheck=True)
-
-    # Match descriptors.
-    best_matches = bf.match(featuresA, featuresB)
-
-    # Sort the features in order of distance.
-    # The points with small distance (more similarity) are ordered first in the vector
-    rawMatches = sorted(best_matches, key=lambda x: x.distance)
-    print("Raw matches (Brute force):", len(rawMatches))
-    return rawMatches
+from internalProject.microscopeControl.tracing import traced
+from internalProject.microscopeControl.feature_matching import detectAndDescribe, createMatcher, matchKeyPointsBF
+from internalProject.microscopeControl.transform_cache import TransformCache, hash_array, REGISTRATION_CACHE_FILE
+from internalProject.microscopeControl import robust_estimation
+from internalProject.microscopeControl.tile_localizer import PyramidNccLocalizer
+from internalProject.microscopeControl.overview_context import OverviewContext
+
+# Parameters of the registrations, part of the key of the cached results. The RANSAC epsilon (pixels) is above the
+# keypoint localization noise, a tighter one rejects true matches and the adaptive RANSAC never stops early
+SIFT_PAIR_PARAMETERS = {'featureDetector': 'sift', 'k': 2, 'ratio': 0.7, 'epsilon': 1.5, 'numberOfIterations': 1000,
+                        'model': 'rigid', 'confidence': 0.999}
+# Translation smallest steps are the pixel size, added at registration
+LOW_MAG_REGISTRATION_PARAMETERS = {'useScale': False, 'useRotation': False, 'useTranslation': True,
+                                   'xScaleInitial': 0.1, 'yScaleInitial': 0.1, 'zScaleInitial': 0.1,
+                                   'xRotationInitial': 0.174533, 'yRotationInitial': 0.174533,
+                                   'zRotationInitial': 0.174533, 'xTranslationInitial': 250e-9,
+                                   'yTranslationInitial': 250e-9, 'zTranslationInitial': 200e-9,
+                                   'xScaleSmallest': 0.01, 'yScaleSmallest': 0.01, 'zScaleSmallest': 0.01,
+                                   'xRotationSmallest': 0.00872665, 'yRotationSmallest': 0.00872665,
+                                   'zRotationSmallest': 0.00872665, 'nearestInterpolationMethod': False,
+                                   'mutualInfoRegistrationMethod': True, 'xSampling': 1, 'ySampling': 1,
+                                   'zSampling': 1, 'useMultiScale': False}
+# smallest step : high mag pixel size, initial step: low mag pixel size, mutual info
+GRAPH_REGISTRATION_PARAMETERS = dict(LOW_MAG_REGISTRATION_PARAMETERS, xTranslationInitial=400e-9,
+                                     yTranslationInitial=400e-9, zTranslationInitial=400e-9, xScaleSmallest=0.001,
+                                     yScaleSmallest=0.001, zScaleSmallest=0.001, xSampling=5, ySampling=2)
+# Tiles are searched in the low mag image within this fraction of their width around their predicted position, their
+# box is moved to the position found if the NCC peak is at least SEED_MIN_CONFIDENCE
+SEED_SEARCH_RADIUS_TILES = 0.5
+SEED_MIN_CONFIDENCE = 0.5
+# Registration of a located tile is restricted to a window of the tile size plus this margin in low mag pixels on each
+# side, its initial translation step is a quarter of the margin
+SEED_WINDOW_MARGIN_PX = 8
 
 def getTransformation(referenceChannelGUID, toRegChannelGUID):
     img_ndArray1 = orsObj(referenceChannelGUID).getNDArray()[0]
     img_ndArray2 = orsObj(toRegChannelGUID).getNDArray()[0]
-    featureDetector = 'sift'
+    return getTransformationFromArrays(img_ndArray1, img_ndArray2)
+
+@traced('stitching')
+def getTransformationFromArrays(img_ndArray1, img_ndArray2, diagnostics=None, epsilon=None):
+    """Rigid transformation between two images from their SIFT matches
+        diagnostics : dict filled with the robust estimate (inliers, residuals, trials) if given
+        epsilon : RANSAC residual threshold in pixels, SIFT_PAIR_PARAMETERS if None
+        return : translation Vector3 and rotation, None and None if not found
+    """
+    featureDetector = SIFT_PAIR_PARAMETERS['featureDetector']
     imageToProcess_1 = FeatureExtractorHelper.normalizeImage(img_ndArray1)
     imageToProcess_2 = FeatureExtractorHelper.normalizeImage(img_ndArray2)
     kps1, descs1 = detectAndDescribe(imageToProcess_1, featureDetector)
     kps2, descs2 = detectAndDescribe(imageToProcess_2, featureDetector)
     bf = cv2.BFMatcher()
-    k = 2
-    ratio = 0.7
-    epsilon = 0.1
-    numberOfIterations = 1000
+    k = SIFT_PAIR_PARAMETERS['k']
+    ratio = SIFT_PAIR_PARAMETERS['ratio']
+    epsilon = SIFT_PAIR_PARAMETERS['epsilon'] if epsilon is None else epsilon
+    numberOfIterations = SIFT_PAIR_PARAMETERS['numberOfIterations']
     matches = bf.knnMatch(descs1, descs2, k=k)
     goodMatches = []
     try:
@@ -95,32 +92,127 @@ def getTransformation(referenceChannelGUID, toRegChannelGUID):
     sorted(goodMatches, key=lambda x: x.distance)
     translation, rotation = None, None
     if len(goodMatches) >= 3:  # we need at least 3 samples for ransac
-        try:
-            center = (imageToProcess_1.shape[1] / 2, imageToProcess_1.shape[0] / 2)
-            src_pts = np.array(
-                [(kps1[m.queryIdx].pt[0] - center[0], kps1[m.queryIdx].pt[1] - center[1]) for m in goodMatches])
-            dst_pts = np.array(
-                [(kps2[m.trainIdx].pt[0] - center[0], kps2[m.trainIdx].pt[1] - center[1]) for m in goodMatches])
-
-            transformation_model, _ = ransac((dst_pts, src_pts), EuclideanTransform, min_samples=2,
-                                             residual_threshold=epsilon,
-                                             max_trials=numberOfIterations)
-
-            rotation = transformation_model.rotation
-            translation = Vector3(transformation_model.translation[0], transformation_model.translation[1], 0)
-        except:
-            pass
-        if translation is None or rotation is None:
+        center = (imageToProcess_1.shape[1] / 2, imageToProcess_1.shape[0] / 2)
+        src_pts = np.array(
+            [(kps1[m.queryIdx].pt[0] - center[0], kps1[m.queryIdx].pt[1] - center[1]) for m in goodMatches])
+        dst_pts = np.array(
+            [(kps2[m.trainIdx].pt[0] - center[0], kps2[m.trainIdx].pt[1] - center[1]) for m in goodMatches])
+
+        # Adaptive number of trials, stops once the inlier ratio found makes more trials useless. Seeded, a pair
+        # registers the same at every run like its cached registration
+        estimate = robust_estimation.estimate(dst_pts, src_pts, SIFT_PAIR_PARAMETERS['model'],
+                                              residualThreshold=epsilon, confidence=SIFT_PAIR_PARAMETERS['confidence'],
+                                              maxTrials=numberOfIterations, rng=np.random.default_rng(0))
+        if estimate is not None and estimate.inlierCount >= robust_estimation.MODELS[SIFT_PAIR_PARAMETERS['model']]:
+            rotation = estimate.rotation
+            translation = Vector3(estimate.translation[0], estimate.translation[1], 0)
+            if diagnostics is not None:
+                diagnostics.update(inliers=estimate.inlierCount, matches=len(goodMatches), trials=estimate.trials,
+                                   residuals=estimate.residuals[estimate.inliers])
+        else:
             try:
                 # Ransac failed, we try with an estimation.
                 rotation = FeatureExtractorHelper.findEstimatedRotationAngle(goodMatches, kps1, kps2, imageToProcess_1.shape, epsilon, numberOfIterations)
                 translation = FeatureExtractorHelper.findEstimatedTranslationVector(goodMatches, kps1, kps2, imageToProcess_1.shape, rotation, epsilon,
                                                                  numberOfIterations)
-            except:
+            except Exception as e:
+                logging.info(f'Transformation estimation failed : {e}')
                 return Vector3(0, 0, 0), 0
 
     return translation, rotation
 
+def openRegistrationCache(folder, useCache):
+    return TransformCache(os.path.join(folder, REGISTRATION_CACHE_FILE)) if useCache else None
+
+def closeRegistrationCache(cache):
+    if cache is not None:
+        cache.close()
+
+def getCachedTranslation(cache, referenceChannelGUID, toRegChannelGUID):
+    """Translation of getTransformation, reused from the cache if both tiles are unchanged"""
+    if cache is None:
+        return getTransformation(referenceChannelGUID, toRegChannelGUID)[0]
+
+    def compute():
+        translation, _ = getTransformation(referenceChannelGUID, toRegChannelGUID)
+        return None if translation is None else [translation.getX(), translation.getY(), translation.getZ()]
+
+    inputHashes = [hash_array(orsObj(guid).getNDArray()[0]) for guid in (referenceChannelGUID, toRegChannelGUID)]
+    value = cache.get_or_compute('sift_pair', inputHashes, SIFT_PAIR_PARAMETERS, compute)
+    return None if value is None else Vector3(*value)
+
+def registerToLowMag(cache, lowMagChannel, lowMagHash, mobileChannel, mask, parameters):
+    """OrsChannelRegistration.register of a tile on the low mag image, moves the box of the tile.
+    The registered box center is reused from the cache if the tile, the low mag image, the initial position, the mask
+    and the parameters are unchanged.
+    """
+    def register():
+        OrsChannelRegistration.register(fixedChannel=lowMagChannel, mobileChannel=mobileChannel, mask=mask,
+                                        **parameters)
+        center = mobileChannel.getBox().getCenter()
+        return [center.getX(), center.getY(), center.getZ()]
+
+    if cache is None:
+        register()
+        return
+
+    initialCenter = mobileChannel.getBox().getCenter()
+    keyParameters = dict(parameters, initialCenter=[initialCenter.getX(), initialCenter.getY(), initialCenter.getZ()])
+    if mask is not None:
+        maskBox = mask.getBox()
+        keyParameters['mask'] = [maskBox.getDirection0Size(), maskBox.getDirection1Size()]
+    center = cache.get_or_compute('low_mag_registration', [hash_array(mobileChannel.getNDArray()), lowMagHash],
+                                  keyParameters, register)
+    box = mobileChannel.getBox()
+    box.setCenter(Vector3(*center))
+    mobileChannel.setBox(box)
+
+def createRegistrationMask(box, sizeX, sizeY):
+    """ROI of sizeX by sizeY (m) with the spacing of the box, moved over the low mag image to restrict the
+    registrations"""
+    maskBox = box.copy()
+    maskBox.setDirection0Size(sizeX)
+    maskBox.setDirection1Size(sizeY)
+    visualBox = VisualBoxHelper.createVisualBoxFromBox(aBox=maskBox)
+    mask = ROI()
+    mask.copyShapeFromBox(maskBox, 1)
+    mask.paintShape3D(visualBox.getShape(0), 1, 0)
+    return mask
+
+def moveRegistrationMask(mask, center):
+    boxForMask = mask.getBox()
+    boxForMask.setCenter(center)
+    mask.setBox(boxForMask)
+
+def getSeededRegistrationParameters(parameters, spacingLowMag):
+    """Registration parameters of a tile located in the low mag image, its position is known within a few pixels"""
+    initialStep = SEED_WINDOW_MARGIN_PX / 4 * spacingLowMag
+    return dict(parameters, xTranslationInitial=initialStep, yTranslationInitial=initialStep)
+
+def seedTilePosition(localizer, lowMagChannel, tileChannel, tile, spacing, searchRadius):
+    """Moves the box of the tile to its position in the low mag image found by the localizer within searchRadius (m)
+    of the box center, so the registration starts from it. The box is unchanged if the tile is not found.
+        tile : 2d array of the tile, spacing : its pixel size in m
+        return : True if the box was moved
+    """
+    lowMagCenter = lowMagChannel.getBox().getCenter()
+    spacingLowMag = localizer.overviewPixelSize_nm * 10 ** -9
+    height, width = localizer.context.get_shape()
+    box = tileChannel.getBox()
+    center = box.getCenter()
+    predictedCenter_px = (width / 2 + (center.getX() - lowMagCenter.getX()) / spacingLowMag,
+                          height / 2 + (center.getY() - lowMagCenter.getY()) / spacingLowMag)
+    offset_px, confidence = localizer.locate(tile, spacing * 10 ** 9, predictedCenter_px, searchRadius / spacingLowMag)
+    if offset_px is None or confidence < SEED_MIN_CONFIDENCE:
+        logging.info(f'Tile not found in the low mag image (NCC {confidence:.2f}), registered from its predicted '
+                     f'position')
+        return False
+
+    box.setCenter(Vector3(center.getX() + offset_px[0] * spacingLowMag, center.getY() + offset_px[1] * spacingLowMag,
+                          center.getZ()))
+    tileChannel.setBox(box)
+    return True
+
 def stitch_right_to_left_for_column(list_channels_SE, list_channels_BSE, translation, column_idx, layoutData):
     x_size = layoutData['nbCols']
     y_size = layoutData['nbRows']
@@ -181,8 +273,10 @@ def generate_output_channels(listOfChannels_SE, listOfChannels_BSE=[]):
 
     return outputChannel_SE, outputChannel_BSE
 
+@traced('stitching')
 def stitchEntireGrid(project_name_SE, project_name_BSE, magnification=100000, xSize=5, ySize=5,
-                          photo_size_x=1280, photo_size_y=960):
+                          photo_size_x=1280, photo_size_y=960, useCache=True):
+    """useCache : pair registrations are reused from the registration cache of the SE folder"""
     # get list of captured images in the project folder
     images_SE = [project_name_SE + f for f in listdir(project_name_SE) if os.path.splitext(f)[-1] == '.tiff']
     images_BSE = [project_name_BSE + f for f in listdir(project_name_BSE) if os.path.splitext(f)[-1] == '.tiff']
@@ -196,8 +290,7 @@ def stitchEntireGrid(project_name_SE, project_name_BSE, magnification=100000, xS
     # magnification = 12000
     # photo_size_x = 1280
     # photo_size_y = 960
-    photo_size_x_mm = 127 / magnification
-    spacing = photo_size_x_mm / photo_size_x * 10**-3  # in m
+    spacing = get_pixel_size_nm(magnification, photo_size_x) * 10 ** -9  # in m
     listChannels_SE = OrsImageLoader.createDatasetFromFiles(list(sorted_files_SE), photo_size_x, photo_size_y, z_size, 1, 0, photo_size_x-1, 0,
                                                          photo_size_y-1, 0, z_size-1, 1, 1, 1, 1, spacing, spacing,
                                                          spacing, 1, 0, '', False, False, False, 0, '', False, 0.0,
@@ -231,6 +324,7 @@ def stitchEntireGrid(project_name_SE, project_name_BSE, magnification=100000, xS
     layout_BSE = RegularGrid(layoutData_BSE)
     listOfChannels_BSE = layout_BSE.getListChannelGUIDS()
 
+    cache = openRegistrationCache(project_name_SE, useCache)
     # Stitch columns
     # Reference index first, to stitch index second
     column_idx = 0
@@ -238,7 +332,7 @@ def stitchEntireGrid(project_name_SE, project_name_BSE, magnification=100000, xS
     for aPair in pairsToStitch:
         referenceChannelGUID = listOfChannels_SE[aPair[0]]
         toRegChannelGUID = listOfChannels_SE[aPair[1]]
-        translation, _ = getTransformation(referenceChannelGUID, toRegChannelGUID)
+        translation = getCachedTranslation(cache, referenceChannelGUID, toRegChannelGUID)
         if translation is not None:
             if aPair[0] > aPair[1]:
                 stitch_right_to_left_for_column(listOfChannels_SE, listOfChannels_BSE, translation.getNegated(), column_idx, layoutData_SE)
@@ -253,7 +347,7 @@ def stitchEntireGrid(project_name_SE, project_name_BSE, magnification=100000, xS
     for aPair in pairsToStitch:
         referenceChannelGUID = listOfChannels_SE[aPair[0]]
         toRegChannelGUID = listOfChannels_SE[aPair[1]]
-        translation, _ = getTransformation(referenceChannelGUID, toRegChannelGUID)
+        translation = getCachedTranslation(cache, referenceChannelGUID, toRegChannelGUID)
         if translation is not None:
             if aPair[0] > aPair[1]:
                 stitch_bottom_to_up_for_row(listOfChannels_SE, listOfChannels_BSE, translation.getNegated(), row_idx, layoutData_SE)
@@ -262,6 +356,7 @@ def stitchEntireGrid(project_name_SE, project_name_BSE, magnification=100000, xS
 
         row_idx += 1
 
+    closeRegistrationCache(cache)
     outputChannel_SE, outputChannel_BSE = generate_output_channels(listOfChannels_SE, listOfChannels_BSE)
     outputChannel_SE.atomicSave(os.path.join(project_name_SE, 'Test.ORSObject'), False)
     outputChannel_BSE.atomicSave(os.path.join(project_name_BSE, 'Test.ORSObject'), False)
@@ -273,11 +368,19 @@ def stitchEntireGrid(project_name_SE, project_name_BSE, magnification=100000, xS
     # particle analysis size distribution (use UI to select measurement)
     plotSizeAndEccentricity(ROIForeground)
 
+@traced('stitching')
 def stitchHighMagToLowMag(forStitching='', copyStitching='', lowMag=20000, magnification=100000, xSize=5, ySize=5,
-                          photo_size_x=1280, photo_size_y=960):
+                          photo_size_x=1280, photo_size_y=960, useCache=True, overlapFraction=1 / 11, tiles=None):
+    """forStitching : folder of the tiles registered to the low mag image (its first image)
+        copyStitching : folder or list of folders of tiles captured in the same scan, placed like the registered tiles
+        useCache : tile registrations are reused from the registration cache of the forStitching folder
+        overlapFraction : overlap the grid was captured with, guides the registration of the tiles
+        tiles : (xIndex, yIndex) of the tiles captured in a sparse grid, all tiles if None. Each tile is registered to
+        the low mag image on its own, the missing tiles are left out of the output
+    """
+    copyFolders = [copyStitching] if isinstance(copyStitching, str) else list(copyStitching)
+    copyFolders = [folder for folder in copyFolders if folder != '']
     # Get list of captured images in the project folder
-    images_SE = [copyStitching + f for f in listdir(copyStitching) if os.path.splitext(f)[-1] == '.tiff']
-    sorted_files_SE = Tcl().call('lsort', '-dict', images_SE)
     images_BSE = [forStitching + f for f in listdir(forStitching) if os.path.splitext(f)[-1] == '.tiff']
     sorted_files_BSE = Tcl().call('lsort', '-dict', images_BSE)
 
@@ -287,17 +390,18 @@ def stitchHighMagToLowMag(forStitching='', copyStitching='', lowMag=20000, magni
     # ySize = 5
     # photo_size_x = 1280
     # photo_size_y = 960
-    zSize = xSize * ySize
+    # Slice of each captured tile by its snake index, the images are named in snake order
+    snakeIndices = range(xSize * ySize) if tiles is None else \
+        sorted(get_snake_index(xIndex, yIndex, ySize) for xIndex, yIndex in tiles)
+    sliceIndices = {snakeIndex: zIndex for zIndex, snakeIndex in enumerate(snakeIndices)}
+    zSize = len(sliceIndices)
 
     # Compute spacing from image info
-    photo_size_x_nm, photo_size_y_nm = get_image_XY_size_for_magnification(magnification)
-    x_step_nm = round(ceil(photo_size_x_nm - photo_size_x_nm / 11) / 25) * 25
-    y_step_nm = round(ceil(photo_size_y_nm - photo_size_y_nm / 11) / 25) * 25
+    x_step_nm, y_step_nm = get_grid_steps_nm(magnification, overlapFraction)
     xStep = x_step_nm*10e-10
     yStep = y_step_nm*10e-10
-    photo_size_x_mm = 127 / magnification
-    spacing = photo_size_x_mm / photo_size_x * 10 ** -3  # in m
-    spacingLowMag = 127 / lowMag / photo_size_x * 10 ** -3  # in m
+    spacing = get_pixel_size_nm(magnification, photo_size_x) * 10 ** -9  # in m
+    spacingLowMag = get_pixel_size_nm(lowMag, photo_size_x) * 10 ** -9  # in m
 
     # Create a box of grid image size to guide registration
     box = Box()
@@ -315,12 +419,23 @@ def stitchHighMagToLowMag(forStitching='', copyStitching='', lowMag=20000, magni
                                                               1, 1, 1, 1, spacingLowMag, spacingLowMag, spacingLowMag,
                                                               1, 0, '', False, False, False, 0, '', False, 0.0, 0.0, 1, '')
     lowMagChannel = channel_SE_lowmag[0]
+    cache = openRegistrationCache(forStitching, useCache)
+    lowMagHash = hash_array(lowMagChannel.getNDArray()) if cache is not None else None
+    # Normalized low mag image and its pyramids built once, every tile is located in it by NCC before its registration
+    context = OverviewContext.build(lowMagChannel.getNDArray()[0], spacingLowMag * 10 ** 9)
+    localizer = PyramidNccLocalizer.from_context(context)
 
     # Add grid images as channel in dragonfly
-    channels_SE = OrsImageLoader.createDatasetFromFiles(list(sorted_files_SE), photo_size_x, photo_size_y, zSize + 1,
-                                                        1, 0, photo_size_x - 1, 0, photo_size_y - 1, 0, zSize,
-                                                        1, 1, 1, 1, spacing, spacing, spacing, 1, 0, '', False,
-                                                        False, False, 0, '', False, 0.0, 0.0, 1, '')
+    copyChannels = []
+    for folder in copyFolders:
+        images_SE = [folder + f for f in listdir(folder) if os.path.splitext(f)[-1] == '.tiff']
+        sorted_files_SE = Tcl().call('lsort', '-dict', images_SE)
+        copyChannels.append(OrsImageLoader.createDatasetFromFiles(list(sorted_files_SE), photo_size_x, photo_size_y,
+                                                                  zSize + 1,
+                                                                  1, 0, photo_size_x - 1, 0, photo_size_y - 1, 0,
+                                                                  zSize, 1, 1, 1, 1, spacing, spacing, spacing, 1, 0,
+                                                                  '', False, False, False, 0, '', False, 0.0, 0.0, 1,
+                                                                  ''))
     channels_BSE = OrsImageLoader.createDatasetFromFiles(list(sorted_files_BSE), photo_size_x, photo_size_y,
                                                         zSize + 1,
                                                         1, 0, photo_size_x - 1, 0, photo_size_y - 1, 0, zSize,
@@ -330,15 +445,11 @@ def stitchHighMagToLowMag(forStitching='', copyStitching='', lowMag=20000, magni
     # initial center of first image on low mag (the grid first image top left)
     lowMagCenter = lowMagChannel.getBox().getCenter()
     # Reposition a mask using box created to help find the registration area
-    maskBox = box.copy()
     # pad the mask (pad values can be changed in UI)
-    maskBox.setDirection0Size((photo_size_x + 200) * spacing)
-    maskBox.setDirection1Size((photo_size_y + 100) * spacing)
-    visualBox = VisualBoxHelper.createVisualBoxFromBox(aBox=maskBox)
-    mask = ROI()
-    mask.copyShapeFromBox(maskBox, 1)
-    aShape = visualBox.getShape(0)
-    mask.paintShape3D(aShape, 1, 0)
+    mask = createRegistrationMask(box, (photo_size_x + 200) * spacing, (photo_size_y + 100) * spacing)
+    # Window around the tiles located in the low mag image
+    windowMask = createRegistrationMask(box, photo_size_x * spacing + 2 * SEED_WINDOW_MARGIN_PX * spacingLowMag,
+                                        photo_size_y * spacing + 2 * SEED_WINDOW_MARGIN_PX * spacingLowMag)
     maskCenter = lowMagCenter
 
     # Current position
@@ -348,57 +459,41 @@ def stitchHighMagToLowMag(forStitching='', copyStitching='', lowMag=20000, magni
 
     # high mag images taken with snake pattern
     snakeValue = 1
-    listChannels_SE = []
+    listChannels_SE = [[] for _ in copyFolders]
     listChannels_BSE = []
     for xIndex in range(xSize):
         for yIndex in range(ySize):
             n+= 1
+            # Tile not captured in a sparse grid
+            if n - 1 not in sliceIndices:
+                cur_y += snakeValue * yStep
+                continue
+
             # Get each grid image - slice of the channel
-            zIndex = xSize*xIndex + yIndex
-            aChannel_SE = createChannelFromNumpyArray(channels_SE[0].getNDArray()[zIndex])
+            zIndex = sliceIndices[n - 1]
             aChannel_BSE = createChannelFromNumpyArray(channels_BSE[0].getNDArray()[zIndex])
             # Place high mag image box at approximately the right position on low mag image to guide registration
             maskCenter.setY(cur_y)
             maskCenter.setX(cur_x)
             box.setCenter(maskCenter)
             aChannel_BSE.setBox(box)
-            boxForMask = mask.getBox()
-            boxForMask.setCenter(maskCenter)
-            mask.setBox(boxForMask)
+            isSeeded = seedTilePosition(localizer, lowMagChannel, aChannel_BSE, channels_BSE[0].getNDArray()[zIndex],
+                                        spacing, SEED_SEARCH_RADIUS_TILES * photo_size_x * spacing)
+            tileMask = windowMask if isSeeded else mask
+            moveRegistrationMask(tileMask, aChannel_BSE.getBox().getCenter())
             # mask.atomicSave(os.path.join(copyStitching, f'mask{n}.ORSObject'), False)
             # Register high mag channel to low mage channel
             # tune registration in UI : xTranslationInitial, yTranslationInitial, xSampling and ySampling
-            transformationMatrix, metricSimilarity = OrsChannelRegistration.register(fixedChannel=lowMagChannel,
-                                                                                     mobileChannel=aChannel_BSE,
-                                                                                     useScale=False, useRotation=False,
-                                                                                     useTranslation=True,
-                                                                                     xScaleInitial=0.1,
-                                                                                     yScaleInitial=0.1,
-                                                                                     zScaleInitial=0.1,
-                                                                                     xRotationInitial=0.174533,
-                                                                                     yRotationInitial=0.174533,
-                                                                                     zRotationInitial=0.174533,
-                                                                                     xTranslationInitial=250e-9,
-                                                                                     yTranslationInitial=250e-9,
-                                                                                     zTranslationInitial=200e-9,
-                                                                                     xScaleSmallest=0.01,
-                                                                                     yScaleSmallest=0.01,
-                                                                                     zScaleSmallest=0.01,
-                                                                                     xRotationSmallest=0.00872665,
-                                                                                     yRotationSmallest=0.00872665,
-                                                                                     zRotationSmallest=0.00872665,
-                                                                                     xTranslationSmallest=spacing,
-                                                                                     yTranslationSmallest=spacing,
-                                                                                     zTranslationSmallest=spacing,
-                                                                                     nearestInterpolationMethod=False,
-                                                                                     mutualInfoRegistrationMethod=True,
-                                                                                     xSampling=1, ySampling=1,
-                                                                                     zSampling=1, mask=mask,
-                                                                                     useMultiScale=False)
-            # Apply tranformation to the grid SE and BSE image (using the box)
+            parameters = dict(LOW_MAG_REGISTRATION_PARAMETERS, xTranslationSmallest=spacing,
+                              yTranslationSmallest=spacing, zTranslationSmallest=spacing)
+            registerToLowMag(cache, lowMagChannel, lowMagHash, aChannel_BSE, tileMask,
+                             getSeededRegistrationParameters(parameters, spacingLowMag) if isSeeded else parameters)
+            # Apply tranformation to the grid image of every copied signal (using the box)
             mobileChannelBox = aChannel_BSE.getBox()
-            aChannel_SE.setBox(mobileChannelBox)
-            listChannels_SE.append(aChannel_SE.getGUID())
+            for channels_SE, listCopyChannels in zip(copyChannels, listChannels_SE):
+                aChannel_SE = createChannelFromNumpyArray(channels_SE[0].getNDArray()[zIndex])
+                aChannel_SE.setBox(mobileChannelBox)
+                listCopyChannels.append(aChannel_SE.getGUID())
             listChannels_BSE.append(aChannel_BSE.getGUID())
             cur_y += snakeValue * yStep
 
@@ -409,10 +504,13 @@ def stitchHighMagToLowMag(forStitching='', copyStitching='', lowMag=20000, magni
 
         #maskCenter.setY(maskCenter.getY() - snakeValue * yStep)
 
+    closeRegistrationCache(cache)
     # Create output channel from list of stitched images
-    outputChannel_SE, outputChannel_BSE = generate_output_channels(listChannels_BSE, listChannels_SE)
-    outputChannel_SE.atomicSave(os.path.join(copyStitching, 'Test1.ORSObject'), False)
+    outputChannel_BSE, _ = generate_output_channels(listChannels_BSE)
     outputChannel_BSE.atomicSave(os.path.join(forStitching, 'Stitched1.ORSObject'), False)
+    for folder, listCopyChannels in zip(copyFolders, listChannels_SE):
+        outputChannel_SE, _ = generate_output_channels(listCopyChannels)
+        outputChannel_SE.atomicSave(os.path.join(folder, 'Test1.ORSObject'), False)
 
     # segment features with otsu (use UI to select algorithm)
     otsuThreshold, minValue, maxValue = Otsu.getOtsuThresholdAndMinMax(outputChannel_BSE, t=0, mask=None, aProgress=None)
@@ -421,7 +519,45 @@ def stitchHighMagToLowMag(forStitching='', copyStitching='', lowMag=20000, magni
     # particle analysis size distribution (use UI to select measurement)
     plotSizeAndEccentricity(ROIForeground)
 
-def stitchHighMagToLowMagWithGraph(project_name, overviewImage, cntGraph, lowMag, magnification, photo_size_x, photo_size_y, zSize):
+def getRegistrationScore(filePath, featureDetector='sift'):
+    """Keypoints found on a tile by the feature detector used for registration"""
+    image = cv2.imread(filePath, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return 0
+
+    keypoints, _ = detectAndDescribe(image, featureDetector)
+    return len(keypoints)
+
+def selectRegistrationSignal(signalFolders, sampleTiles=3):
+    """Signal of a multi-signal acquisition registering best, the one with the most keypoints on a few of its tiles
+        signalFolders : dict of signal to the folder of its tiles
+    """
+    scores = {}
+    for signal, folder in signalFolders.items():
+        images = sorted(f for f in listdir(folder) if os.path.splitext(f)[-1] == '.tiff')
+        sampled = images[::max(1, len(images) // sampleTiles)][:sampleTiles]
+        scores[signal] = np.mean([getRegistrationScore(os.path.join(folder, f)) for f in sampled]) if sampled else 0
+
+    return max(scores, key=scores.get)
+
+@traced('stitching')
+def stitchMultiSignalGrid(signalFolders, lowMag=20000, magnification=100000, xSize=5, ySize=5, photo_size_x=1280,
+                          photo_size_y=960, overlapFraction=1 / 11, tiles=None):
+    """Tiles of all signals are captured in the same scan, so share their placement : the signal registering best is
+    registered to the low mag image once and its placement is applied to the tiles of every other signal.
+    """
+    registrationSignal = selectRegistrationSignal(signalFolders)
+    otherSignals = [signal for signal in signalFolders if signal != registrationSignal]
+    logging.info(f'Tiles of {otherSignals} are placed with the registration of {registrationSignal}')
+    stitchHighMagToLowMag(signalFolders[registrationSignal], [signalFolders[signal] for signal in otherSignals],
+                          lowMag, magnification, xSize, ySize, photo_size_x, photo_size_y,
+                          overlapFraction=overlapFraction, tiles=tiles)
+    return registrationSignal
+
+@traced('stitching')
+def stitchHighMagToLowMagWithGraph(project_name, overviewImage, cntGraph, lowMag, magnification, photo_size_x, photo_size_y, zSize,
+                                   useCache=True):
+    """useCache : tile registrations are reused from the registration cache of the project folder"""
     # Get list of captured images in the project folder
     # project_name_BSE = 'D:\\'
     images_SE = [project_name + f for f in listdir(project_name) if os.path.splitext(f)[-1] == '.tiff']
@@ -434,9 +570,8 @@ def stitchHighMagToLowMagWithGraph(project_name, overviewImage, cntGraph, lowMag
     # magnification = 100000
     # photo_size_x = 1280
     # photo_size_y = 960
-    photo_size_x_mm = 127 / magnification
-    spacing = photo_size_x_mm / photo_size_x * 10 ** -3  # in m
-    spacingLowMag = 127 / lowMag / photo_size_x * 10 ** -3  # in m
+    spacing = get_pixel_size_nm(magnification, photo_size_x) * 10 ** -9  # in m
+    spacingLowMag = get_pixel_size_nm(lowMag, photo_size_x) * 10 ** -9  # in m
     box = Box()
     box.setDirection0Spacing(spacing)
     box.setDirection1Spacing(spacing)
@@ -460,17 +595,18 @@ def stitchHighMagToLowMagWithGraph(project_name, overviewImage, cntGraph, lowMag
     #                                                     False, False, 0, '', False, 0.0, 0.0, 1, '')
     lowMagChannel = channel_SE_lowmag[0]
     lowMagCenter = lowMagChannel.getBox().getCenter()
+    cache = openRegistrationCache(project_name, useCache)
+    lowMagHash = hash_array(lowMagChannel.getNDArray()) if cache is not None else None
+    # Normalized low mag image and its pyramids built once, every tile is located in it by NCC before its registration
+    context = OverviewContext.build(lowMagChannel.getNDArray()[0], spacingLowMag * 10 ** 9)
+    localizer = PyramidNccLocalizer.from_context(context)
     listChannels_SE = []
     listChannels_BSE = []
-    maskBox = box.copy()
-    maskBox.setDirection0Size((photo_size_x+1000)*spacing)
-    maskBox.setDirection1Size((photo_size_y+1000)*spacing)
-    visualBox = VisualBoxHelper.createVisualBoxFromBox(aBox=maskBox)
     # Use a mask to help find the registration area
-    mask = ROI()
-    mask.copyShapeFromBox(maskBox, 1)
-    aShape = visualBox.getShape(0)
-    mask.paintShape3D(aShape, 1, 0)
+    mask = createRegistrationMask(box, (photo_size_x + 1000) * spacing, (photo_size_y + 1000) * spacing)
+    # Window around the tiles located in the low mag image
+    windowMask = createRegistrationMask(box, photo_size_x * spacing + 2 * SEED_WINDOW_MARGIN_PX * spacingLowMag,
+                                        photo_size_y * spacing + 2 * SEED_WINDOW_MARGIN_PX * spacingLowMag)
     # n = 0
     timeIndex = 0
     # todo send vertices used directly from acquisitions
@@ -486,7 +622,6 @@ def stitchHighMagToLowMagWithGraph(project_name, overviewImage, cntGraph, lowMag
     currentPosition = overviewImage.getBox().getCenter()
     curX = currentPosition.getX()
     curY = currentPosition.getY()
-    maskToUse = None
     zIndex = 0
     for aVertex in validVertices:
         xPos = vertices.at(3*aVertex)
@@ -506,41 +641,19 @@ def stitchHighMagToLowMagWithGraph(project_name, overviewImage, cntGraph, lowMag
         maskCenter.setY(yPos)
         box.setCenter(maskCenter)
         aChannel_SE.setBox(box)
-        boxForMask = mask.getBox()
-        boxForMask.setCenter(maskCenter)
-        mask.setBox(boxForMask)
+        isSeeded = seedTilePosition(localizer, lowMagChannel, aChannel_SE, channels_SE[0].getNDArray()[zIndex],
+                                    spacing, SEED_SEARCH_RADIUS_TILES * photo_size_x * spacing)
+        tileMask = windowMask if isSeeded else mask
+        moveRegistrationMask(tileMask, aChannel_SE.getBox().getCenter())
         # mask.atomicSave(os.path.join(project_name_SE, f'mask{zIndex}.ORSObject'), False)
 
         # Register high mag channel to low mage channel
         # smallest step : high mag pixel size, initial step: low mag pixel size, mutual info
         # tune registration in UI : xTranslationInitial, yTranslationInitial, xSampling and ySampling
-        transformationMatrix, metricSimilarity = OrsChannelRegistration.register(fixedChannel=lowMagChannel,
-                                                                                 mobileChannel=aChannel_SE,
-                                                                                 useScale=False, useRotation=False,
-                                                                                 useTranslation=True,
-                                                                                 xScaleInitial=0.1,
-                                                                                 yScaleInitial=0.1,
-                                                                                 zScaleInitial=0.1,
-                                                                                 xRotationInitial=0.174533,
-                                                                                 yRotationInitial=0.174533,
-                                                                                 zRotationInitial=0.174533,
-                                                                                 xTranslationInitial=400e-9,
-                                                                                 yTranslationInitial=400e-9,
-                                                                                 zTranslationInitial=400e-9,
-                                                                                 xScaleSmallest=0.001,
-                                                                                 yScaleSmallest=0.001,
-                                                                                 zScaleSmallest=0.001,
-                                                                                 xRotationSmallest=0.00872665,
-                                                                                 yRotationSmallest=0.00872665,
-                                                                                 zRotationSmallest=0.00872665,
-                                                                                 xTranslationSmallest=spacingLowMag,
-                                                                                 yTranslationSmallest=spacingLowMag,
-                                                                                 zTranslationSmallest=spacingLowMag,
-                                                                                 nearestInterpolationMethod=False,
-                                                                                 mutualInfoRegistrationMethod=True,
-                                                                                 xSampling=5, ySampling=2,
-                                                                                 zSampling=1, mask=maskToUse,
-                                                                                 useMultiScale=False)
+        parameters = dict(GRAPH_REGISTRATION_PARAMETERS, xTranslationSmallest=spacingLowMag,
+                          yTranslationSmallest=spacingLowMag, zTranslationSmallest=spacingLowMag)
+        registerToLowMag(cache, lowMagChannel, lowMagHash, aChannel_SE, tileMask,
+                         getSeededRegistrationParameters(parameters, spacingLowMag) if isSeeded else parameters)
         # mobileChannelBox = aChannel_SE.getBox()
         # aChannel_BSE.setBox(mobileChannelBox)
         listChannels_SE.append(aChannel_SE.getGUID())
@@ -549,7 +662,7 @@ def stitchHighMagToLowMagWithGraph(project_name, overviewImage, cntGraph, lowMag
         curX = xPos
         curY = yPos
 
-
+    closeRegistrationCache(cache)
 
     outputChannel_SE, outputChannel_BSE = generate_output_channels(listChannels_SE, listChannels_BSE)
     outputChannel_SE.atomicSave(os.path.join(project_name, 'Unstitched.ORSObject'), False)
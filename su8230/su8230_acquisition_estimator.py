@@ -0,0 +1,233 @@
+import logging
+from math import ceil, hypot
+from internalProject.microscopeControl.su8230.su8230_field_of_view import get_image_XY_size_for_magnification, \
+    get_pixel_size_nm
+from internalProject.microscopeControl.su8230.su8230_capture_settings import CaptureSettingsTable, \
+    get_feasible_capture_settings, CAPTURE_RESOLUTIONS
+from internalProject.microscopeControl.su8230.su8230_beam_shift_calibration import NOMINAL_UNIT_PX, split_image_shift
+
+"""
+Predicts the duration of grid and tracking acquisitions from what was measured on the microscope:
+    command latencies recorded by the external communication
+    stage speed fitted on set_stage_XY completions
+    capture duration of the capture settings (CaptureSettingsTable)
+    image transfer and tiff conversion time
+Defaults are used for anything not measured yet.
+"""
+
+# Send and receive sleep 2 s each, waiting for IDLE polls at least once (0.5 s + send and receive)
+DEFAULT_COMMAND_LATENCY_S = 8.5
+DEFAULT_TRANSFER_S = 1.0
+DEFAULT_STAGE_SPEED_NM_S = 500000
+# Steps smaller than this use beam shift instead of stage shift (same rule as Su8230Impl)
+BEAM_SHIFT_LIMIT_NM = 900
+# Measured latency of these commands includes the stage travel or the capture, they are estimated separately
+LONG_COMMAND_KEYS = ('Set CAPTURESAVE EXECUTE', 'Set STAGEUNIT MOVEXY', 'Set STAGEUNIT MOVEXYR',
+                     'Set STAGEUNIT MOVEXYZTR', 'Set STAGEUNIT RELATIVEXY')
+
+
+def get_grid_steps_nm(magnification, overlapFraction=1 / 11):
+    """Grid steps in x and y with an overlap of overlapFraction of the image"""
+    photo_size_x_nm, photo_size_y_nm = get_image_XY_size_for_magnification(magnification)
+    # Step needs to be of minimum 25 nm increment
+    x_step_nm = round(ceil(photo_size_x_nm - photo_size_x_nm * overlapFraction) / 25) * 25
+    y_step_nm = round(ceil(photo_size_y_nm - photo_size_y_nm * overlapFraction) / 25) * 25
+    return x_step_nm, y_step_nm
+
+
+def get_number_of_image_shift_commands(steps_nm, magnification, xPixelSize, axis=0, beamShiftCalibration=None):
+    """Number of set_image_shift commands for consecutive steps along the axis from a total shift of 0 : full 127
+    shifts and the remaining shift. Units of a step are computed like Su8230Impl.getImageShiftUnits, from the beam
+    shift calibration and the total shift of the previous steps, 1 beam shift = 3.4 * pixel size (nm) without
+    calibration.
+    """
+    nominalUnit_nm = NOMINAL_UNIT_PX * get_pixel_size_nm(magnification, xPixelSize)
+    totalUnits = 0
+    count = 0
+    for step_nm in steps_nm:
+        if beamShiftCalibration is not None:
+            units = beamShiftCalibration.get_shift_units(magnification, axis, totalUnits, step_nm, nominalUnit_nm)
+        else:
+            units = int(round(step_nm / nominalUnit_nm))
+        count += len(split_image_shift(units))
+        totalUnits += units
+    return count
+
+
+class AcquisitionTimeEstimator:
+    def __init__(self, commands=None, captureSettingsTable=None, beamShiftCalibration=None):
+        """beamShiftCalibration : BeamShiftCalibration used to send the image shifts, nominal units if None"""
+        self.commands = commands
+        self.captureSettingsTable = captureSettingsTable if captureSettingsTable is not None else CaptureSettingsTable()
+        self.beamShiftCalibration = beamShiftCalibration
+
+    def get_command_latency(self, command_key):
+        externalCommunication = self.commands.get_external_communication() if self.commands is not None else None
+        if externalCommunication is None:
+            return DEFAULT_COMMAND_LATENCY_S
+
+        latency = None
+        if command_key not in LONG_COMMAND_KEYS:
+            latency = externalCommunication.get_mean_command_latency(command_key)
+
+        if latency is None:
+            latency = externalCommunication.get_mean_latency_for_main_code(command_key.split()[0],
+                                                                          DEFAULT_COMMAND_LATENCY_S,
+                                                                          excluded_keys=LONG_COMMAND_KEYS)
+        return latency
+
+    def get_transfer_time(self):
+        externalCommunication = self.commands.get_external_communication() if self.commands is not None else None
+        if externalCommunication is None:
+            return DEFAULT_TRANSFER_S
+
+        return externalCommunication.get_mean_command_latency('im_transfer', DEFAULT_TRANSFER_S)
+
+    def get_stage_model(self):
+        """Least square fit of duration = overhead + distance / speed on measured stage moves
+            return : overhead in s, speed in nm/s
+        """
+        moves = getattr(self.commands, 'stageMoveDurations', [])
+        defaultModel = (self.get_command_latency('Set STAGEUNIT MOVEXY'), DEFAULT_STAGE_SPEED_NM_S)
+        if len(moves) < 2:
+            return defaultModel
+
+        meanDistance = sum(move[0] for move in moves) / len(moves)
+        meanDuration = sum(move[1] for move in moves) / len(moves)
+        variance = sum((move[0] - meanDistance) ** 2 for move in moves)
+        if variance == 0:
+            return defaultModel
+
+        slope = sum((move[0] - meanDistance) * (move[1] - meanDuration) for move in moves) / variance
+        if slope <= 0:
+            return defaultModel
+
+        overhead = max(meanDuration - slope * meanDistance, 0)
+        return overhead, 1 / slope
+
+    def get_capture_time(self, captureSettings):
+        return self.captureSettingsTable.get_duration(captureSettings['scan_mode'], captureSettings['resolution'],
+                                                      captureSettings['scan_time'],
+                                                      captureSettings['integration_number'])
+
+    @staticmethod
+    def new_breakdown():
+        return {'commands': 0.0, 'stage': 0.0, 'capture': 0.0, 'transfer': 0.0, 'tiles': 0, 'total': 0.0}
+
+    def add_capture(self, breakdown, captureSettings):
+        """A tile averaged from fast frames (captureSettings 'frames') costs a capture and a transfer per frame"""
+        frames = captureSettings.get('frames', 1)
+        breakdown['commands'] += frames * self.get_command_latency('Set CAPTURESAVE EXECUTE')
+        breakdown['capture'] += frames * self.get_capture_time(captureSettings)
+        breakdown['transfer'] += frames * self.get_transfer_time()
+
+    def add_magnification_change(self, breakdown):
+        breakdown['commands'] += self.get_command_latency('Get SCAN NOW') + \
+                                 self.get_command_latency('Set MAGNIFICATION EXECUTE')
+
+    def add_stage_move(self, breakdown, distance_nm):
+        overhead, speed = self.get_stage_model()
+        breakdown['commands'] += self.get_command_latency('Get SCAN NOW') + overhead
+        breakdown['stage'] += distance_nm / speed
+
+    def add_image_shifts(self, breakdown, numberOfShifts):
+        breakdown['commands'] += numberOfShifts * (self.get_command_latency('Get MAGNIFICATION NOW') +
+                                                   self.get_command_latency('Get SCAN NOW') +
+                                                   self.get_command_latency('Set PANEL IMAGESHIFTX'))
+
+    def add_low_mag_overview(self, breakdown, captureSettings):
+        breakdown['commands'] += self.get_command_latency('Set CAPTURESAVE CAPTURESPEED')
+        self.add_magnification_change(breakdown)
+        self.add_capture(breakdown, captureSettings)
+        self.add_magnification_change(breakdown)
+
+    @staticmethod
+    def finalize(breakdown):
+        breakdown['total'] = breakdown['commands'] + breakdown['stage'] + breakdown['capture'] + breakdown['transfer']
+        return breakdown
+
+    def estimate_grid(self, x, y, magnification, captureSettings, xPixelSize=640, useBeamShift=None):
+        """Breakdown in s of capture_XbyY_grid (overview, then snake by columns)"""
+        breakdown = self.new_breakdown()
+        self.add_low_mag_overview(breakdown, captureSettings)
+        x_step_nm, y_step_nm = get_grid_steps_nm(magnification)
+        if useBeamShift is None:
+            useBeamShift = x_step_nm < BEAM_SHIFT_LIMIT_NM or y_step_nm < BEAM_SHIFT_LIMIT_NM
+
+        if useBeamShift:
+            # Same steps as gridAcquisitionBeamShift : snake along y in each column, then one column back along x
+            ySteps = [(1 if column % 2 == 0 else -1) * y_step_nm for column in range(x) for _ in range(y - 1)]
+            self.add_image_shifts(breakdown, get_number_of_image_shift_commands(ySteps, magnification, xPixelSize, 1,
+                                                                                self.beamShiftCalibration))
+            self.add_image_shifts(breakdown, get_number_of_image_shift_commands([-x_step_nm] * x, magnification,
+                                                                                xPixelSize, 0,
+                                                                                self.beamShiftCalibration))
+        else:
+            # First move is at the current position, one move per tile
+            self.add_stage_move(breakdown, 0)
+            for _ in range(x * (y - 1)):
+                self.add_stage_move(breakdown, y_step_nm)
+            for _ in range(x - 1):
+                self.add_stage_move(breakdown, x_step_nm)
+
+        for _ in range(x * y):
+            self.add_capture(breakdown, captureSettings)
+
+        breakdown['tiles'] = x * y
+        return self.finalize(breakdown)
+
+    def estimate_tracking(self, steps_nm, magnification, captureSettings, xPixelSize=640):
+        """Breakdown in s of tracking, steps_nm are the (x, y) steps between consecutive skeleton vertices"""
+        breakdown = self.new_breakdown()
+        self.add_low_mag_overview(breakdown, captureSettings)
+        xSteps, ySteps = [], []
+        for x_step_nm, y_step_nm in steps_nm:
+            # skip vertices in near vicinity
+            if abs(x_step_nm) < 600 and abs(y_step_nm) < 400:
+                continue
+
+            if abs(y_step_nm) < BEAM_SHIFT_LIMIT_NM or abs(x_step_nm) < BEAM_SHIFT_LIMIT_NM:
+                xSteps.append(x_step_nm)
+                ySteps.append(y_step_nm)
+            else:
+                breakdown['commands'] += self.get_command_latency('Get STAGEUNIT MOVEXYZTR')
+                self.add_stage_move(breakdown, hypot(x_step_nm, y_step_nm))
+
+            self.add_capture(breakdown, captureSettings)
+            breakdown['tiles'] += 1
+
+        # Beam shifts accumulate over the run, like beamShift
+        self.add_image_shifts(breakdown, get_number_of_image_shift_commands(xSteps, magnification, xPixelSize, 0,
+                                                                            self.beamShiftCalibration) +
+                              get_number_of_image_shift_commands(ySteps, magnification, xPixelSize, 1,
+                                                                 self.beamShiftCalibration))
+        return self.finalize(breakdown)
+
+    def recommend_grid_plan(self, x, y, magnification, time_budget_s, min_resolution='640x480'):
+        """Best plan variant (beam or stage shift, capture settings) finishing within the time budget. Higher resolution
+            first, then the longest capture (more signal), then the shortest run.
+            return : dict with useBeamShift, captureSettings and estimate, None if no variant meets the budget
+        """
+        bestPlan = None
+        bestRank = None
+        for scan_mode, resolution, scan_time, integration_number in get_feasible_capture_settings():
+            if CAPTURE_RESOLUTIONS[resolution] < CAPTURE_RESOLUTIONS[min_resolution]:
+                continue
+
+            captureSettings = {'scan_mode': scan_mode, 'resolution': resolution, 'scan_time': scan_time,
+                               'integration_number': integration_number}
+            xPixelSize = int(resolution.split('x')[0])
+            for useBeamShift in (False, True):
+                estimate = self.estimate_grid(x, y, magnification, captureSettings, xPixelSize, useBeamShift)
+                if estimate['total'] > time_budget_s:
+                    continue
+
+                rank = (CAPTURE_RESOLUTIONS[resolution], self.get_capture_time(captureSettings), -estimate['total'])
+                if bestRank is None or rank > bestRank:
+                    bestRank = rank
+                    bestPlan = {'useBeamShift': useBeamShift, 'captureSettings': captureSettings,
+                                'estimate': estimate}
+
+        if bestPlan is None:
+            logging.info(f'No plan variant finishes within {time_budget_s} s')
+        return bestPlan
@@ -0,0 +1,1068 @@
+import time
+import asyncio
+import logging
+from math import hypot
+from internalProject.microscopeControl.command_executor import PRIORITY_SAFETY
+from internalProject.microscopeControl.su8230.su8230_external_communication import Su8230ExternalCommunication
+from internalProject.microscopeControl.su8230.su8230_capture_settings import CAPTURE_SCAN_MODES, CAPTURE_RESOLUTIONS, \
+    CAPTURE_SCAN_TIMES, CAPTURE_INTEGRATION_NUMBERS, FEASIBILITY_TABLE
+from internalProject.microscopeControl.su8230.su8230_beam_shift_calibration import IMAGE_SHIFT_RANGE
+
+"""
+Coroutines of the SU8230 getters and setters, they send their Get/Set commands through the command executor of the
+external communication and parse the replies
+
+    asyncCommands = AsyncSu8230Commands(externalCommunication)
+    await asyncio.gather(asyncCommands.set_stage_XY(x, y), asyncCommands.get_emission_current())
+
+Commands awaited on the event loop thread of the external communication go straight to the command executor, from
+another event loop they are handed over to it. Su8230Commands runs them on the event loop thread and waits for the
+result, the ranges of the values are documented there.
+"""
+
+
+class AsyncSu8230Commands:
+    mag_modes = {'High-Mag': 0, 'Low-Mag': 1}
+    scan_speeds = {'Rapid1': 10, 'Rapid2': 11, 'FAST1': 12, 'FAST2': 13, 'SLOW1': 20, 'SLOW2': 21, 'SLOW3': 22,
+                   'SLOW4': 23, 'SLOW5': 24, 'SLOW6': 25, 'SLOW7': 26, 'CSS1': 30, 'CSS2': 31, 'CSS3': 32, 'CSS4': 33,
+                   'CSS5': 34, 'CSS6': 35, 'CSS7': 36, 'REDUCE1': 40, 'REDUCE2': 41, 'REDUCE3': 42}
+
+    scan_mode = {'Normal Scan': 0, 'Spot Position Set': 1, 'Spot mode': 2, 'Area Position Set': 3, 'Area Scan mode': 4}
+    selected_screens = {'screen1': 0, 'screen2': 0, 'screen3': 0, 'screen4': 0, 'screenMix': 0}
+    alignment_mode = {'Beam Alignment': 0, 'Aperture Alignment': 1, 'Stigma X Alignment': 2,
+                      'Stigma Y Alignment': 3, 'ULV Alignment': 4, 'Low Mag Position': 5}
+    probe_current = {'Normal': 0, 'High': 1}
+    flashing_modes = {'Mild': 0, 'Normal': 1}
+    # Capture settings
+    capture_scan_mode = CAPTURE_SCAN_MODES
+    capture_resolution = CAPTURE_RESOLUTIONS
+    capture_scan_time = CAPTURE_SCAN_TIMES
+    capture_integration_number = CAPTURE_INTEGRATION_NUMBERS
+
+    def __init__(self, external_communication=None):
+        if external_communication is None:
+            external_communication = Su8230ExternalCommunication()
+            external_communication.set_sem_dir_temp('V:/SemImage/temp')
+        self.external_communication = external_communication
+        # Measured stage moves (distance in nm, duration in s) from set_stage_XY completions
+        self.stageMoveDurations = []
+        self._lastStageXY = None
+        # Movable range read once, limited by sample size and optional detectors (cleared at specimen exchange)
+        self._movableRange = None
+        # Signals of screen 1 to 4 read once for All captures (cleared by set_detectors)
+        self._screenSignals = None
+        # Total image shift (x, y) sent since set_image_shift_zero, image shift values are relative and the total cannot
+        # be read, it is assumed to be 0 at the connection until set_image_shift_zero
+        self._imageShiftUnits = [0, 0]
+        self._imageShiftZeroed = False
+
+    def get_external_communication(self):
+        return self.external_communication
+
+    async def process_get_command(self, command_string, priority=None):
+        """Raw Get command, returns the decoded reply"""
+        return await self.execute(command_string, priority)
+
+    async def process_set_command(self, command_string, priority=None):
+        """Raw Set command, returns the decoded reply"""
+        return await self.execute(command_string, priority)
+
+    async def process_safety_command(self, command_string):
+        """Skips the command queues and the command delay and cancels the queued Sets"""
+        return await self.execute(command_string, PRIORITY_SAFETY)
+
+    async def execute(self, command_string, priority):
+        commandExecutor = self.external_communication.get_command_executor()
+        if priority is None:
+            priority = self.external_communication.get_async_communication().get_command_priority(command_string)
+        if asyncio.get_running_loop() is self.external_communication.get_event_loop_thread().loop:
+            return await commandExecutor.execute(command_string, priority)
+        return await asyncio.wrap_future(commandExecutor.submit(command_string, priority))
+
+    # Getters
+    async def get_instrument_name(self):
+        """SEM returns model name"""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get InstructName ALL')
+            if dictDecodedMessage is not None:
+                instrumentName = dictDecodedMessage['data']
+                return instrumentName
+
+        return ''
+
+    async def get_version_information(self):
+        """SEM returns program version"""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get Version ALL')
+            if dictDecodedMessage is not None:
+                version = dictDecodedMessage['data']
+                return version
+
+        return ''
+
+    async def get_HV_status(self):
+        """SEM returns HV ON/OFF status"""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get HVONOFF ALL')
+            if dictDecodedMessage is not None:
+                hvonoff = dictDecodedMessage['data']
+                return int(hvonoff)
+
+        return 0
+
+    async def get_HV_control(self):
+        """SEM returns present acceleration voltage (Vacc) and deceleration voltage (Vdec)"""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get HVCONTROL VACC')
+            if dictDecodedMessage is not None:
+                vacc, vdec = str(dictDecodedMessage['data']).split(',')
+                vacc = float(vacc)/1000
+                vdec = float(vdec)/1000
+                return vacc, vdec
+
+        return 0, 0
+
+    async def get_emission_current(self):
+        """SEM returns set value and preset actual value of emission current"""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get EMISSION NOW')
+            if dictDecodedMessage is not None:
+                set_value, actual_value = str(dictDecodedMessage['data']).split(',')
+                set_value = float(set_value)/1000
+                actual_value = float(actual_value)/1000
+                return set_value, actual_value
+        return 0, 0
+
+    async def get_magnification(self):
+        """SEM returns present magnification mode (High-Mag/Low-Mag) and magnification value"""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get MAGNIFICATION NOW')
+            if dictDecodedMessage is not None:
+                magmode, mag = str(dictDecodedMessage['data']).split(',')
+                # Find string associated to value
+                for aMode in self.mag_modes:
+                    if int(magmode) == self.mag_modes[aMode]:
+                        return aMode, int(mag)
+
+        return '', 0
+
+    async def get_WD(self):
+        """SEM returns present WD (working distance) value calculated from focus current"""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get WD NOW')
+            if dictDecodedMessage is not None:
+                wd = dictDecodedMessage['data']
+                return float(wd)
+
+        return 0
+
+    async def get_focus_value(self):
+        """SEM returns focus current DAC value (focus coarse and fine)"""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get FOCUS NOW')
+            if dictDecodedMessage is not None:
+                coarse, fine = str(dictDecodedMessage['data']).split(',')
+                return int(coarse), int(fine)
+
+        return 0, 0
+
+    async def get_stage_position(self):
+        """SEM returns present stage coordinates (5 axes, X, Y, Z, T, R)"""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get STAGEUNIT MOVEXYZTR')
+            if dictDecodedMessage is not None:
+                x, y, z, t, r = str(dictDecodedMessage['data']).split(',')
+                t = float(t) / 1000
+                r = float(r) / 1000
+                return int(x), int(y), int(z), t, r
+
+        return 0, 0, 0, 0, 0
+
+    async def get_stage_position_2(self):
+        """SEM returns present stage coordinates (5 axes, X, Y, Z, T, R)"""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get STAGEUNIT MOVEXYZTR2')
+            if dictDecodedMessage is not None:
+                x, y, z, t, r = str(dictDecodedMessage['data']).split(',')
+                t = float(t) / 1000
+                r = float(r) / 1000
+                return int(x), int(y), int(z), t, r
+
+        return 0, 0, 0, 0, 0
+
+    async def get_movable_range_stage(self):
+        """SEM returns present movable range of stage limited by sample size, insertion of optional detector, etc."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get STAGESETTING LIMIT2')
+            if dictDecodedMessage is not None:
+                xMin, xMax, yMin, yMax, zMin, zMax, tMin, tMax, rMode = str(dictDecodedMessage['data']).split(',')
+                tMin = float(tMin) / 1000
+                tMax = float(tMax) / 1000
+                return int(xMin), int(xMax), int(yMin), int(yMax), int(zMin), int(zMax), tMin, tMax, int(rMode)
+
+        return 0, 0, 0, 0, 0, 0, 0, 0, 0
+
+    async def get_cached_movable_range(self):
+        """Movable range of stage, read from the SEM on first use only"""
+        if self._movableRange is None:
+            self._movableRange = await self.get_movable_range_stage()
+        return self._movableRange
+
+    def clear_movable_range_cache(self):
+        self._movableRange = None
+
+    async def get_cached_screen_signals(self):
+        if self._screenSignals is None:
+            self._screenSignals = await self.get_detector_signal()
+        return self._screenSignals
+
+    def get_image_shift_units(self):
+        """Total image shift (x, y) sent since set_image_shift_zero (or the connection), no command sent"""
+        return tuple(self._imageShiftUnits)
+
+    def set_image_shift_zero(self):
+        """Counts the total image shift from 0, once the image shift is reset on the SEM"""
+        self._imageShiftUnits = [0, 0]
+        self._imageShiftZeroed = True
+
+    def is_image_shift_zeroed(self):
+        return self._imageShiftZeroed
+
+    async def get_detector_signal(self):
+        """SEM returns signal name assigned to screen 1 to screen 4."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get DETECTOR SIGNAL')
+            if dictDecodedMessage is not None:
+                screen1, screen2, screen3, screen4 = str(dictDecodedMessage['data']).split(',')
+                return screen1, screen2, screen3, screen4
+
+        return '*', '*', '*', '*'
+
+    async def get_detector_high_mag(self):
+        """SEM returns signal names assignable to image screen using "Set DETECTOR ALL" command in High-Mag mode."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get DETECTOR HIGHMAG')
+            if dictDecodedMessage is not None:
+                signal_names = dictDecodedMessage['data']
+                return signal_names
+
+        return ''
+
+    async def get_detector_low_mag(self):
+        """SEM returns signal names assignable to image screen using "Set DETECTOR ALL" command in Low-Mag mode."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get DETECTOR LOWMAG')
+            if dictDecodedMessage is not None:
+                signal_names = dictDecodedMessage['data']
+                return signal_names
+
+        return ''
+
+    async def get_detector_option(self):
+        """SEM returns signal names of optional detectors assignable to image screen."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get DETECTOR OPTION')
+            if dictDecodedMessage is not None:
+                signal_names = dictDecodedMessage['data']
+                return signal_names
+
+        return ''
+
+    async def get_sample_settings(self):
+        """SEM returns present specified sample size and height setting."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get SPECIMEN ALL')
+            if dictDecodedMessage is not None:
+                size, height = str(dictDecodedMessage['data']).split(',')
+                height = float(height) / 1000
+                return size, height
+
+        return 0, 0
+
+    async def get_scan_status(self):
+        """SEM returns present scan status."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get SCAN NOW')
+            if dictDecodedMessage is not None:
+                scan_status = dictDecodedMessage['data']
+                return scan_status
+
+        return ''
+
+    async def get_scan_speed_status(self):
+        """SEM returns present scan speed and number of averaging frames."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get SCAN SCANSPEED')
+            if dictDecodedMessage is not None:
+                speed, averaging_frames = str(dictDecodedMessage['data']).split(',')
+                # Find string associated to value
+                for aSpeed in self.scan_speeds:
+                    if int(speed) == self.scan_speeds[aSpeed]:
+                        return aSpeed, int(averaging_frames)
+
+        return 0, 0
+
+    async def get_scan_mode(self):
+        """SEM returns present scan mode"""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get SCAN SCANMODE')
+            if dictDecodedMessage is not None:
+                scan_mode = dictDecodedMessage['data']
+                # Find string associated to value
+                for aMode in self.scan_mode:
+                    if int(scan_mode) == self.scan_mode[aMode]:
+                        return aMode
+
+        return ''
+
+    async def get_selected_screen(self):
+        """SEM returns screen number that is selected as target of operation."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get SCREEN NOW')
+            if dictDecodedMessage is not None:
+                selected_screen = dictDecodedMessage['data']
+                # Find string associated to value
+                for aScreen in self.selected_screens:
+                    if int(selected_screen) == self.selected_screens[aScreen]:
+                        return aScreen
+
+        return ''
+
+    async def get_photo_size(self):
+        """SEM returns screen mode and Photo-size."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get PHOTOSIZE NOW')
+            if dictDecodedMessage is not None:
+                screen_mode, photo_size = str(dictDecodedMessage['data']).split(',')
+                photo_size = float(photo_size)/1000  # turns value into mm
+                return int(screen_mode), photo_size
+
+        return 0, 0
+
+    async def get_alignment_parameter(self):
+        """SEM returns present axis alignment data (DAC setting value of aligner current supply)."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get ALIGNMENT NOW')
+            if dictDecodedMessage is not None:
+                dictAlignmentParameters = {}
+                items = str(dictDecodedMessage['data']).split(',')
+                dictAlignmentParameters['beam_alignmentX'] = int(items[0])
+                dictAlignmentParameters['beam_alignmentY'] = int(items[1])
+                dictAlignmentParameters['aperture_alignmentX'] = int(items[2])
+                dictAlignmentParameters['aperture_alignmentY'] = int(items[3])
+                dictAlignmentParameters['stigma_alignmentXX'] = int(items[4])
+                dictAlignmentParameters['stigma_alignmentXY'] = int(items[5])
+                dictAlignmentParameters['stigma_alignmentYX'] = int(items[6])
+                dictAlignmentParameters['stigma_alignmentYY'] = int(items[7])
+                dictAlignmentParameters['ulv_alignmentX'] = int(items[8])
+                dictAlignmentParameters['ulv_alignmentY'] = int(items[9])
+                dictAlignmentParameters['low_mag_posX'] = int(items[10])
+                dictAlignmentParameters['low_mag_posY'] = int(items[11])
+                return dictAlignmentParameters
+
+        return {}
+
+    async def get_probe_current_and_cond1(self):
+        """SEM return present Probe current mode and Cond.1 setting."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get LENSMODE NOW')
+            if dictDecodedMessage is not None:
+                probe_current_mode, cond1_setting = str(dictDecodedMessage['data']).split(',')
+                cond1_setting = float(cond1_setting)/10
+                return int(probe_current_mode), cond1_setting
+
+        return 0, 0
+
+    async def get_stigma_current(self):
+        """SEM returns present stigma current X, Y (DAC value of current driver)."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get STIGMAXY NOW')
+            if dictDecodedMessage is not None:
+                stigmaX, stigmaY = str(dictDecodedMessage['data']).split(',')
+                return stigmaX, stigmaY
+
+        return 0, 0
+
+    async def get_raster_rotation(self):
+        """SEM returns present Raster Rotation status, on/off and rotation angle."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            dictDecodedMessage = await self.process_get_command('Get RROTATION NOW')
+            if dictDecodedMessage is not None:
+                onoff, rotation_angle = str(dictDecodedMessage['data']).split(',')
+                rotation_angle = float(rotation_angle)/1000
+                return int(onoff), rotation_angle
+
+        return 0, 0
+
+    # Setters
+    # TODO with function update_current_state - for all the setters, change the dict current state value
+    async def set_HV_status(self, on_off):
+        """This command sets HV ON/OFF status."""
+        command = f'Set HVONOFF EXECUTE {on_off}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_HV_off_immediately(self):
+        """Safety stop of the beam : turns the HV off, sent before the commands waiting to be sent"""
+        command = 'Set HVONOFF EXECUTE OFF'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_safety_command(command)
+            logging.info(result)
+
+    async def set_HV_control(self, vacc):
+        """This command sets acceleration voltage."""
+
+        # Command doesn't work in deceleration mode
+        if await self.get_HV_status() == 2:
+            return False
+
+        vacc *= 1000
+        command = f'Set HVCONTROL VACC {vacc}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+        return True
+
+    async def set_emission_current(self, emission_current):
+        """This command sets the emission current."""
+        # Command doesn't work when HV status is OFF
+        if await self.get_HV_status() == 0:
+            return False
+
+        emission_current *= 10
+        command = f'Set EMISSION EXECUTE {emission_current}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+        return True
+
+    async def set_magnification(self, magnification):
+        """This command sets the magnification."""
+        # Make sure the scan status is Run, if frozen the command won't work
+        isFrozen = await self.get_scan_status() == 'FREEZE'
+        if isFrozen:
+            await self.set_scan_status(0)
+
+        command = f'Set MAGNIFICATION EXECUTE {magnification}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+        # If the scan status was frozen, put it back
+        if isFrozen:
+            await self.set_scan_status(1)
+
+    async def set_magnification_mode(self, mag_mode):
+        """This command sets the magnification mode."""
+        if mag_mode not in self.mag_modes:
+            logging.info('Set value in command text is not correct (not defined, out of range, etc.)')
+            return
+
+        command = f'Set MAGMODE EXECUTE {self.mag_modes[mag_mode]}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_WD(self, wd):
+        """This command sets the WD (working distance) value and set focus current."""
+        # Make sure the magnification mode is High-Mag, in Low-Mag the command won't work
+        isLowMag = (await self.get_magnification())[0] == 1
+        if isLowMag:
+            await self.set_magnification_mode(0)
+
+        # Make sure the scan mode is not Spot or Area Scan mode
+        if await self.get_scan_mode() == 'Spot mode' or await self.get_scan_mode() == 'Area Scan mode':
+            return False
+
+        wd *= 1000
+        command = f'Set WD HM {wd}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+        # If the magnification mode was Low-Mag, put it back
+        if isLowMag:
+            await self.set_magnification_mode(1)
+
+        return True
+
+    async def set_focus_value(self, coarse_value, fine_value):
+        """This command sets focus current DAC value."""
+        # Make sure the scan status is Run, if frozen the command won't work
+        isFrozen = await self.get_scan_status() == 'FREEZE'
+        if isFrozen:
+            await self.set_scan_status(0)
+
+        # Make sure the magnification mode is High-Mag, in Low-Mag the command won't work
+        isLowMag = (await self.get_magnification())[0] == 1
+        if isLowMag:
+            await self.set_magnification_mode(0)
+
+        # Make sure the scan mode is not Spot or Area Scan mode
+        if await self.get_scan_mode() == 'Spot mode' or await self.get_scan_mode() == 'Area Scan mode':
+            return False
+
+        command = f'Set FOCUS ALL {coarse_value},{fine_value}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+        # If the scan status was frozen, put it back
+        if isFrozen:
+            await self.set_scan_status(1)
+
+        # If the magnification mode was Low-Mag, put it back
+        if isLowMag:
+            await self.set_magnification_mode(1)
+
+        return True
+
+    async def getIsInMovableRange(self, x, y, z=None, t=None, r=None):
+        # Verify that the values are inside the movable range
+        xMin, xMax, yMin, yMax, zMin, zMax, tMin, tMax, rMode = await self.get_cached_movable_range()
+        if x < xMin or x > xMax:
+            return False
+
+        if y < yMin or y > yMax:
+            return False
+
+        if z is not None:
+            if z < zMin or z > zMax:
+                return False
+
+        if t is not None:
+            if t < tMin or t > tMax:
+                return False
+
+        if r is not None:
+            if (rMode == 1 and r > 359900) or (rMode == 2 and r > 90000) or (rMode == 3 and r > 180000) \
+                    or (rMode == 4 and r > 0):
+                return False
+
+        return True
+
+    async def set_stage_position(self, x=None, y=None, z=None, t=None, r=None):
+        """This command drives stage specifying all 5 axes coordinates value."""
+        # Make sure the scan status is Run, if frozen the command won't work
+        isFrozen = await self.get_scan_status() == 'FREEZE'
+        if isFrozen:
+            await self.set_scan_status(0)
+
+        # Verify that positions are in movable range
+        isInMovableRange = await self.getIsInMovableRange(x, y, z, t, r)
+        if not isInMovableRange:
+            return False
+
+        # If the increment is too small, stay at current position
+        x_present, y_present, z_present, t_present, r_present = await self.get_stage_position_2()
+        if abs(x - x_present) < 25:
+            x = x_present
+        if abs(y - y_present) < 25:
+            y = y_present
+        if abs(z - z_present) < 400:
+            z = z_present
+        if abs(t - t_present) < 0.0012:
+            t = t_present
+        if abs(r - r_present) < 0.009:
+            r = r_present
+
+        t *= 1000
+        r *= 1000
+        command = f'Set STAGEUNIT MOVEXYZTR {x},{y},{z},{t},{r}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+        return True
+
+    async def set_stage_XYR(self, x=None, y=None, r=None):
+        """This command drives stage specifying X, Y and R axes coordinates value."""
+        # Make sure the scan status is Run, if frozen the command won't work
+        isFrozen = await self.get_scan_status() == 'FREEZE'
+        if isFrozen:
+            await self.set_scan_status(0)
+
+        # Verify that positions are in movable range
+        isInMovableRange = await self.getIsInMovableRange(x, y, r)
+        if not isInMovableRange:
+            return False
+
+        # If the increment is too small, stay at current position
+        x_present, y_present, z_present, t_present, r_present = await self.get_stage_position_2()
+        if abs(x - x_present) < 25:
+            x = x_present
+        if abs(y - y_present) < 25:
+            y = y_present
+        if abs(r - r_present) < 0.009:
+            r = r_present
+
+        r *= 1000
+        command = F'Set STAGEUNIT MOVEXYR {x},{y},{r}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+        # If the scan status was frozen, put it back
+        if isFrozen:
+            await self.set_scan_status(1)
+
+        return True
+
+    async def set_stage_XY(self, x=None, y=None):
+        """This command drives stage specifying X, Y axes coordinates value."""
+        # Make sure the scan status is Run, if frozen the command won't work
+        isFrozen = await self.get_scan_status() == 'FREEZE'
+        if isFrozen:
+            await self.set_scan_status(0)
+
+        command = f'Set STAGEUNIT MOVEXY {x},{y},0'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            startTime = time.perf_counter()
+            result = await self.process_set_command(command)
+            logging.info(result)
+            # Command returns when the SEM is idle, the duration includes stage travel (unless the move was stopped)
+            isComplete = result is None or result.get('is_complete', True)
+            if self._lastStageXY is not None and isComplete:
+                distance = hypot(x - self._lastStageXY[0], y - self._lastStageXY[1])
+                self.stageMoveDurations.append((distance, time.perf_counter() - startTime))
+            self._lastStageXY = (x, y)
+
+        # If the scan status was frozen, put it back
+        if isFrozen:
+            await self.set_scan_status(1)
+
+        return True
+
+    async def set_stage_relative_XY(self, x=0, y=0):
+        """This command drives stage specifying relative value X, Y."""
+        # Make sure the scan status is Run, if frozen the command won't work
+        isFrozen = await self.get_scan_status() == 'FREEZE'
+        if isFrozen:
+            await self.set_scan_status(0)
+
+        x_present, y_present, z_present, t_present, r_present = await self.get_stage_position_2()
+        x_new = x_present + x
+        y_new = y_present + y
+
+        # Verify that positions are in movable range
+        isInMovableRange = await self.getIsInMovableRange(x_new, y_new)
+        if not isInMovableRange:
+            return False
+
+        command = f'Set STAGEUNIT RELATIVEXY {x},{y}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+        # If the scan status was frozen, put it back
+        if isFrozen:
+            await self.set_scan_status(1)
+
+        return True
+
+    async def set_stage_move_exchange(self):
+        """This command drives stage to specimen exchange position."""
+        command = 'Set STAGEUNIT MOVEEXCHANGE *'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+            # Movable range changes with the sample
+            self.clear_movable_range_cache()
+
+    async def set_home_position(self):
+        """This command drives stage to home position."""
+        command = 'Set STAGEUNIT MOVEHOME *'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_move_constant_speed(self, **kwargs):
+        """This command drives stage to specified direction with constant specified speed."""
+        x_control = kwargs['x_control']
+        x_direction = kwargs['x_direction']
+        x_speed = kwargs['x_speed']
+        y_control = kwargs['y_control']
+        y_direction = kwargs['y_direction']
+        y_speed = kwargs['y_speed']
+        command = f'Set STAGEUNIT CONSTMOVE2 {x_control},{x_direction},{x_speed},{y_control},{y_direction},{y_speed}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_stage_move_stop(self):
+        """This command stops stage motion if sent during stage is moving."""
+        command = 'Set STAGE STOP ' + '*'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_safety_command(command)
+            logging.info(result)
+
+    async def set_detectors(self, list_of_signals):
+        """This command sets signal name for image screen 1 to 4."""
+        if len(list_of_signals) > 6:
+            logging.info('Too many signals to display.')
+            return False
+
+        data = str(list_of_signals[0])
+        for signal in list_of_signals:
+            data += (f',{signal}')
+
+        command = 'Set DETECTOR ALL ' + data
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+            self._screenSignals = None
+
+        return True
+
+    async def set_scan_status(self, status):
+        """This command sets scan status."""
+        command = 'Set SCAN EXECUTE ' + str(status)
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_scan_freeze_immediately(self):
+        """Safety stop of the scan : immediately freezes it, sent before the commands waiting to be sent"""
+        command = 'Set SCAN EXECUTE 2'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_safety_command(command)
+            logging.info(result)
+
+    async def set_scan_speed(self, speed):
+        """This command sets scan speed."""
+        if speed not in self.scan_speeds:
+            logging.info('Set value in command text is not correct (not defined, out of range, etc.)')
+            return False
+
+        # Make sure the scan mode is not Spot or Area Scan mode
+        if await self.get_scan_mode() == 'Spot mode' or await self.get_scan_mode() == 'Area Scan mode':
+            return False
+
+        command = 'Set SCAN SCANSPEED ' + str(self.scan_speeds[speed])
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+        return True
+
+    async def set_scan_mode(self, mode):
+        """This command sets scan mode."""
+        if mode not in self.scan_mode:
+            logging.info('Set value in command text is not correct (not defined, out of range, etc.)')
+            return False
+
+
+        command = 'Set SCAN SCANMODE ' + str(self.scan_mode[mode])
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+        return True
+
+    async def set_selected_screen(self, selected_screen):
+        """In Dual or Quad screen mode, this command selects a screen to set it as the target of operation."""
+        screen_number = 0
+        signals = await self.get_detector_signal()
+        for aSignal in signals:
+            if aSignal == selected_screen:
+                break
+            screen_number += 1
+
+        if screen_number > 3:
+            logging.info('Set value in command text is not correct (not defined, out of range, etc.)')
+            return
+
+        command = 'Set SCREEN EXECUTE ' + str(screen_number)
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_direct_save(self, arg):
+        """This command freezes image if running and saves image."""
+        value = None
+        if arg == 'Single':
+            value = 0
+        elif arg == 'All':
+            value = 1
+
+        command = f'Set DIRECTSAVE EXECUTE {value}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    def validate_capture_setting_parameters(self, scan_mode, resolution, scan_time, integration_number):
+        """Looks up the precomputed feasibility table, arguments are the indices of the capture dictionaries"""
+        return FEASIBILITY_TABLE.get((scan_mode, resolution, scan_time, integration_number), False)
+
+    async def set_capture_settings(self, scan_mode, resolution, scan_time, integration_number):
+        """This command sets parameters for image capturing."""
+        is_valid = self.validate_capture_setting_parameters(self.capture_scan_mode[scan_mode],
+                                                            self.capture_resolution[resolution],
+                                                            self.capture_scan_time[scan_time],
+                                                            self.capture_integration_number[integration_number])
+        if not is_valid:
+            logging.info('Capture settings are not compatible')
+            return False
+
+        command = f'Set CAPTURESAVE CAPTURESPEED {self.capture_scan_mode[scan_mode]},{self.capture_resolution[resolution]},{self.capture_scan_time[scan_time]},{self.capture_integration_number[integration_number]}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+            return True
+
+        return False
+
+    async def set_capture_and_save(self, arg, project_name='', newFileName=''):
+        """This command runs image capturing and save captured image(s)."""
+        value = None
+        if arg == 'Single':
+            value = 0
+        elif arg == 'All':
+            saveDirs = await self.set_capture_and_save_signals(project_name, newFileName)
+            return next(iter(saveDirs.values()), project_name) if saveDirs is not None else None
+
+        command = f'Set CAPTURESAVE EXECUTE {value}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            # File copies and tiff conversion, off the event loop
+            save_dir = await asyncio.to_thread(externalCommunication.im_transfer, project_name, newFileName)
+            logging.info(result)
+            return save_dir
+
+    async def set_capture_and_save_signals(self, project_name='', newFileName=''):
+        """Captures all screens in one scan, the signals of the screens are set with set_detectors."""
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command('Set CAPTURESAVE EXECUTE 1')
+            screenSignals = await self.get_cached_screen_signals()
+            saveDirs = await asyncio.to_thread(externalCommunication.im_transfer_signals, project_name, newFileName,
+                                               screenSignals)
+            logging.info(result)
+            return saveDirs
+
+    async def set_alignment_set(self, mode, x_value, y_value):
+        """This command sets axial alignment data."""
+        if mode not in self.alignment_mode:
+            logging.info('Set value in command text is not correct (not defined, out of range, etc.)')
+            return
+
+        command = f'Set ALIGNMENT EXECUTE {self.alignment_mode[mode]},{x_value},{y_value}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_probe_current_and_cond1(self, probe_current, cond1):
+        """This command sets Probe current mode and Condenser lens 1 setting value."""
+        if probe_current not in self.probe_current:
+            logging.info('Set value in command text is not correct (not defined, out of range, etc.)')
+            return
+
+        cond1 *= 10
+        command = f'Set LENSMODE EXECUTE {self.probe_current[probe_current]},{cond1}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_stigma_current(self, x_value, y_value):
+        """This command sets stigma current."""
+        command = f'Set STIGMAXY EXECUTE {x_value},{y_value}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_raster_rotation(self, onoff, angle):
+        """This command sets On/Off and angle of raster rotation."""
+        angle *= 10
+        command = f'Set RROTATION EXECUTE {onoff},{angle}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_flashing(self, flashing_mode):
+        """This command executes flashing."""
+        if flashing_mode not in self.flashing_modes:
+            logging.info('Set value in command text is not correct (not defined, out of range, etc.)')
+            return False
+
+        command = f'Set FLASHING EXECUTE {self.flashing_modes[flashing_mode]}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+        return True
+
+    async def set_degauss(self):
+        """This command executes degaussing (demagnetization of magnetic lenses)."""
+        command = 'Set DEGAUSS EXECUTE *'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_auto_focus(self):
+        """This command executes auto-focus."""
+        command = 'Set AUTO AFC *'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_auto_stigma(self):
+        """This command executes auto-stigma."""
+        command = 'Set AUTO ASC *'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_ABC(self, abc_mode, beam_adjust):
+        """This command executes ABCC (auto-brightness/contrast adjustment)."""
+        command = f'Set AUTO ABC {abc_mode},{beam_adjust}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_beam_monitor_adjust(self):
+        """This command executes beam monitor adjustment."""
+        command = 'Set AUTO BMC *'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_contrast_adjust(self, value):
+        """This command adjusts image contrast."""
+        command = f'Set PANEL CONTRAST {value}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_brightness_adjust(self, value):
+        """This command adjusts image brightness."""
+        command = f'Set PANEL BRIGHTNESS {value}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+
+    async def set_image_shift_X(self, value):
+        """This command moves image in horizontal direction by image shift function."""
+        # Make sure the magnification mode is High-Mag, in Low-Mag the command won't work
+        isLowMag = (await self.get_magnification())[0] == 1
+        if isLowMag:
+            await self.set_magnification_mode(0)
+
+        # Make sure the scan status is Run, if frozen the command won't work
+        isFrozen = await self.get_scan_status() == 'FREEZE'
+        if isFrozen:
+            await self.set_scan_status(0)
+
+        command = f'Set PANEL IMAGESHIFTX {int(value)}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+            self._add_image_shift(0, int(value))
+
+        # If the magnification mode was Low-Mag, put it back
+        if isLowMag:
+            await self.set_magnification_mode(1)
+
+        # If the scan status was frozen, put it back
+        if isFrozen:
+            await self.set_scan_status(1)
+
+    def _add_image_shift(self, axis, value):
+        # Image does not move when the total would exceed the range
+        if abs(self._imageShiftUnits[axis] + value) <= IMAGE_SHIFT_RANGE:
+            self._imageShiftUnits[axis] += value
+        else:
+            logging.warning(f'Image shift {value} on axis {axis} from {self._imageShiftUnits[axis]} beyond the assumed '
+                            f'range +-{IMAGE_SHIFT_RANGE}, not counted')
+
+    async def set_image_shift_Y(self, value):
+        """This command moves image in vertical direction by image shift function."""
+        # Make sure the magnification mode is High-Mag, in Low-Mag the command won't work
+        isLowMag = (await self.get_magnification())[0] == 1
+        if isLowMag:
+            await self.set_magnification_mode(0)
+
+        # Make sure the scan status is Run, if frozen the command won't work
+        isFrozen = await self.get_scan_status() == 'FREEZE'
+        if isFrozen:
+            await self.set_scan_status(0)
+
+        command = f'Set PANEL IMAGESHIFTY {int(value)}'
+        externalCommunication = self.get_external_communication()
+        if externalCommunication is not None:
+            result = await self.process_set_command(command)
+            logging.info(result)
+            self._add_image_shift(1, int(value))
+
+        # If the magnification mode was Low-Mag, put it back
+        if isLowMag:
+            await self.set_magnification_mode(1)
+
+        # If the scan status was frozen, put it back
+        if isFrozen:
+            await self.set_scan_status(1)
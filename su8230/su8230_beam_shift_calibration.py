@@ -0,0 +1,159 @@
+import os
+import json
+import logging
+import cv2
+import numpy as np
+
+"""
+Image shift (beam shift) calibration of the SU8230 : field of view displacement in nm against the total image shift
+value, per magnification and axis. Frames are captured at known shift values across the range and the displacement
+between consecutive frames is measured by phase correlation, so the table includes the nonlinearity near the range
+limits. Planners convert a step in nm to shift units by inverse interpolation from the present total shift, a
+magnification without table uses the nearest calibrated one scaled by the magnification ratio, and the nominal
+3.4 pixels per unit without any table. Tables are stored as json.
+"""
+DEFAULT_BEAM_SHIFT_CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                   'su8230_beam_shift_calibration.json')
+# One unit moves the image by this many pixels at the 640 pixels width (nominal, before calibration)
+NOMINAL_UNIT_PX = 3.4
+# Image shift of a command is limited to +-127. The total image shift can neither be read nor is its range given by
+# the external communication specification, IMAGE_SHIFT_RANGE (20 full commands) is an assumed bound : shifts beyond
+# it are logged and not counted, measure the range on the instrument before relying on it
+MAX_SHIFT_COMMAND = 127
+IMAGE_SHIFT_RANGE = 20 * 127
+# Phase correlation peak under which two frames are not considered overlapping
+MIN_RESPONSE = 0.05
+
+
+def split_image_shift(units):
+    """Relative image shift commands of at most 127 for a shift of units"""
+    sign = 1 if units >= 0 else -1
+    commands = [sign * MAX_SHIFT_COMMAND] * (abs(units) // MAX_SHIFT_COMMAND)
+    if abs(units) % MAX_SHIFT_COMMAND != 0:
+        commands.append(sign * (abs(units) % MAX_SHIFT_COMMAND))
+    return commands
+
+
+def measure_displacement(reference, image):
+    """Displacement (x, y) in pixels of image from reference and the phase correlation peak"""
+    # Copies, phaseCorrelate applies the window to its inputs in place
+    reference = np.array(reference, dtype=np.float32)
+    image = np.array(image, dtype=np.float32)
+    window = cv2.createHanningWindow(reference.shape[::-1], cv2.CV_32F)
+    (dx, dy), response = cv2.phaseCorrelate(reference, image, window)
+    return (dx, dy), response
+
+
+class BeamShiftCalibration:
+    def __init__(self, filePath=DEFAULT_BEAM_SHIFT_CALIBRATION_FILE):
+        self.filePath = filePath
+        # Magnification : [x table, y table], a table is [units, shift_nm] sorted by units
+        self.tables = {}
+        self.load()
+
+    def load(self):
+        if self.filePath is not None and os.path.exists(self.filePath):
+            with open(self.filePath, 'r') as file:
+                self.tables = {int(magnification): tables for magnification, tables in json.load(file).items()}
+
+    def save(self):
+        if self.filePath is None:
+            return
+
+        with open(self.filePath, 'w') as file:
+            json.dump({str(magnification): tables for magnification, tables in self.tables.items()}, file, indent=2,
+                      sort_keys=True)
+
+    def set_table(self, magnification, axis, units, shift_nm):
+        order = np.argsort(units)
+        tables = self.tables.setdefault(int(magnification), [None, None])
+        tables[axis] = [np.asarray(units)[order].tolist(), np.asarray(shift_nm, dtype=float)[order].tolist()]
+
+    def get_table(self, magnification, axis):
+        """Units and shift in nm of the axis, from the nearest calibrated magnification, None if not calibrated"""
+        calibrated = [calibratedMagnification for calibratedMagnification, tables in self.tables.items()
+                      if tables[axis] is not None]
+        if len(calibrated) == 0:
+            return None
+
+        nearest = min(calibrated, key=lambda calibratedMagnification: abs(np.log(calibratedMagnification /
+                                                                                 magnification)))
+        units, shift_nm = self.tables[nearest][axis]
+        # Shift in nm is inversely proportional to the magnification
+        return np.asarray(units, dtype=float), np.asarray(shift_nm) * nearest / magnification
+
+    def get_shift_units(self, magnification, axis, currentUnits, step_nm, nominalUnit_nm):
+        """Relative image shift moving the field of view by step_nm, positive along positive shift values, from the
+        total shift currentUnits"""
+        table = self.get_table(magnification, axis)
+        if table is None:
+            return int(round(step_nm / nominalUnit_nm))
+
+        units, shift_nm = table
+        # Shift is monotonic over the calibrated range, extrapolated with the slope of the end segments
+        target_nm = self.get_shift_nm(units, shift_nm, currentUnits) + step_nm
+        if target_nm < shift_nm[0]:
+            targetUnits = units[0] + (target_nm - shift_nm[0]) * (units[1] - units[0]) / (shift_nm[1] - shift_nm[0])
+        elif target_nm > shift_nm[-1]:
+            targetUnits = units[-1] + (target_nm - shift_nm[-1]) * (units[-1] - units[-2]) / \
+                          (shift_nm[-1] - shift_nm[-2])
+        else:
+            targetUnits = np.interp(target_nm, shift_nm, units)
+        return int(round(targetUnits - currentUnits))
+
+    @staticmethod
+    def get_shift_nm(units, shift_nm, value):
+        if value < units[0]:
+            return shift_nm[0] + (value - units[0]) * (shift_nm[1] - shift_nm[0]) / (units[1] - units[0])
+        if value > units[-1]:
+            return shift_nm[-1] + (value - units[-1]) * (shift_nm[-1] - shift_nm[-2]) / (units[-1] - units[-2])
+        return float(np.interp(value, units, shift_nm))
+
+    def calibrate_axis(self, magnification, axis, pixelSize_nm, capture, shift, stepUnits,
+                       rangeUnits=IMAGE_SHIFT_RANGE):
+        """Sweeps the axis from 0 to +rangeUnits and to -rangeUnits by steps of stepUnits, the total shift must be 0
+            pixelSize_nm : pixel size of the frames
+            capture : function returning the frame (2d array) at the present shift
+            shift : function sending a relative image shift on the axis
+            return : units and shift in nm of the table, shift is positive along positive units
+        """
+        units, shift_nm = [0], [0.0]
+        reference = capture()
+        for direction in (1, -1):
+            position, position_nm = 0, 0.0
+            previous = reference
+            while position * direction < rangeUnits:
+                step = direction * min(stepUnits, rangeUnits - position * direction)
+                shift(step)
+                image = capture()
+                (dx, dy), response = measure_displacement(previous, image)
+                displacement_px = dx if axis == 0 else dy
+                if response < MIN_RESPONSE:
+                    logging.info(f'Beam shift calibration : frames do not overlap after a shift of {step}')
+                    shift(-step)
+                    break
+
+                # Image does not move beyond the range limit, the step was sent all the same
+                if abs(displacement_px) < 0.25 * abs(step) * NOMINAL_UNIT_PX * image.shape[1] / 640:
+                    shift(-step)
+                    break
+
+                position += step
+                position_nm += displacement_px * pixelSize_nm
+                units.append(position)
+                shift_nm.append(position_nm)
+                previous = image
+            for value in split_image_shift(-position):
+                shift(value)
+
+        if len(units) < 2:
+            logging.info(f'Beam shift calibration at {magnification} axis {axis} failed, no shift measured')
+            return units, shift_nm
+
+        # Sign of the image motion depends on the axis, the table is increasing along positive units
+        if shift_nm[int(np.argmax(units))] < 0:
+            shift_nm = [-value for value in shift_nm]
+        self.set_table(magnification, axis, units, shift_nm)
+        logging.info(f'Beam shift calibration at {magnification} axis {axis} : {len(units)} points from '
+                     f'{min(units)} to {max(units)} units, {round(min(shift_nm))} to {round(max(shift_nm))} nm')
+        return units, shift_nm
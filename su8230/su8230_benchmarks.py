@@ -0,0 +1,792 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import threading
+import asyncio
+import tempfile
+import cv2
+import numpy as np
+from PIL import Image
+from skimage.measure import ransac
+from skimage.transform import EuclideanTransform
+from internalProject.microscopeControl.abstract_external_communication import AbstractExternalCommunication
+from internalProject.microscopeControl.su8230.su8230_external_communication import Su8230ExternalCommunication
+from internalProject.microscopeControl.command_executor import CommandAbortedError
+from internalProject.microscopeControl.su8230.su8230_simulator import Su8230Simulator
+from internalProject.microscopeControl.su8230.su8230_impl import Su8230Impl
+from internalProject.microscopeControl.su8230.su8230_acquisition_estimator import get_grid_steps_nm
+from internalProject.microscopeControl.su8230.su8230_capture_settings import estimate_capture_duration
+from internalProject.microscopeControl.su8230.su8230_path_planner import StagePathPlanner, get_snake_index
+from internalProject.microscopeControl.su8230.su8230_occupancy_planner import get_otsu_threshold
+from internalProject.microscopeControl.su8230.su8230_stage_calibration import StageCalibration
+from internalProject.microscopeControl.su8230.su8230_beam_shift_calibration import BeamShiftCalibration, \
+    measure_displacement
+from internalProject.microscopeControl.su8230.su8230_field_of_view import FieldOfViewCalibration, \
+    get_nominal_image_size_nm, get_pixel_size_nm, set_field_of_view_calibration
+from internalProject.microscopeControl.stitching import getTransformationFromArrays, SIFT_PAIR_PARAMETERS
+from internalProject.microscopeControl.tile_localizer import PyramidNccLocalizer, locate_tiles_parallel
+from internalProject.microscopeControl.overview_context import OverviewContext
+from internalProject.microscopeControl.overview_index import OverviewDescriptorIndex
+from internalProject.microscopeControl.overlap_validator import load_tile
+from internalProject.microscopeControl import robust_estimation
+
+"""
+End-to-end acquisition benchmarks against the simulated SU8230. Each scenario records wall time, commands sent,
+round trips (commands and idle polls), bytes transferred (socket and images) and tile throughput. Results are
+compared to the json baselines and a scenario fails when a metric regresses by more than the threshold. Wall times
+depend on the machine running the benchmarks, they are compared with their own, looser threshold.
+"""
+# Delay between commands on the microscope, the simulated microscope runs without it
+PRODUCTION_COMMAND_DELAY_S = AbstractExternalCommunication.COMMAND_DELAY_S
+DEFAULT_BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'su8230_benchmark_baselines.json')
+LOWER_IS_BETTER = ('wall_time_s', 'commands', 'round_trips', 'bytes_transferred', 'registration_error_px',
+                   'stop_latency_s', 'stop_return_s', 'move_release_s', 'safety_wait_s', 'moved_after_stop_nm',
+                   'tile_offset_error_nm', 'localization_error_nm', 'localization_time_s', 'estimation_time_s',
+                   'estimation_error_px',
+                   'calibrated_placement_error_nm', 'calibrated_overlap_fraction', 'backlash_error_nm',
+                   'fov_query_time_s',
+                   'fov_interpolation_error', 'averaged_time_to_target_s', 'denoise_time_s', 'adaptive_beam_time_s',
+                   'adaptive_missed_feature_tiles', 'region_beam_time_s', 'region_geometry_error_px')
+HIGHER_IS_BETTER = ('tiles_per_s', 'denoised_dice')
+# Measured with the clock of the machine, the beam times estimated from the capture settings are not
+WALL_TIME_METRICS = ('wall_time_s', 'tiles_per_s', 'stop_latency_s', 'stop_return_s', 'move_release_s',
+                     'safety_wait_s', 'localization_time_s', 'estimation_time_s', 'fov_query_time_s', 'denoise_time_s')
+
+
+class Su8230Benchmarks:
+    def __init__(self, baselinesFile=DEFAULT_BASELINES_FILE, threshold=0.1, wallTimeThreshold=0.5, timeScale=0.005,
+                 useAsyncioSimulator=False):
+        self.baselinesFile = baselinesFile
+        self.threshold = threshold
+        self.wallTimeThreshold = wallTimeThreshold
+        self.timeScale = timeScale
+        self.useAsyncioSimulator = useAsyncioSimulator
+        self.results = {}
+        self.scenarios = {'grid_3x3': lambda impl: self.benchmark_grid(impl, 3, 3),
+                          'grid_5x5': lambda impl: self.benchmark_grid(impl, 5, 5),
+                          'grid_multi_signal_3x3': self.benchmark_grid_multi_signal,
+                          'grid_10x10': lambda impl: self.benchmark_grid(impl, 10, 10),
+                          'grid_beam_shift_3x3': self.benchmark_grid_beam_shift,
+                          'tracking': self.benchmark_tracking,
+                          'stitching_3x3': self.benchmark_stitching,
+                          'async_stage_and_emission': self.benchmark_async_stage_and_emission,
+                          'stop_preemption': self.benchmark_stop_preemption,
+                          'grid_path_backlash': self.benchmark_grid_path_backlash,
+                          'sparse_grid_5x5': self.benchmark_sparse_grid,
+                          'tile_localization': self.benchmark_tile_localization,
+                          'overview_index': self.benchmark_overview_index,
+                          'robust_estimation': self.benchmark_robust_estimation,
+                          'stage_calibration': self.benchmark_stage_calibration,
+                          'beam_shift_calibration': self.benchmark_beam_shift_calibration,
+                          'field_of_view': self.benchmark_field_of_view,
+                          'frame_averaging': self.benchmark_frame_averaging,
+                          'denoising': self.benchmark_denoising,
+                          'adaptive_dwell_5x5': self.benchmark_adaptive_dwell,
+                          'region_capture_5x5': self.benchmark_region_capture}
+        # Simulator parameters of the scenarios that need them
+        self.scenarioParameters = {'stop_preemption': {'stageSpeed_nm_s': 10000},
+                                   'grid_path_backlash': {'backlash_nm': 400},
+                                   # Few isolated particles, most tiles are empty
+                                   'sparse_grid_5x5': {'particleCount': 60, 'curveCount': 0},
+                                   # Stage axes 2 % long in x, 1 % short in y and rotated by 1 degree, with backlash
+                                   'stage_calibration': {'stageMatrix': ((1.02, -0.0175), (0.0175, 0.99)),
+                                                         'backlash_nm': 60},
+                                   # Image shift unit 12 % shorter than the nominal 3.4 pixels, less effective near
+                                   # the range limits
+                                   'beam_shift_calibration': {'beamShiftUnitPixels': 3.0,
+                                                              'beamShiftNonlinearity': 0.2},
+                                   # Drift of a few pixels during the long captures at 100000
+                                   'frame_averaging': {'drift_nm_s': (0.2, -0.1)},
+                                   'adaptive_dwell_5x5': {'particleCount': 60, 'curveCount': 0},
+                                   'region_capture_5x5': {'particleCount': 60, 'curveCount': 0}}
+        self.simulator = None
+
+    def create_simulated_microscope(self, workDir, **simulatorParameters):
+        # No delay needed between commands with the simulator
+        AbstractExternalCommunication.COMMAND_DELAY_S = 0
+        Su8230ExternalCommunication.IDLE_POLL_INTERVAL_S = 0.5 * self.timeScale
+        semDirTemp = os.path.join(workDir, 'temp')
+        simulator = Su8230Simulator(semDirTemp, timeScale=self.timeScale, **simulatorParameters)
+        impl = Su8230Impl()
+        impl.get_microscope_commands().get_external_communication().set_sem_dir_temp(semDirTemp)
+        # The simulator starts without image shift
+        impl.get_microscope_commands().set_image_shift_zero()
+        impl._filePath = os.path.join(workDir, 'images') + os.sep
+        os.makedirs(impl._filePath)
+        # Calibration learned during a scenario stays in its work directory
+        impl._stageCalibration = StageCalibration(os.path.join(workDir, 'stage_calibration.json'))
+        impl._beamShiftCalibration = BeamShiftCalibration(os.path.join(workDir, 'beam_shift_calibration.json'))
+        # The simulator images have the nominal field of view
+        set_field_of_view_calibration(FieldOfViewCalibration(os.path.join(workDir, 'field_of_view.json')))
+        return simulator, impl
+
+    def run_scenario(self, name, **simulatorParameters):
+        # Delays changed for the simulator are restored after the scenario
+        commandDelay = AbstractExternalCommunication.COMMAND_DELAY_S
+        idlePollInterval = Su8230ExternalCommunication.IDLE_POLL_INTERVAL_S
+        workDir = tempfile.mkdtemp()
+        simulator, impl = self.create_simulated_microscope(workDir, **simulatorParameters)
+        self.simulator = simulator
+        simulator.start(self.useAsyncioSimulator)
+        try:
+            startTime = time.perf_counter()
+            tiles = self.scenarios[name](impl)
+            wallTime = time.perf_counter() - startTime
+        finally:
+            impl.get_microscope_commands().get_external_communication().shutdown()
+            simulator.stop()
+            shutil.rmtree(workDir, ignore_errors=True)
+            AbstractExternalCommunication.COMMAND_DELAY_S = commandDelay
+            Su8230ExternalCommunication.IDLE_POLL_INTERVAL_S = idlePollInterval
+
+        if isinstance(tiles, dict):
+            metrics = tiles
+        else:
+            statistics = simulator.statistics
+            metrics = {'wall_time_s': wallTime,
+                       'commands': statistics['commands'] - statistics['idle_polls'],
+                       'round_trips': statistics['commands'],
+                       'bytes_transferred': statistics['bytes_received'] + statistics['bytes_sent'] +
+                                            statistics['bytes_written'],
+                       'tiles': tiles,
+                       'tiles_per_s': tiles / wallTime}
+        logging.info(f'Benchmark {name} : {metrics}')
+        return metrics
+
+    def benchmark_grid(self, impl, x, y):
+        impl.capture_XbyY_grid(x=x, y=y, stitchFollowingAcquisitions=False)
+        return x * y
+
+    def benchmark_grid_multi_signal(self, impl):
+        """3x3 grid of SE and BSE tiles captured in the same scans, tiles of both signals are counted"""
+        impl.setMultiSignalCapture(['SE', 'LA-BSE'])
+        impl.capture_XbyY_grid(x=3, y=3, stitchFollowingAcquisitions=False)
+        return sum(len([f for f in os.listdir(folder) if f.startswith('grid_mag') and f.endswith('.tiff')])
+                   for folder in impl.getSignalFolders().values())
+
+    def benchmark_grid_beam_shift(self, impl):
+        impl.setMagnification(300000)
+        impl.setCaptureSettingsForMicroscope()
+        impl.get_microscope_commands().set_magnification(impl.getMagnification())
+        x_step_nm, y_step_nm = get_grid_steps_nm(impl.getMagnification())
+        impl.gridAcquisitionBeamShift(x_step_nm, y_step_nm, 3, 3)
+        return 9
+
+    def benchmark_tracking(self, impl):
+        # Curves of the simulated texture are the synthetic skeleton
+        impl.tracking(project_name=impl._filePath)
+        return len([f for f in os.listdir(impl._filePath) if f.startswith('image_')])
+
+    def benchmark_stitching(self, impl):
+        """Pairwise registration of the neighbours of a 3x3 grid, error is measured against the simulator ground
+        truth"""
+        commands = impl.get_microscope_commands()
+        impl.setCaptureSettingsForMicroscope()
+        x_step_nm, y_step_nm = get_grid_steps_nm(impl.getMagnification())
+        cur_x, cur_y, _, _, _ = commands.get_stage_position()
+        tiles = {}
+        for xIndex in range(3):
+            for yIndex in range(3):
+                commands.set_stage_XY(cur_x + xIndex * x_step_nm, cur_y + yIndex * y_step_nm)
+                name = f'tile_{xIndex}_{yIndex}'
+                commands.set_capture_and_save(arg='Single', project_name=impl._filePath, newFileName=name)
+                tiles[(xIndex, yIndex)] = np.asarray(Image.open(f'{impl._filePath}{name}_1.tiff').convert('L'))
+
+        pairs = [((xIndex, yIndex), (xIndex + dx, yIndex + dy)) for xIndex in range(3) for yIndex in range(3)
+                 for dx, dy in ((1, 0), (0, 1)) if xIndex + dx < 3 and yIndex + dy < 3]
+        pixelSize_nm = 127 * 10 ** 6 / impl.getMagnification() / tiles[(0, 0)].shape[1]
+        errors = []
+        startTime = time.perf_counter()
+        for reference, toRegister in pairs:
+            translation, _ = getTransformationFromArrays(tiles[reference], tiles[toRegister])
+            expectedX = (toRegister[0] - reference[0]) * x_step_nm / pixelSize_nm
+            expectedY = (toRegister[1] - reference[1]) * y_step_nm / pixelSize_nm
+            if translation is None:
+                errors.append(float(max(tiles[reference].shape)))
+            else:
+                errors.append(float(np.hypot(translation.getX() - expectedX, translation.getY() - expectedY)))
+        wallTime = time.perf_counter() - startTime
+        return {'wall_time_s': wallTime, 'pairs': len(pairs), 'tiles': 9, 'tiles_per_s': 9 / wallTime,
+                'registration_error_px': float(np.mean(errors))}
+
+    def benchmark_async_stage_and_emission(self, impl):
+        """Emission current read on the same connection while a long stage move is awaited"""
+        commands = impl.get_microscope_commands()
+        asyncCommands = commands.get_async_commands()
+
+        async def move_and_read_emission():
+            cur_x, cur_y, _, _, _ = await asyncCommands.get_stage_position()
+            move = asyncio.ensure_future(asyncCommands.set_stage_XY(cur_x + 1000000, cur_y))
+            emissionReads = 0
+            while not move.done():
+                await asyncCommands.get_emission_current()
+                emissionReads += 1
+            await move
+            return emissionReads
+
+        startTime = time.perf_counter()
+        emissionReads = commands.run(move_and_read_emission())
+        wallTime = time.perf_counter() - startTime
+        return {'wall_time_s': wallTime, 'emission_reads': emissionReads}
+
+    def benchmark_stop_preemption(self, impl):
+        """Stage stop sent during a long stage move (slow simulated stage) with telemetry and another move queued
+        behind it, with the delay between commands of the microscope
+            stop_latency_s : until the simulator stops the stage, stop_return_s : until set_stage_move_stop returns
+            moved_after_stop_nm : stage travel after the stop, the queued move must not run
+        """
+        AbstractExternalCommunication.COMMAND_DELAY_S = PRODUCTION_COMMAND_DELAY_S
+        commands = impl.get_microscope_commands()
+        commandExecutor = commands.get_external_communication().get_command_executor()
+        cur_x, cur_y, _, _, _ = commands.get_stage_position()
+        move = threading.Thread(target=commands.set_stage_XY, args=(cur_x + 5000000, cur_y))
+        move.start()
+        # Wait for the stage to move, the move then polls for IDLE
+        waitEnd = time.perf_counter() + 10 * PRODUCTION_COMMAND_DELAY_S
+        while self.simulator.now() >= self.simulator.moveEnd and time.perf_counter() < waitEnd:
+            time.sleep(self.timeScale)
+        telemetry = [threading.Thread(target=commands.get_emission_current) for _ in range(5)]
+        for thread in telemetry:
+            thread.start()
+        queuedMove = commandExecutor.submit(f'Set STAGEUNIT MOVEXY {cur_x},{cur_y},0')
+        time.sleep(50 * self.timeScale)
+
+        simulator = self.simulator
+        moveEnd = simulator.moveEnd
+        stop = threading.Thread(target=commands.set_stage_move_stop)
+        stopTime = time.perf_counter()
+        stop.start()
+        # The simulator stops the stage where it is when it receives the stop
+        while simulator.moveEnd == moveEnd and stop.is_alive():
+            time.sleep(0.0001)
+        stopPosition = list(simulator.stageTarget[:2])
+        stopLatency = simulator.moveEnd - stopTime
+        stop.join()
+        stopReturn = time.perf_counter() - stopTime
+        move.join()
+        moveRelease = time.perf_counter() - stopTime
+        for thread in telemetry:
+            thread.join()
+        try:
+            queuedMove.result()
+            queuedSetsFlushed = 0
+        except CommandAbortedError:
+            queuedSetsFlushed = 1
+        endPosition = self.simulator.get_commanded_stage_position()[:2]
+
+        statistics = commandExecutor.get_statistics()
+        return {'wall_time_s': time.perf_counter() - stopTime, 'stop_latency_s': stopLatency,
+                'stop_return_s': stopReturn, 'move_release_s': moveRelease,
+                'queued_sets_flushed': queuedSetsFlushed,
+                'moved_after_stop_nm': float(np.hypot(endPosition[0] - stopPosition[0],
+                                                      endPosition[1] - stopPosition[1])),
+                'max_queue_depth': statistics['max_queue_depth'],
+                'safety_wait_s': statistics['safety']['max_wait_s'],
+                'telemetry_wait_s': statistics['telemetry']['max_wait_s']}
+
+    def run_path(self, impl, moves):
+        """Moves and captures the tiles of a path
+            return : wall time, mean deviation (nm) of the tile offsets (true - commanded position) from their mean
+        """
+        commands = impl.get_microscope_commands()
+        startTime = time.perf_counter()
+        offsets = []
+        for move in moves:
+            commands.set_stage_XY(*move['target'])
+            if move['tile'] is not None:
+                commands.set_capture_and_save(arg='Single', project_name=impl._filePath, newFileName='tile')
+                centerX, centerY = self.simulator.captureLog[-1]['center_nm']
+                offsets.append((centerX - move['target'][0], centerY - move['target'][1]))
+        wallTime = time.perf_counter() - startTime
+        offsets = np.array(offsets)
+        return wallTime, float(np.mean(np.linalg.norm(offsets - offsets.mean(axis=0), axis=1)))
+
+    def benchmark_grid_path_backlash(self, impl):
+        """4x4 stage grid on a stage with backlash, path chosen by the planner against the snake"""
+        commands = impl.get_microscope_commands()
+        impl.setCaptureSettingsForMicroscope()
+        x_step_nm, y_step_nm = get_grid_steps_nm(impl.getMagnification())
+        cur_x, cur_y, _, _, _ = commands.get_stage_position()
+        planner = StagePathPlanner.from_estimator(impl.estimator, impl._captureSettings,
+                                                  backlash_nm=self.scenarioParameters['grid_path_backlash']['backlash_nm'])
+        snakeWallTime, snakeError = self.run_path(impl, planner.build_path('snake', cur_x, cur_y, x_step_nm, y_step_nm,
+                                                                           4, 4, useApproach=False))
+        moves, name, _ = planner.plan(cur_x, cur_y, x_step_nm, y_step_nm, 4, 4)
+        wallTime, error = self.run_path(impl, moves)
+        logging.info(f'Planned path {name}')
+        return {'wall_time_s': wallTime, 'tile_offset_error_nm': error, 'snake_wall_time_s': snakeWallTime,
+                'snake_tile_offset_error_nm': snakeError}
+
+    def benchmark_sparse_grid(self, impl):
+        """5x5 grid within the low mag image, skipping its empty tiles"""
+        impl.setMagnification(200000)
+        impl.capture_XbyY_grid(x=5, y=5, stitchFollowingAcquisitions=False, sparse=True)
+        return len([f for f in os.listdir(impl._filePath) if f.startswith('grid_mag')])
+
+    def benchmark_tile_localization(self, impl, tileCount=20, predictionError_nm=300):
+        """High mag tiles rendered at known positions, located in the low mag overview from a predicted position off by
+        up to predictionError_nm, then again by worker processes sharing the overview context
+        """
+        rng = np.random.default_rng(0)
+        lowMag, magnification = 20000, 100000
+        overviewPixelSize_nm = get_pixel_size_nm(lowMag, 1280)
+        tilePixelSize_nm = impl.getPixelSize_nm(magnification)
+        overview = self.simulator.render(0, 0, overviewPixelSize_nm, 1280, 960)
+        localizer = PyramidNccLocalizer(overview, overviewPixelSize_nm)
+        truePositions = rng.uniform((-2000, -1500), (2000, 1500), (tileCount, 2))
+        predictions = truePositions + rng.uniform(-predictionError_nm, predictionError_nm, (tileCount, 2))
+        tiles = [self.simulator.render(trueX, trueY, tilePixelSize_nm, impl._xPixelSize, impl._yPixelSize) +
+                 rng.normal(0, 0.05, (impl._yPixelSize, impl._xPixelSize)).astype(np.float32)
+                 for trueX, trueY in truePositions]
+        startTime = time.perf_counter()
+        results = [localizer.locate_nm(tile, tilePixelSize_nm, prediction, 2 * predictionError_nm)
+                   for tile, prediction in zip(tiles, predictions)]
+        wallTime = time.perf_counter() - startTime
+
+        context = OverviewContext.build(overview, overviewPixelSize_nm, shared=True)
+        try:
+            startTime = time.perf_counter()
+            parallelResults = locate_tiles_parallel(context, tiles, tilePixelSize_nm, predictions,
+                                                    2 * predictionError_nm)
+            parallelWallTime = time.perf_counter() - startTime
+        finally:
+            context.close()
+
+        errors = [np.hypot(*(prediction + offset - truePosition))
+                  for (offset, _), prediction, truePosition in zip(results, predictions, truePositions)]
+        parallelErrors = [np.hypot(*(prediction + offset - truePosition))
+                          for (offset, _), prediction, truePosition in zip(parallelResults, predictions, truePositions)]
+        return {'localization_error_nm': float(np.mean(errors)), 'max_localization_error_nm': float(np.max(errors)),
+                'localization_time_s': wallTime / tileCount,
+                'min_confidence': float(min(confidence for _, confidence in results)),
+                'parallel_localization_error_nm': float(np.mean(parallelErrors)),
+                'parallel_localization_time_s': parallelWallTime / tileCount}
+
+    def benchmark_overview_index(self, impl, tileCount=20, predictionError_nm=3000):
+        """Tiles located with the overview descriptor index, stage prediction off by up to predictionError_nm"""
+        rng = np.random.default_rng(1)
+        overviewPixelSize_nm = get_pixel_size_nm(20000, 1280)
+        tilePixelSize_nm = impl.getPixelSize_nm()
+        overview = self.simulator.render(0, 0, overviewPixelSize_nm, 1280, 960)
+        startTime = time.perf_counter()
+        index = OverviewDescriptorIndex(overview, overviewPixelSize_nm)
+        buildTime = time.perf_counter() - startTime
+        truePositions = rng.uniform((-2500, -1800), (2500, 1800), (tileCount, 2))
+        predictions = truePositions + rng.uniform(-predictionError_nm, predictionError_nm, (tileCount, 2))
+        errors = []
+        methods = []
+        queryTime = 0.0
+        for (trueX, trueY), prediction in zip(truePositions, predictions):
+            tile = self.simulator.render(trueX, trueY, tilePixelSize_nm, impl._xPixelSize, impl._yPixelSize)
+            tile = tile + rng.normal(0, 0.05, tile.shape).astype(np.float32)
+            startTime = time.perf_counter()
+            position, _, method = index.locate_nm(tile, tilePixelSize_nm, prediction)
+            queryTime += time.perf_counter() - startTime
+            methods.append(method)
+            if position is not None:
+                errors.append(np.hypot(position[0] - trueX, position[1] - trueY))
+        return {'localization_error_nm': float(np.median(errors)) if errors else float('inf'),
+                'localization_time_s': queryTime / tileCount, 'index_build_s': buildTime,
+                'index_found': methods.count('index'), 'ncc_fallbacks': methods.count('ncc'),
+                'not_found': methods.count(None)}
+
+    def benchmark_robust_estimation(self, impl, pointCount=200, inlierRatios=(0.9, 0.7, 0.5, 0.3), repeats=10):
+        """Rigid transformation of synthetic matches with outliers, fixed 1000 trials RANSAC against the adaptive and
+        preemptive estimators, per inlier ratio, at the registration threshold
+        """
+        rng = np.random.default_rng(2)
+        threshold = SIFT_PAIR_PARAMETERS['epsilon']
+        metrics = {}
+        adaptiveTimes, adaptiveErrors = [], []
+        for inlierRatio in inlierRatios:
+            times = {'fixed': 0.0, 'adaptive': 0.0, 'preemptive': 0.0}
+            errors = {'fixed': [], 'adaptive': [], 'preemptive': []}
+            trials = []
+            for _ in range(repeats):
+                rotation, translation = rng.uniform(-0.05, 0.05), rng.uniform(-300, 300, 2)
+                src = rng.uniform(-640, 640, (pointCount, 2))
+                rotationMatrix = np.array([[np.cos(rotation), -np.sin(rotation)], [np.sin(rotation), np.cos(rotation)]])
+                dst = src @ rotationMatrix.T + translation + rng.normal(0, 0.3, (pointCount, 2))
+                outliers = rng.random(pointCount) > inlierRatio
+                dst[outliers] = rng.uniform(-640, 640, (int(outliers.sum()), 2))
+                center = np.array([0.0, 0.0])
+
+                startTime = time.perf_counter()
+                model, _ = ransac((src, dst), EuclideanTransform, min_samples=2, residual_threshold=threshold,
+                                  max_trials=1000, rng=rng)
+                times['fixed'] += time.perf_counter() - startTime
+                if model is not None:
+                    errors['fixed'].append(np.hypot(*(model(center[None])[0] - translation)))
+                for mode in ('adaptive', 'preemptive'):
+                    startTime = time.perf_counter()
+                    estimate = robust_estimation.estimate(src, dst, 'rigid', residualThreshold=threshold,
+                                                          maxTrials=1000, preemptive=mode == 'preemptive', rng=rng)
+                    times[mode] += time.perf_counter() - startTime
+                    errors[mode].append(np.hypot(*(estimate.translation - translation)))
+                    if mode == 'adaptive':
+                        trials.append(estimate.trials)
+            suffix = f'_{int(round(100 * inlierRatio))}'
+            for mode in times:
+                metrics[f'{mode}_time_s{suffix}'] = times[mode] / repeats
+                metrics[f'{mode}_error_px{suffix}'] = float(np.median(errors[mode])) if errors[mode] else float('inf')
+            metrics[f'adaptive_trials{suffix}'] = float(np.mean(trials))
+            adaptiveTimes.append(times['adaptive'] / repeats)
+            adaptiveErrors.append(metrics[f'adaptive_error_px{suffix}'])
+        metrics['estimation_time_s'] = float(np.mean(adaptiveTimes))
+        metrics['estimation_error_px'] = float(np.max(adaptiveErrors))
+        return metrics
+
+    def benchmark_field_of_view(self, impl, queryCount=100000, repeats=5):
+        """Field of view of a synthetic measured table (scale error growing with the magnification and the working
+        distance), interpolated at magnifications between the measured ones : relative error and time per query of
+        the vectorized and the memoized scalar queries
+        """
+        def get_true_scales(magnification, wd_um):
+            decades = np.log10(magnification / 1000)
+            return 1 + 0.02 * decades - 0.004 * decades ** 2 + 0.004 * (wd_um - 7000) / 1000, \
+                1 + 0.015 * decades - 0.003 * decades ** 2 + 0.004 * (wd_um - 7000) / 1000
+
+        calibration = FieldOfViewCalibration(None)
+        for wd_um in (4000, 7000, 10000):
+            for magnification in np.geomspace(1000, 1000000, 13):
+                xScale, yScale = get_true_scales(magnification, wd_um)
+                nominal_x_nm, nominal_y_nm = get_nominal_image_size_nm(magnification)
+                calibration.record(magnification, 640, wd_um, nominal_x_nm * xScale, nominal_y_nm * yScale)
+
+        rng = np.random.default_rng(3)
+        magnifications = np.round(np.exp(rng.uniform(np.log(1000), np.log(1000000), queryCount)))
+        wd_um = 8500
+        startTime = time.perf_counter()
+        for _ in range(repeats):
+            calibration.clear_cache()
+            x_nm, y_nm = calibration.get_image_size_nm(magnifications, 640, wd_um)
+        vectorizedTime = (time.perf_counter() - startTime) / repeats / queryCount
+        # Planners query the same few magnifications again and again
+        scalarMagnifications = magnifications[:1000] // 1000 * 1000
+        startTime = time.perf_counter()
+        for magnification in scalarMagnifications:
+            calibration.get_pixel_size_nm(magnification, 640, wd_um)
+        scalarTime = (time.perf_counter() - startTime) / len(scalarMagnifications)
+
+        xScale, yScale = get_true_scales(magnifications, wd_um)
+        nominal_x_nm, nominal_y_nm = get_nominal_image_size_nm(magnifications)
+        errors = np.maximum(np.abs(x_nm / (nominal_x_nm * xScale) - 1), np.abs(y_nm / (nominal_y_nm * yScale) - 1))
+        nominalErrors = np.maximum(np.abs(1 / xScale - 1), np.abs(1 / yScale - 1))
+        return {'fov_query_time_s': vectorizedTime, 'fov_scalar_query_time_s': scalarTime,
+                'fov_interpolation_error': float(np.max(errors)), 'fov_nominal_error': float(np.max(nominalErrors))}
+
+    def get_placement_errors(self, captures, magnification, x_step_nm, y_step_nm, ignoreCommonOffset=False):
+        """Distance of the captured tile centers to the nearest position of the planned grid, the grid starts at the
+        low mag capture
+            ignoreCommonOffset : the grid is shifted by the median error first (backlash offsets all the tiles reached
+            from the same direction)
+        """
+        start = np.array(captures[0]['center_nm'])
+        errors = []
+        for capture in captures[1:]:
+            if capture['magnification'] != magnification or capture['screen'] != 1:
+                continue
+
+            offset = np.array(capture['center_nm']) - start
+            nearest = np.round(offset / (x_step_nm, y_step_nm)) * (x_step_nm, y_step_nm)
+            errors.append(offset - nearest)
+        errors = np.asarray(errors).reshape(-1, 2)
+        if ignoreCommonOffset and len(errors) > 0:
+            errors = errors - np.median(errors, axis=0)
+        return np.hypot(errors[:, 0], errors[:, 1]).tolist()
+
+    def benchmark_stage_calibration(self, impl, size=4, magnification=50000):
+        """Stage grid on a stage with axes errors and backlash, captured twice : the first grid calibrates the stage,
+        the second uses the corrected moves, the reduced overlap and the measured backlash to plan its path"""
+        impl.setMagnification(magnification)
+        results = {}
+        for run in ('uncalibrated', 'calibrated'):
+            firstCapture = len(self.simulator.captureLog)
+            impl.capture_XbyY_grid(x=size, y=size, stitchFollowingAcquisitions=False, useBeamShift=False)
+            captures = self.simulator.captureLog[firstCapture:]
+            # Overlap chosen by the grid from the calibration
+            overlapFraction = impl._overlapValidator.overlapFraction
+            x_step_nm, y_step_nm = get_grid_steps_nm(magnification, overlapFraction)
+            errors = self.get_placement_errors(captures, magnification, x_step_nm, y_step_nm, ignoreCommonOffset=True)
+            results[f'{run}_placement_error_nm'] = float(np.max(errors))
+            results[f'{run}_overlap_fraction'] = overlapFraction
+            results[f'{run}_captures'] = len([capture for capture in captures if capture['screen'] == 1])
+            results[f'{run}_area_per_tile_nm2'] = x_step_nm * y_step_nm
+        model = impl._stageCalibration.get_model(magnification)
+        results['calibration_residual_nm'] = model['residual_nm'] if model is not None else float('inf')
+        # Measured by the pairs of the first grid reached from opposite directions
+        results['backlash_error_nm'] = abs(impl._stageCalibration.get_backlash_nm() -
+                                           self.scenarioParameters['stage_calibration']['backlash_nm'])
+        return results
+
+    def benchmark_beam_shift_calibration(self, impl, magnification=300000, calibrationMagnification=100000,
+                                         rangeUnits=4 * 127):
+        """3x3 beam shift grid with the nominal image shift, then with the table measured by calibrateBeamShift at
+        a lower magnification (the simulated texture is too smooth at the grid magnification)"""
+        impl.setMagnification(magnification)
+        impl.setCaptureSettingsForMicroscope()
+        impl.get_microscope_commands().set_magnification(magnification)
+        x_step_nm, y_step_nm = get_grid_steps_nm(magnification)
+        results = {}
+        for run in ('uncalibrated', 'calibrated'):
+            if run == 'calibrated':
+                firstCapture = len(self.simulator.captureLog)
+                startTime = time.perf_counter()
+                impl.calibrateBeamShift([calibrationMagnification], rangeUnits)
+                results['calibration_time_s'] = time.perf_counter() - startTime
+                results['calibration_frames'] = len(self.simulator.captureLog) - firstCapture
+            firstCapture = len(self.simulator.captureLog)
+            impl.gridAcquisitionBeamShift(x_step_nm, y_step_nm, 3, 3)
+            captures = self.simulator.captureLog[firstCapture:]
+            results[f'{run}_placement_error_nm'] = float(np.max(
+                self.get_placement_errors(captures, magnification, x_step_nm, y_step_nm)))
+            # Back to the first tile for the next run
+            for axis, units in enumerate(impl.get_microscope_commands().get_image_shift_units()):
+                impl.sendImageShift(axis, -units)
+        return results
+
+    def get_tile_snr_db(self, tile, capture, border=24):
+        """SNR of a tile against the noise free rendering at the center of its capture, without the border"""
+        width, height = capture['resolution']
+        reference = np.clip(self.simulator.render(*capture['center_nm'], capture['pixel_size_nm'], width, height,
+                                                  capture['signal']) * 255, 0, 255)
+        reference = reference[border:height - border, border:width - border]
+        error = tile[border:height - border, border:width - border] - reference
+        return float(10 * np.log10(reference.var() / np.mean(error ** 2)))
+
+    def benchmark_frame_averaging(self, impl, frameCounts=(2, 3, 4, 6, 8, 12, 16), frameSettings=('Fast', '8'),
+                                  hardwareSettings=(('Slow', '10', '8'), ('Slow', '20', '8'), ('Slow', '40', '8'),
+                                                    ('Slow', '80', '8'), ('Slow', '160', '8'), ('Fast', '10', '16'),
+                                                    ('Fast', '10', '32'), ('Fast', '10', '64'),
+                                                    ('Rapid', '10', '256'), ('Rapid', '10', '1024'))):
+        """Tiles of a drifting sample captured with the hardware settings (longer scans, more integrated frames),
+        then averaged from drift corrected fast frames. Target is the best SNR of the hardware settings, the time to
+        target is the beam time of the fastest setting or number of frames reaching it
+        """
+        resolution = impl._captureSettings['resolution']
+        results = {}
+        hardware = []
+        for scan_mode, scan_time, integration_number in hardwareSettings:
+            impl._captureSettings = {'scan_mode': scan_mode, 'resolution': resolution, 'scan_time': scan_time,
+                                     'integration_number': integration_number}
+            impl.setCaptureSettingsForMicroscope()
+            name = f'hardware_{scan_mode}_{scan_time}_{integration_number}'
+            savedir = impl.captureTile(name)
+            snr_db = self.get_tile_snr_db(load_tile(f'{savedir}{name}_1.tiff'), self.simulator.captureLog[-1])
+            duration = estimate_capture_duration(scan_mode, resolution, scan_time, integration_number)
+            hardware.append((duration, snr_db))
+            results[f'snr_db_{scan_mode}_{scan_time if scan_mode == "Slow" else integration_number}'] = snr_db
+
+        targetSnr_db = max(snr_db for _, snr_db in hardware)
+        results['target_snr_db'] = targetSnr_db
+        results['hardware_time_to_target_s'] = min(duration for duration, snr_db in hardware if snr_db >= targetSnr_db)
+        results['averaged_time_to_target_s'] = float('inf')
+        frameDuration = estimate_capture_duration(frameSettings[0], resolution, '10', frameSettings[1])
+        for frames in frameCounts:
+            impl.setFrameAveraging(frames, *frameSettings)
+            impl.setCaptureSettingsForMicroscope()
+            firstCapture = len(self.simulator.captureLog)
+            name = f'averaged_{frames}'
+            savedir = impl.captureTile(name)
+            # Average is aligned on its first frame
+            snr_db = self.get_tile_snr_db(load_tile(f'{savedir}{name}_1.tiff'),
+                                          self.simulator.captureLog[firstCapture])
+            results[f'snr_db_averaged_{frames}'] = snr_db
+            if snr_db >= targetSnr_db:
+                results['averaged_time_to_target_s'] = frames * frameDuration
+                results['averaged_frames_to_target'] = frames
+                break
+        impl.setFrameAveraging(0)
+        return results
+
+    @staticmethod
+    def measure_particles(image, pixelSize_nm, minArea=4):
+        """Otsu segmentation of the particles : mask, particle count and mean equivalent diameter in nm"""
+        mask = image > get_otsu_threshold(image)
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        areas = areas[areas >= minArea]
+        diameter_nm = float(np.mean(2 * np.sqrt(areas / np.pi))) * pixelSize_nm if len(areas) > 0 else 0.0
+        return mask, len(areas), diameter_nm
+
+    def benchmark_denoising(self, impl, referenceSettings=('Slow', '80', '8'),
+                            fastSettings=(('Rapid', '10', '32'), ('Fast', '10', '8'), ('Fast', '10', '16')),
+                            summarySettings=('Fast', '10', '8'), method='nlmeans'):
+        """Tiles at faster scan settings, raw and denoised, segmented (Otsu and particle measurement) and compared to
+        a slow scan reference of the same field : Dice of the masks, error of the particle count and mean diameter,
+        beam time saved against denoising time
+        """
+        resolution = impl._captureSettings['resolution']
+        pixelSize_nm = impl.getPixelSize_nm()
+
+        def capture(settings, name):
+            impl._captureSettings = {'scan_mode': settings[0], 'resolution': resolution, 'scan_time': settings[1],
+                                     'integration_number': settings[2]}
+            impl.setCaptureSettingsForMicroscope()
+            savedir = impl.captureTile(name)
+            return load_tile(f'{savedir}{name}_1.tiff')
+
+        referenceImage = capture(referenceSettings, 'reference')
+        referenceMask, referenceCount, referenceDiameter_nm = self.measure_particles(referenceImage, pixelSize_nm)
+        referenceDuration = estimate_capture_duration(referenceSettings[0], resolution, *referenceSettings[1:])
+        results = {'reference_particles': referenceCount}
+        denoiseTimes = []
+        for settings in fastSettings:
+            key = f'{settings[0]}_{settings[1] if settings[0] == "Slow" else settings[2]}'
+            for run in ('raw', 'denoised'):
+                impl.setDenoising(method if run == 'denoised' else None)
+                mask, count, diameter_nm = self.measure_particles(capture(settings, f'{run}_{key}'), pixelSize_nm)
+                dice = 2 * np.sum(mask & referenceMask) / (np.sum(mask) + np.sum(referenceMask))
+                results[f'{run}_dice_{key}'] = float(dice)
+                results[f'{run}_count_error_{key}'] = abs(count - referenceCount) / max(referenceCount, 1)
+                results[f'{run}_diameter_error_{key}'] = abs(diameter_nm - referenceDiameter_nm) / \
+                    max(referenceDiameter_nm, 1e-9)
+                if run == 'denoised':
+                    denoiseTimes.append(impl._denoiser.totalTime_s)
+            if settings == summarySettings:
+                results['raw_dice'] = results[f'raw_dice_{key}']
+                results['denoised_dice'] = results[f'denoised_dice_{key}']
+                results['beam_time_saved_s'] = referenceDuration - estimate_capture_duration(settings[0], resolution,
+                                                                                            *settings[1:])
+        results['denoise_time_s'] = float(np.mean(denoiseTimes))
+        impl.setDenoising(None)
+        return results
+
+    def benchmark_adaptive_dwell(self, impl, magnification=200000, size=5):
+        """Stage grid of few isolated particles captured with the capture settings on every tile, then with the capture
+        settings of each tile chosen from the low mag image : beam time of the tiles, capture settings switches and
+        tiles with particles (noise free render of the simulator) captured with the background (Rapid) setting
+        """
+        impl.setMagnification(magnification)
+        commands = impl.get_microscope_commands()
+        startX, startY = commands.get_stage_position()[:2]
+        results = {}
+        for run in ('uniform', 'adaptive'):
+            # Both grids use the same overlap, the stage is not calibrated by the first one
+            impl._stageCalibration = StageCalibration(None)
+            commands.set_stage_XY(startX, startY)
+            firstCapture = len(self.simulator.captureLog)
+            impl.capture_XbyY_grid(x=size, y=size, stitchFollowingAcquisitions=False, useBeamShift=False,
+                                   adaptiveDwell=run == 'adaptive')
+            captures = [capture for capture in self.simulator.captureLog[firstCapture:]
+                        if capture['magnification'] == magnification and capture['screen'] == 1]
+            settings = [capture['capture_settings'] for capture in captures]
+            # Background is under 0.25, particles over 0.5
+            hasFeatures = [self.simulator.render(*capture['center_nm'], capture['pixel_size_nm'],
+                                                 *capture['resolution'], 'BSE').max() > 0.4 for capture in captures]
+            results[f'{run}_beam_time_s'] = float(sum(estimate_capture_duration(*setting) for setting in settings))
+            results[f'{run}_settings_switches'] = sum(1 for previous, setting in zip(settings, settings[1:])
+                                                      if setting != previous)
+            results[f'{run}_tiles'] = len(captures)
+            results[f'{run}_feature_tiles'] = int(sum(hasFeatures))
+            results[f'{run}_fast_tiles'] = sum(1 for setting in settings if setting[0] in ('Rapid', 'Fast'))
+            results[f'{run}_missed_feature_tiles'] = sum(1 for setting, features in zip(settings, hasFeatures)
+                                                         if setting[0] == 'Rapid' and features)
+        results['beam_time_saved_s'] = results['uniform_beam_time_s'] - results['adaptive_beam_time_s']
+        return results
+
+    def benchmark_region_capture(self, impl, magnification=200000, size=5, calibrationMagnification=100000,
+                                 rangeUnits=2 * 127):
+        """Stage grid of few isolated particles captured as sub-frames around the particles of the low mag image, after
+        a beam shift calibration : beam time against full frames, area imaged, and geometry error of the assembled
+        tiles (phase correlation with the noise free render of the planned tile on the imaged pixels). Tiles are
+        1280x960, sub-frames 640x480.
+        """
+        impl.setMagnification(magnification)
+        impl._xPixelSize, impl._yPixelSize = 1280, 960
+        impl._captureSettings['resolution'] = '1280x960'
+        impl.calibrateBeamShift([calibrationMagnification], rangeUnits)
+        impl._stageCalibration = StageCalibration(None)
+        commands = impl.get_microscope_commands()
+        startX, startY = commands.get_stage_position()[:2]
+        firstCapture = len(self.simulator.captureLog)
+        impl.capture_XbyY_grid(x=size, y=size, stitchFollowingAcquisitions=False, useBeamShift=False,
+                               regionCapture=True)
+        captures = [capture for capture in self.simulator.captureLog[firstCapture:]
+                    if capture['magnification'] >= magnification and capture['screen'] == 1]
+        width, height = [int(value) for value in impl._captureSettings['resolution'].split('x')]
+        settings = impl._captureSettings
+        fullDuration = estimate_capture_duration(settings['scan_mode'], settings['resolution'], settings['scan_time'],
+                                                 settings['integration_number'])
+        results = {'full_beam_time_s': size * size * fullDuration,
+                   'region_beam_time_s': float(sum(estimate_capture_duration(*capture['capture_settings'])
+                                                   for capture in captures)),
+                   'region_imaged_fraction': sum(capture['resolution'][0] * capture['resolution'][1]
+                                                 for capture in captures) / (size * size * width * height),
+                   'subframes': sum(1 for capture in captures if capture['magnification'] > magnification)}
+        results['region_time_fraction'] = results['region_beam_time_s'] / results['full_beam_time_s']
+        results['beam_time_saved_s'] = results['full_beam_time_s'] - results['region_beam_time_s']
+        x_step_nm, y_step_nm = get_grid_steps_nm(magnification, impl._overlapValidator.overlapFraction)
+        pixelSize_nm = impl.getPixelSize_nm()
+        errors = []
+        for xIndex in range(size):
+            for yIndex in range(size):
+                tile = load_tile(f'{impl._filePath}grid_mag{magnification}_{get_snake_index(xIndex, yIndex, size) + 1}'
+                                 f'_1.tiff')
+                # Region tiles are 0 outside of their sub-frames, tiles without sub-frame are full frames or empty
+                imaged = tile > 0
+                if np.mean(imaged) > 0.9 or not imaged.any():
+                    continue
+
+                render = self.simulator.render(startX + xIndex * x_step_nm, startY + yIndex * y_step_nm,
+                                               pixelSize_nm, width, height, 'SE') * 255
+                (dx, dy), response = measure_displacement(render * imaged, tile)
+                errors.append(float(np.hypot(dx, dy)))
+        results['region_geometry_error_px'] = max(errors) if len(errors) > 0 else 0.0
+        return results
+
+    def load_baselines(self):
+        if not os.path.exists(self.baselinesFile):
+            return {}
+
+        with open(self.baselinesFile, 'r') as file:
+            return json.load(file)
+
+    def save_baselines(self, results):
+        baselines = self.load_baselines()
+        baselines.update(results)
+        with open(self.baselinesFile, 'w') as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+
+    def compare_to_baseline(self, name, metrics, baseline):
+        """Returns the list of regressions of a scenario"""
+        regressions = []
+        for metric, value in metrics.items():
+            if metric not in baseline or baseline[metric] == 0:
+                continue
+
+            change = (value - baseline[metric]) / abs(baseline[metric])
+            threshold = self.wallTimeThreshold if metric in WALL_TIME_METRICS else self.threshold
+            if (metric in LOWER_IS_BETTER and change > threshold) or \
+                    (metric in HIGHER_IS_BETTER and change < -threshold):
+                regressions.append(f'{name} {metric}: {baseline[metric]} -> {value} ({round(100 * change, 1)} %)')
+        return regressions
+
+    def run(self, scenarios=None, update_baselines=False):
+        """Runs the scenarios, returns True if no metric regressed"""
+        baselines = self.load_baselines()
+        regressions = []
+        for name in scenarios if scenarios is not None else self.scenarios:
+            self.results[name] = self.run_scenario(name, **self.scenarioParameters.get(name, {}))
+            if name in baselines:
+                regressions += self.compare_to_baseline(name, self.results[name], baselines[name])
+
+        for regression in regressions:
+            logging.error(f'Regression {regression}')
+
+        if update_baselines:
+            self.save_baselines(self.results)
+
+        return len(regressions) == 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s.%(msecs)03d[%(levelname)-8s]:%(created).6f %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    benchmarks = Su8230Benchmarks(useAsyncioSimulator='--asyncio-simulator' in sys.argv)
+    isSuccess = benchmarks.run(update_baselines='--update-baselines' in sys.argv)
+    sys.exit(0 if isSuccess else 1)
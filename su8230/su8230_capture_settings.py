@@ -0,0 +1,164 @@
+import os
+import json
+import logging
+from itertools import product
+
+"""
+Capture settings of the SU8230 (Set CAPTURESAVE CAPTURESPEED).
+Values of the dictionaries are the indices sent in the command text.
+
+Feasibility of every combination is precomputed once, measured durations are kept on disk so the fastest valid
+setting for a requested quality can be looked up without sending any command.
+"""
+CAPTURE_SCAN_MODES = {'Rapid': 0, 'Fast': 1, 'Slow': 2, 'CSS': 3, 'Slow1Integration': 4}
+CAPTURE_RESOLUTIONS = {'640x480': 0, '1280x960': 1, '2560x1920': 2, '5120x3840': 3}
+CAPTURE_SCAN_TIMES = {'10': 0, '20': 1, '40': 2, '80': 3, '160': 4, '320': 5}
+CAPTURE_INTEGRATION_NUMBERS = {'8': 0, '16': 1, '32': 2, '64': 3, '128': 4, '256': 5, '512': 6, '1024': 7}
+
+# Nominal frame time (s) at 640x480 for integrating scan modes, used until a duration is measured
+NOMINAL_FRAME_TIME_S = {'Rapid': 0.04, 'Fast': 0.5, 'Slow1Integration': 1.0}
+
+DEFAULT_DURATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'su8230_capture_durations.json')
+
+
+def is_capture_setting_feasible(scan_mode, resolution, scan_time, integration_number):
+    """Rules of the SU8230 for capture settings, arguments are the indices of the capture dictionaries"""
+    if scan_mode == 0 or scan_mode == 1:
+        if resolution == 3:
+            return False
+
+        # Not effective
+        if scan_time != 0:
+            return False
+
+    elif scan_mode == 2:
+        if resolution == 0 and scan_time == 5:
+            return False
+        elif resolution == 1 and scan_time == 0:
+            return False
+        elif resolution == 2 and scan_time < 2:
+            return False
+        elif resolution == 3 and scan_time < 3:
+            return False
+
+        # Not effective
+        if integration_number != 0:
+            return False
+    elif scan_mode == 3:
+        if resolution == 0 and scan_time > 3:
+            return False
+        elif resolution == 1 and (scan_time == 0 or scan_time == 5):
+            return False
+        elif resolution == 2 and scan_time < 2:
+            return False
+        elif resolution == 3:
+            return False
+
+        # Not effective
+        if integration_number != 0:
+            return False
+    elif scan_mode == 4:
+        if resolution == 3:
+            return False
+
+        if integration_number > 4:
+            return False
+
+        # Not effective
+        if scan_time != 0:
+            return False
+
+    return True
+
+
+# Lookup table (scan_mode, resolution, scan_time, integration_number) indices -> valid
+FEASIBILITY_TABLE = {indices: is_capture_setting_feasible(*indices)
+                     for indices in product(CAPTURE_SCAN_MODES.values(), CAPTURE_RESOLUTIONS.values(),
+                                            CAPTURE_SCAN_TIMES.values(), CAPTURE_INTEGRATION_NUMBERS.values())}
+
+
+def get_capture_setting_indices(scan_mode, resolution, scan_time, integration_number):
+    return (CAPTURE_SCAN_MODES[scan_mode], CAPTURE_RESOLUTIONS[resolution], CAPTURE_SCAN_TIMES[scan_time],
+            CAPTURE_INTEGRATION_NUMBERS[integration_number])
+
+
+def get_feasible_capture_settings():
+    """Returns the list of valid settings as (scan_mode, resolution, scan_time, integration_number) names"""
+    return [setting for setting in product(CAPTURE_SCAN_MODES, CAPTURE_RESOLUTIONS, CAPTURE_SCAN_TIMES,
+                                           CAPTURE_INTEGRATION_NUMBERS)
+            if FEASIBILITY_TABLE[get_capture_setting_indices(*setting)]]
+
+
+def get_setting_key(scan_mode, resolution, scan_time, integration_number):
+    return f'{scan_mode},{resolution},{scan_time},{integration_number}'
+
+
+def estimate_capture_duration(scan_mode, resolution, scan_time, integration_number):
+    """Nominal capture duration (s) of a setting. Slow and CSS frames last scan_time, integrating modes average
+    integration_number frames"""
+    xPixels, yPixels = resolution.split('x')
+    pixelRatio = int(xPixels) * int(yPixels) / (640 * 480)
+    if scan_mode in NOMINAL_FRAME_TIME_S:
+        return NOMINAL_FRAME_TIME_S[scan_mode] * pixelRatio * int(integration_number)
+
+    return float(scan_time)
+
+
+class CaptureSettingsTable:
+    """
+    Measured capture duration for each valid setting, stored as json. Settings never measured use the nominal
+    duration. Slow and CSS settings have no integration, they only count as the default integration number.
+    """
+    def __init__(self, filePath=DEFAULT_DURATIONS_FILE):
+        self.filePath = filePath
+        self.durations = {}
+        self._fastestSettings = {}
+        self.load()
+
+    def load(self):
+        if self.filePath is not None and os.path.exists(self.filePath):
+            with open(self.filePath, 'r') as file:
+                self.durations = json.load(file)
+
+        self._update_fastest_settings()
+
+    def save(self):
+        with open(self.filePath, 'w') as file:
+            json.dump(self.durations, file, indent=2, sort_keys=True)
+
+    def record_duration(self, scan_mode, resolution, scan_time, integration_number, duration_s):
+        if not FEASIBILITY_TABLE[get_capture_setting_indices(scan_mode, resolution, scan_time, integration_number)]:
+            logging.info('Capture settings are not compatible')
+            return
+
+        self.durations[get_setting_key(scan_mode, resolution, scan_time, integration_number)] = duration_s
+        self._update_fastest_settings()
+
+    def is_measured(self, scan_mode, resolution, scan_time, integration_number):
+        return get_setting_key(scan_mode, resolution, scan_time, integration_number) in self.durations
+
+    def get_duration(self, scan_mode, resolution, scan_time, integration_number):
+        key = get_setting_key(scan_mode, resolution, scan_time, integration_number)
+        if key in self.durations:
+            return self.durations[key]
+
+        return estimate_capture_duration(scan_mode, resolution, scan_time, integration_number)
+
+    def get_fastest_setting(self, min_resolution='640x480', min_integration_number='8'):
+        """Returns the fastest valid setting with at least the resolution and integration number asked and its
+        duration, (None, None) if no setting satisfies it"""
+        return self._fastestSettings.get((CAPTURE_RESOLUTIONS[min_resolution],
+                                          CAPTURE_INTEGRATION_NUMBERS[min_integration_number]), (None, None))
+
+    def _update_fastest_settings(self):
+        # Best setting for every (minimum resolution, minimum integration) pair so queries are a dict lookup
+        settings = [(self.get_duration(*setting), setting) for setting in get_feasible_capture_settings()]
+        settings.sort(key=lambda x: x[0])
+        self._fastestSettings = {}
+        for minResolution, minIntegration in product(CAPTURE_RESOLUTIONS.values(),
+                                                     CAPTURE_INTEGRATION_NUMBERS.values()):
+            for duration, setting in settings:
+                _, resolution, _, integration_number = get_capture_setting_indices(*setting)
+                if resolution >= minResolution and integration_number >= minIntegration:
+                    self._fastestSettings[(minResolution, minIntegration)] = (setting, duration)
+                    break
@@ -0,0 +1,128 @@
+import logging
+import cv2
+import numpy as np
+from internalProject.microscopeControl.su8230.su8230_capture_settings import FEASIBILITY_TABLE, \
+    CaptureSettingsTable, get_capture_setting_indices
+from internalProject.microscopeControl.su8230.su8230_occupancy_planner import get_otsu_threshold, \
+    DEFAULT_FOREGROUND_FRACTION
+
+"""
+Capture settings of each tile of a grid from the content of the low mag overview. The foreground fraction (occupancy
+planner) and the edge density (Otsu threshold of the gradient magnitude) of the tile footprint predict its information
+content. Background tiles are captured with a fast setting, tiles with a few features with an intermediate one and
+feature-rich tiles with the capture settings of the acquisition. Tiles outside of the overview keep the acquisition
+settings, their content is unknown. Tiles are grouped by setting and captured group after group, one capture settings
+switch per group, the group with the acquisition settings last so the acquisition ends with its own settings.
+"""
+BACKGROUND, INTERMEDIATE, RICH = 0, 1, 2
+# (scan_mode, scan_time, integration_number) of the background and intermediate tiles, at the grid resolution
+DEFAULT_BACKGROUND_SETTINGS = ('Rapid', '10', '32')
+DEFAULT_INTERMEDIATE_SETTINGS = ('Fast', '10', '16')
+# Content under which a tile is background, from which it is feature-rich (a particle a few overview pixels wide)
+DEFAULT_BACKGROUND_CONTENT = 0.005
+DEFAULT_RICH_CONTENT = DEFAULT_FOREGROUND_FRACTION
+
+
+def get_edge_map(overview, blurSigma=1.5):
+    """Edges of the overview : gradient magnitude of the smoothed image over its Otsu threshold"""
+    smoothed = cv2.GaussianBlur(np.asarray(overview, dtype=np.float32), (0, 0), blurSigma)
+    magnitude = np.hypot(cv2.Sobel(smoothed, cv2.CV_32F, 1, 0), cv2.Sobel(smoothed, cv2.CV_32F, 0, 1))
+    return magnitude > get_otsu_threshold(magnitude)
+
+
+class DwellPlanner:
+    def __init__(self, occupancyPlanner, commands=None, captureSettingsTable=None,
+                 backgroundSettings=DEFAULT_BACKGROUND_SETTINGS, intermediateSettings=DEFAULT_INTERMEDIATE_SETTINGS,
+                 backgroundContent=DEFAULT_BACKGROUND_CONTENT, richContent=DEFAULT_RICH_CONTENT):
+        """occupancyPlanner : OccupancyPlanner of the low mag overview
+            commands : Su8230Commands, validate_capture_setting_parameters is the feasibility oracle
+        """
+        self.occupancyPlanner = occupancyPlanner
+        self.commands = commands
+        self.captureSettingsTable = captureSettingsTable if captureSettingsTable is not None else \
+            CaptureSettingsTable()
+        self.backgroundSettings = backgroundSettings
+        self.intermediateSettings = intermediateSettings
+        self.backgroundContent = backgroundContent
+        self.richContent = richContent
+        edges = get_edge_map(occupancyPlanner.overview)
+        self.edgeIntegral = np.pad(np.cumsum(np.cumsum(edges, axis=0), axis=1), ((1, 0), (1, 0)))
+
+    def is_feasible(self, captureSettings):
+        indices = get_capture_setting_indices(captureSettings['scan_mode'], captureSettings['resolution'],
+                                              captureSettings['scan_time'], captureSettings['integration_number'])
+        if self.commands is not None:
+            return self.commands.validate_capture_setting_parameters(*indices)
+
+        return FEASIBILITY_TABLE.get(indices, False)
+
+    def get_duration(self, captureSettings):
+        return self.captureSettingsTable.get_duration(captureSettings['scan_mode'], captureSettings['resolution'],
+                                                      captureSettings['scan_time'],
+                                                      captureSettings['integration_number'])
+
+    def get_tier_settings(self, captureSettings):
+        """Capture settings of the background, intermediate and rich tiers, a tier without a feasible and faster
+        setting uses the settings of the next tier"""
+        tierSettings = [None, None, dict(captureSettings)]
+        for tier, (scan_mode, scan_time, integration_number) in ((INTERMEDIATE, self.intermediateSettings),
+                                                                 (BACKGROUND, self.backgroundSettings)):
+            settings = {'scan_mode': scan_mode, 'resolution': captureSettings['resolution'], 'scan_time': scan_time,
+                        'integration_number': integration_number}
+            nextSettings = tierSettings[tier + 1]
+            if not self.is_feasible(settings) or self.get_duration(settings) >= self.get_duration(nextSettings):
+                logging.info(f'Capture settings {settings} not feasible or not faster, tier {tier} uses the next tier')
+                settings = nextSettings
+            tierSettings[tier] = settings
+        return tierSettings
+
+    def get_content(self, magnification, x_step_nm, y_step_nm, numImagesX, numImagesY):
+        """Foreground fraction, edge density and content (the larger of both) of each tile indexed [xIndex, yIndex],
+        nan outside of the overview"""
+        foreground = self.occupancyPlanner.get_occupancy(magnification, x_step_nm, y_step_nm, numImagesX, numImagesY)
+        edges = self.occupancyPlanner.get_occupancy(magnification, x_step_nm, y_step_nm, numImagesX, numImagesY,
+                                                    self.edgeIntegral)
+        return foreground, edges, np.fmax(foreground, edges)
+
+    def get_tiers(self, content):
+        tiers = np.full(content.shape, RICH)
+        tiers[content < self.richContent] = INTERMEDIATE
+        tiers[content < self.backgroundContent] = BACKGROUND
+        tiers[np.isnan(content)] = RICH
+        return tiers
+
+    def plan(self, captureSettings, magnification, x_step_nm, y_step_nm, numImagesX, numImagesY, tiles=None):
+        """Groups of tiles sharing capture settings, from the fastest setting to the acquisition settings
+            tiles : tiles to capture, all if None
+            return : list of (capture settings, set of (xIndex, yIndex)), report
+        """
+        _, _, content = self.get_content(magnification, x_step_nm, y_step_nm, numImagesX, numImagesY)
+        tiers = self.get_tiers(content)
+        tierSettings = self.get_tier_settings(captureSettings)
+        groups = {}
+        for xIndex in range(numImagesX):
+            for yIndex in range(numImagesY):
+                if tiles is not None and (xIndex, yIndex) not in tiles:
+                    continue
+
+                settings = tierSettings[tiers[xIndex, yIndex]]
+                key = tuple(sorted(settings.items()))
+                groups.setdefault(key, (settings, set()))[1].add((xIndex, yIndex))
+
+        orderedGroups = sorted(groups.values(), key=lambda group: (group[0] == tierSettings[RICH],
+                                                                   self.get_duration(group[0])))
+        report = self.get_report(orderedGroups, captureSettings, tiers)
+        logging.info(f'Adaptive dwell : {report}')
+        return orderedGroups, report
+
+    def get_report(self, groups, captureSettings, tiers):
+        tileCount = sum(len(groupTiles) for _, groupTiles in groups)
+        uniformTime = tileCount * self.get_duration(captureSettings)
+        plannedTime = sum(len(groupTiles) * self.get_duration(settings) for settings, groupTiles in groups)
+        fasterGroups = sum(1 for settings, _ in groups if settings != captureSettings)
+        return {'tiles': tileCount, 'background_tiles': int(np.sum(tiers == BACKGROUND)),
+                'intermediate_tiles': int(np.sum(tiers == INTERMEDIATE)), 'rich_tiles': int(np.sum(tiers == RICH)),
+                # One switch per faster group and one back to the acquisition settings
+                'settings_switches': fasterGroups + int(fasterGroups > 0),
+                'uniform_beam_time_s': uniformTime, 'planned_beam_time_s': plannedTime,
+                'beam_time_saved_s': uniformTime - plannedTime}
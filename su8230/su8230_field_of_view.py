@@ -0,0 +1,157 @@
+import os
+import json
+import logging
+import numpy as np
+
+"""
+Field of view of the SU8230 against the magnification, the image width in pixels and the working distance, the single
+source of image sizes and pixel sizes for the planners and the stitchers.
+The measured table is loaded once. Each measurement is stored as the ratio of the measured field of view to the nominal
+one (127 mm / magnification wide, 4:3), interpolated in log magnification between measured magnifications and linearly
+between working distances, and clamped to the end values outside of the table. Without any measurement the nominal
+field of view is used. Queries take scalars or arrays of magnifications, results are memoized by query.
+"""
+DEFAULT_FIELD_OF_VIEW_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'su8230_field_of_view.json')
+# Width of the image at magnification 1 (127 mm photo), in nm, and height over width
+NOMINAL_WIDTH_NM = 127e6
+ASPECT_RATIO = 0.75
+MAX_CACHED_QUERIES = 100000
+
+
+def get_nominal_image_size_nm(magnification):
+    width_nm = NOMINAL_WIDTH_NM / np.asarray(magnification, dtype=np.float64)
+    return width_nm, width_nm * ASPECT_RATIO
+
+
+class FieldOfViewCalibration:
+    def __init__(self, filePath=DEFAULT_FIELD_OF_VIEW_FILE):
+        self.filePath = filePath
+        # List of {'magnification', 'width_px', 'wd_um', 'x_nm', 'y_nm'}
+        self.measurements = []
+        # Scale curves by image width : list of (wd_um, log magnifications, x scales, y scales) sorted by wd_um
+        self._curves = {}
+        self._cache = {}
+        self.load()
+
+    def load(self):
+        if self.filePath is not None and os.path.exists(self.filePath):
+            with open(self.filePath, 'r') as file:
+                self.measurements = json.load(file).get('measurements', [])
+            logging.info(f'Field of view calibration : {len(self.measurements)} measurements loaded')
+        self.clear_cache()
+
+    def save(self):
+        if self.filePath is None:
+            return
+
+        with open(self.filePath, 'w') as file:
+            json.dump({'measurements': self.measurements}, file, indent=2, sort_keys=True)
+
+    def clear_cache(self):
+        self._curves = {}
+        self._cache = {}
+
+    def record(self, magnification, width_px, wd_um, x_nm, y_nm):
+        """Measured field of view (e.g. from a calibration grating) of an image width_px wide at the working distance"""
+        self.measurements.append({'magnification': float(magnification), 'width_px': int(width_px),
+                                  'wd_um': float(wd_um), 'x_nm': float(x_nm), 'y_nm': float(y_nm)})
+        self.clear_cache()
+
+    def get_curves(self, width_px):
+        """Scale curves of the measurements of the image width, of all measurements if this width was not measured"""
+        if width_px in self._curves:
+            return self._curves[width_px]
+
+        measurements = [measurement for measurement in self.measurements if measurement['width_px'] == width_px]
+        if len(measurements) == 0:
+            measurements = self.measurements
+
+        curves = []
+        for wd_um in sorted({measurement['wd_um'] for measurement in measurements}):
+            rows = sorted((measurement for measurement in measurements if measurement['wd_um'] == wd_um),
+                          key=lambda measurement: measurement['magnification'])
+            magnifications = np.array([row['magnification'] for row in rows])
+            nominal_x_nm, nominal_y_nm = get_nominal_image_size_nm(magnifications)
+            curves.append((wd_um, np.log(magnifications), np.array([row['x_nm'] for row in rows]) / nominal_x_nm,
+                           np.array([row['y_nm'] for row in rows]) / nominal_y_nm))
+        self._curves[width_px] = curves
+        return curves
+
+    def get_scales(self, logMagnifications, width_px, wd_um):
+        """Measured over nominal field of view in x and y for the arrays of log magnifications"""
+        curves = self.get_curves(width_px)
+        if len(curves) == 0:
+            return np.ones_like(logMagnifications), np.ones_like(logMagnifications)
+
+        scales = [(np.interp(logMagnifications, logs, xScales), np.interp(logMagnifications, logs, yScales))
+                  for _, logs, xScales, yScales in curves]
+        if len(curves) == 1 or wd_um is None:
+            return np.mean([scale[0] for scale in scales], axis=0), np.mean([scale[1] for scale in scales], axis=0)
+
+        wds = [curve[0] for curve in curves]
+        upper = int(np.clip(np.searchsorted(wds, wd_um), 1, len(wds) - 1))
+        weight = float(np.clip((wd_um - wds[upper - 1]) / (wds[upper] - wds[upper - 1]), 0, 1))
+        return tuple((1 - weight) * scales[upper - 1][axis] + weight * scales[upper][axis] for axis in range(2))
+
+    def get_image_size_nm(self, magnification, width_px=640, wd_um=None):
+        """Field of view (x, y) in nm, floats for a scalar magnification, arrays for an array of magnifications"""
+        if np.ndim(magnification) == 0:
+            cached = self._cache.get((float(magnification), width_px, wd_um))
+            if cached is not None:
+                return float(cached[0]), float(cached[1])
+
+        magnifications = np.asarray(magnification, dtype=np.float64)
+        flat = magnifications.reshape(-1)
+        sizes = np.empty((len(flat), 2))
+        missing = []
+        for index, value in enumerate(flat):
+            cached = self._cache.get((value, width_px, wd_um))
+            if cached is None:
+                missing.append(index)
+            else:
+                sizes[index] = cached
+
+        if len(missing) > 0:
+            if len(self._cache) > MAX_CACHED_QUERIES:
+                self._cache = {}
+            values = flat[missing]
+            xScales, yScales = self.get_scales(np.log(values), width_px, wd_um)
+            nominal_x_nm, nominal_y_nm = get_nominal_image_size_nm(values)
+            sizes[missing, 0] = nominal_x_nm * xScales
+            sizes[missing, 1] = nominal_y_nm * yScales
+            for index, value in zip(missing, values):
+                self._cache[(float(value), width_px, wd_um)] = (sizes[index, 0], sizes[index, 1])
+
+        if magnifications.ndim == 0:
+            return float(sizes[0, 0]), float(sizes[0, 1])
+        return sizes[:, 0].reshape(magnifications.shape), sizes[:, 1].reshape(magnifications.shape)
+
+    def get_pixel_size_nm(self, magnification, width_px=640, wd_um=None):
+        """Size in nm of a pixel of an image width_px wide (pixels are square)"""
+        x_nm, _ = self.get_image_size_nm(magnification, width_px, wd_um)
+        return x_nm / width_px
+
+
+# Calibration shared by the planners and the stitchers, loaded on first use
+_fieldOfViewCalibration = None
+
+
+def get_field_of_view_calibration():
+    global _fieldOfViewCalibration
+    if _fieldOfViewCalibration is None:
+        _fieldOfViewCalibration = FieldOfViewCalibration()
+    return _fieldOfViewCalibration
+
+
+def set_field_of_view_calibration(calibration):
+    global _fieldOfViewCalibration
+    _fieldOfViewCalibration = calibration
+
+
+def get_image_XY_size_for_magnification(magnification, width_px=640, wd_um=None):
+    """Field of view (x, y) in nm"""
+    return get_field_of_view_calibration().get_image_size_nm(magnification, width_px, wd_um)
+
+
+def get_pixel_size_nm(magnification, width_px=640, wd_um=None):
+    return get_field_of_view_calibration().get_pixel_size_nm(magnification, width_px, wd_um)
@@ -1,19 +1,38 @@
 import os
 import sys
 import numpy as np
-from math import ceil, floor
 import logging
 import tkinter
 from tkinter import messagebox, simpledialog
+from PIL import Image
 from keras.models import load_model
 
 from ORSModel import orsObj, Channel, ROI, Vector3, Graph, CxvFiltering_Mode
 from ORSServiceClass.mathutils.otsu import Otsu
 from internalProject.microscopeControl.abstract_impl import AbstractImpl
 from internalProject.microscopeControl.su8230.su8230_commands import Su8230Commands
+from internalProject.microscopeControl.su8230.su8230_motion_plan import MotionPlan
+from internalProject.microscopeControl.su8230.su8230_path_planner import StagePathPlanner, ORDERS, get_snake_index
+from internalProject.microscopeControl.su8230.su8230_occupancy_planner import OccupancyPlanner, \
+    DEFAULT_FOREGROUND_FRACTION
+from internalProject.microscopeControl.su8230.su8230_dwell_planner import DwellPlanner
+from internalProject.microscopeControl.su8230.su8230_region_planner import RegionPlanner, assemble_tile, get_skeleton
+from internalProject.microscopeControl.su8230.su8230_stage_calibration import StageCalibration, MIN_INLIERS, \
+    REGISTRATION_THRESHOLD_PX
+from internalProject.microscopeControl.su8230.su8230_beam_shift_calibration import BeamShiftCalibration, \
+    split_image_shift, NOMINAL_UNIT_PX, IMAGE_SHIFT_RANGE
+from internalProject.microscopeControl.su8230.su8230_field_of_view import get_pixel_size_nm
 from internalProject.microscopeControl.su8230.su8230_tests import Su8230Tests
-from internalProject.microscopeControl.su8230.su8230_calibration import get_image_XY_size_for_magnification
-from internalProject.microscopeControl.stitching import getTransformation, stitchHighMagToLowMag, stitchHighMagToLowMagWithGraph
+from internalProject.microscopeControl.su8230.su8230_acquisition_estimator import AcquisitionTimeEstimator, \
+    get_grid_steps_nm
+from internalProject.microscopeControl.stitching import getTransformationFromArrays, stitchHighMagToLowMag, \
+    stitchHighMagToLowMagWithGraph, stitchMultiSignalGrid, SEED_SEARCH_RADIUS_TILES, SEED_MIN_CONFIDENCE
+from internalProject.microscopeControl.overview_index import OverviewDescriptorIndex
+from internalProject.microscopeControl.overlap_validator import OverlapValidator, load_tile
+from internalProject.microscopeControl.frame_averaging import FrameAverager
+from internalProject.microscopeControl.denoising import TileDenoiser
+from internalProject.microscopeControl.su8230.su8230_external_communication import get_signal_folder_name
+from internalProject.microscopeControl.tracing import TRACE_RECORDER
 from OrsPlugins.orsimageloader import OrsImageLoader
 
 
@@ -21,6 +40,18 @@ class Su8230Impl(AbstractImpl):
 
     def __init__(self):
         super().__init__()
+        # Neighbour tiles overlap check, feature matching only when the strip correlation is inconclusive
+        self._overlapValidator = OverlapValidator(
+            fullMatcher=lambda image1, image2: getTransformationFromArrays(image1, image2)[0] is not None)
+        # Stage axes errors and backlash learned from the registration of neighbour tiles
+        self._stageCalibration = StageCalibration()
+        # Measured field of view displacement against image shift, see calibrateBeamShift
+        self._beamShiftCalibration = BeamShiftCalibration()
+        self.estimator = AcquisitionTimeEstimator(self.commands, beamShiftCalibration=self._beamShiftCalibration)
+        # Fast frames averaged per tile instead of one capture with the capture settings, see setFrameAveraging
+        self._frameAveraging = None
+        # Denoising of the tiles after their transfer, see setDenoising
+        self._denoiser = None
 
     def instantiate_microscope_commands(self):
         self.commands = Su8230Commands()
@@ -41,6 +72,184 @@ class Su8230Impl(AbstractImpl):
         if status != 'RUN' or status != 'FREEZING':
             commands.set_scan_status(status='RUN')
 
+    def setMultiSignalCapture(self, signals, low_mag_signal='SE', SE_suppress=0):
+        """Displays up to 4 signals and captures them in one scan, the tiles of each signal are saved in their folder.
+            An empty list goes back to Single capture of the selected screen.
+        """
+        commands: Su8230Commands = self.get_microscope_commands()
+        if commands is None:
+            return
+
+        if len(signals) == 0:
+            self._saveStatus = 'Single'
+            return
+
+        screenSignals = (list(signals) + ['*'] * 4)[:4]
+        if commands.set_detectors(list_of_signals=screenSignals + [low_mag_signal, SE_suppress]):
+            self._saveStatus = 'All'
+
+    def setFrameAveraging(self, frames, scan_mode='Fast', integration_number='8'):
+        """Tiles averaged from fast frames (Rapid or Fast scan) registered to each other, instead of one capture with
+            the capture settings : same signal in less beam time, drift between the frames is corrected instead of
+            blurring the tile. Less than 2 frames goes back to the capture settings.
+        """
+        if frames < 2:
+            self._frameAveraging = None
+            return
+
+        if scan_mode not in ('Rapid', 'Fast'):
+            logging.info(f'Frame averaging needs Rapid or Fast scan, not {scan_mode}')
+            return
+
+        self._frameAveraging = {'frames': frames, 'scan_mode': scan_mode, 'integration_number': integration_number}
+
+    def setDenoising(self, method='nlmeans', strength=1.0):
+        """Denoises every tile after its transfer so faster scan settings still give segmentation quality tiles,
+            method is one of denoising.METHODS, None turns it off
+        """
+        self._denoiser = TileDenoiser(method, strength) if method is not None else None
+
+    def getTileCaptureSettings(self):
+        """Capture settings of one tile, the fast frame settings and their number with frame averaging"""
+        if self._frameAveraging is None:
+            return self._captureSettings
+
+        return {'scan_mode': self._frameAveraging['scan_mode'], 'resolution': self._captureSettings['resolution'],
+                'scan_time': '10', 'integration_number': self._frameAveraging['integration_number'],
+                'frames': self._frameAveraging['frames']}
+
+    def setCaptureSettingsForMicroscope(self):
+        commands = self.get_microscope_commands()
+        if commands is None or self._frameAveraging is None:
+            return super().setCaptureSettingsForMicroscope()
+
+        captureSettings = self.getTileCaptureSettings()
+        return commands.set_capture_settings(scan_mode=captureSettings['scan_mode'],
+                                             resolution=captureSettings['resolution'],
+                                             scan_time=captureSettings['scan_time'],
+                                             integration_number=captureSettings['integration_number'])
+
+    def setTileCaptureSettings(self, captureSettings):
+        """Capture settings of the next tiles, the capture settings of the acquisition are not changed"""
+        commands = self.get_microscope_commands()
+        return commands.set_capture_settings(scan_mode=captureSettings['scan_mode'],
+                                             resolution=captureSettings['resolution'],
+                                             scan_time=captureSettings['scan_time'],
+                                             integration_number=captureSettings['integration_number'])
+
+    def captureTile(self, newFileName, regions=None):
+        """Captures and saves a tile as set_capture_and_save, averaged from fast frames with frame averaging and
+            denoised with denoising
+            regions : sub-frames of the tile (RegionPlanner), the full frame if None
+            return : save dir of the tile
+        """
+        commands = self.get_microscope_commands()
+        if regions is not None:
+            savedir = self.captureRegionTile(newFileName, regions)
+        elif self._frameAveraging is None:
+            savedir = commands.set_capture_and_save(arg=self._saveStatus, project_name=self._filePath,
+                                                    newFileName=newFileName)
+        else:
+            savedir = self.captureAveragedTile(newFileName)
+
+        if self._denoiser is not None and savedir is not None:
+            folders = list(self.getSignalFolders().values()) if self._saveStatus == 'All' else [savedir]
+            for folder in folders:
+                self._denoiser.denoise_file(f'{folder}{newFileName}_1.tiff')
+        return savedir
+
+    def captureAveragedTile(self, newFileName):
+        """Tile averaged from drift corrected fast frames. The signals of a multi-signal capture are averaged with the
+            shifts measured on the first one.
+        """
+        commands = self.get_microscope_commands()
+        averagers = {}
+        savedir = None
+        for frame in range(self._frameAveraging['frames']):
+            frameName = f'{newFileName}_frame{frame}'
+            savedir = commands.set_capture_and_save(arg=self._saveStatus, project_name=self._filePath,
+                                                    newFileName=frameName)
+            folders = list(self.getSignalFolders().values()) if self._saveStatus == 'All' else [savedir]
+            for folder in folders:
+                averagers.setdefault(folder, FrameAverager())
+            shift = averagers[folders[0]].add(load_tile(f'{folders[0]}{frameName}_1.tiff'))
+            for folder in folders[1:]:
+                if shift is not None:
+                    averagers[folder].add(load_tile(f'{folder}{frameName}_1.tiff'), shift)
+            for folder in folders:
+                # Metadata of the tile is the one of its first frame
+                if frame == 0 and os.path.exists(f'{folder}{frameName}_1.txt'):
+                    os.replace(f'{folder}{frameName}_1.txt', f'{folder}{newFileName}_1.txt')
+                for file in os.listdir(folder):
+                    if file.startswith(f'{frameName}_'):
+                        os.remove(os.path.join(folder, file))
+
+        for folder, averager in averagers.items():
+            average = np.clip(np.round(averager.get_average()), 0, 255).astype(np.uint8)
+            Image.fromarray(average).convert('RGB').save(f'{folder}{newFileName}_1.tiff', format='TIFF',
+                                                         compression='tiff_lzw')
+        averager = averagers[next(iter(averagers))]
+        logging.info(f'Frame averaging {newFileName} : {averager.frameCount} frames, {averager.rejected} dropped, '
+                     f'drift {np.round(averager.shifts[-1], 2)} px')
+        return savedir
+
+    def captureRegionTile(self, newFileName, regions):
+        """Tile assembled from sub-frames, each one captured at its magnification and capture settings and centered
+            by image shift, the image shift, magnification and capture settings are restored after the tile
+        """
+        commands = self.get_microscope_commands()
+        folders = list(self.getSignalFolders().values()) if self._saveStatus == 'All' else [self._filePath]
+        images = {folder: [] for folder in folders}
+        pixelSize_nm = self.getPixelSize_nm()
+        magnification = self.getMagnification()
+        captureSettings = self._captureSettings
+        savedir = folders[0]
+        for index, region in enumerate(regions):
+            if region['magnification'] != magnification:
+                magnification = region['magnification']
+                commands.set_magnification(magnification)
+            if region['captureSettings'] != captureSettings:
+                captureSettings = region['captureSettings']
+                self.setTileCaptureSettings(captureSettings)
+            # Units depend on the magnification, the same units are sent back
+            units = [self.getImageShiftUnits(axis, region['center_px'][axis] * pixelSize_nm, magnification)
+                     for axis in range(2)]
+            for axis in range(2):
+                self.sendImageShift(axis, units[axis])
+            frameName = f'{newFileName}_region{index}'
+            savedir = commands.set_capture_and_save(arg=self._saveStatus, project_name=self._filePath,
+                                                    newFileName=frameName)
+            for axis in range(2):
+                self.sendImageShift(axis, -units[axis])
+            for folder in folders:
+                images[folder].append(load_tile(f'{folder}{frameName}_1.tiff'))
+                # Metadata of the tile is the one of its first sub-frame
+                if index == 0 and os.path.exists(f'{folder}{frameName}_1.txt'):
+                    os.replace(f'{folder}{frameName}_1.txt', f'{folder}{newFileName}_1.txt')
+                for file in os.listdir(folder):
+                    if file.startswith(f'{frameName}_'):
+                        os.remove(os.path.join(folder, file))
+        if magnification != self.getMagnification():
+            commands.set_magnification(self.getMagnification())
+        if captureSettings != self._captureSettings:
+            self.setCaptureSettingsForMicroscope()
+
+        for folder in folders:
+            tile = assemble_tile(self._xPixelSize, self._yPixelSize, regions, images[folder])
+            Image.fromarray(np.clip(np.round(tile), 0, 255).astype(np.uint8)).convert('RGB').save(
+                f'{folder}{newFileName}_1.tiff', format='TIFF', compression='tiff_lzw')
+        logging.info(f'Region capture {newFileName} : {len(regions)} sub-frames')
+        return savedir
+
+    def getSignalFolders(self):
+        """Folder of the tiles of each signal of a multi-signal capture"""
+        commands: Su8230Commands = self.get_microscope_commands()
+        if commands is None or self._saveStatus != 'All':
+            return {}
+
+        return {signal: os.path.join(self._filePath, get_signal_folder_name(signal)) + os.sep
+                for signal in commands.get_cached_screen_signals() if signal not in ('*', 'NONE')}
+
     def update_current_state(self,  key, get_command):
         if key not in self.currentState:
             return
@@ -218,170 +427,315 @@ class Su8230Impl(AbstractImpl):
         # Test capture images
         tests.test_capture_settings(commands=commands, project_name='')
 
-    def capture_XbyY_grid(self, x, y, stitchFollowingAcquisitions=False):
+    def estimateGridAcquisition(self, x, y, useBeamShift=None):
+        """Predicted duration (s) of capture_XbyY_grid with the present capture settings and its breakdown"""
+        estimate = self.estimator.estimate_grid(x, y, self.getMagnification(), self.getTileCaptureSettings(),
+                                                self._xPixelSize, useBeamShift)
+        logging.info(f'Estimated acquisition time for {x}x{y} grid : {round(estimate["total"])} s ({estimate})')
+        return estimate
+
+    def recommendGridPlan(self, x, y, timeBudget_s):
+        """Plan variant (beam or stage shift, capture settings) of capture_XbyY_grid meeting the time budget"""
+        plan = self.estimator.recommend_grid_plan(x, y, self.getMagnification(), timeBudget_s)
+        if plan is not None:
+            logging.info(f'Recommended plan : {plan}')
+        return plan
+
+    def capture_XbyY_grid(self, x, y, stitchFollowingAcquisitions=False, useBeamShift=None, sparse=False,
+                          foregroundFraction=DEFAULT_FOREGROUND_FRACTION, adaptiveDwell=False, regionCapture=False):
         """
         Captures a grid with X by Y images with sufficient overlap to ensure stitching is successful.
         If stitching fails, a beam shift will be performed to increase the overlap and attempt another stitch.
+        useBeamShift forces beam or stage shift, otherwise chosen from the step size.
+        sparse skips the tiles with less foreground than foregroundFraction on the low mag image.
+        adaptiveDwell captures the background tiles of the low mag image with faster capture settings (DwellPlanner),
+        not with frame averaging.
+        regionCapture only scans sub-frames around the foreground of the low mag image in each tile (RegionPlanner),
+        not with frame averaging nor adaptive dwell. Region tiles are not validated nor stitched.
 
         """
         commands: Su8230Commands = self.get_microscope_commands()
         if commands is None:
             return
 
+        self.estimateGridAcquisition(x, y, useBeamShift)
+        TRACE_RECORDER.clear()
         isValid = self.setCaptureSettingsForMicroscope()
         if isValid:
             # Take low mag pic
             low_mag = 20000
             commands.set_magnification(low_mag)
-            savedirLowMag = commands.set_capture_and_save(arg=self._saveStatus, project_name=self._filePath,
-                                                    newFileName=f'full_image_{low_mag}')
+            savedirLowMag = self.captureTile(f'full_image_{low_mag}')
             # Go to high mag
             commands.set_magnification(self.getMagnification())
 
             # Calculate photosize for x and y steps
-            photo_size_x_nm, photo_size_y_nm = get_image_XY_size_for_magnification(self._magnification)
-            # Step needs to be of minimum 25 nm increment
-            x_step_nm = round(ceil(photo_size_x_nm - photo_size_x_nm / 11) / 25) * 25
-            y_step_nm = round(ceil(photo_size_y_nm - photo_size_y_nm / 11) / 25) * 25
+            x_step_nm, y_step_nm = get_grid_steps_nm(self._magnification)
             # If xStep or yStep is smaller than 1000 nm, use beam shift
-            useBeamShiftX = True if x_step_nm < 900 else False
-            useBeamShiftY = True if y_step_nm < 900 else False
-            if useBeamShiftX or useBeamShiftY:
-                self.gridAcquisitionBeamShift(x_step_nm, y_step_nm, x, y)
+            if useBeamShift is None:
+                useBeamShiftX = True if x_step_nm < 900 else False
+                useBeamShiftY = True if y_step_nm < 900 else False
+                useBeamShift = useBeamShiftX or useBeamShiftY
+
+            # Calibrated stage moves land closer to the plan, their overlap only covers the remaining error
+            overlapFraction = 1 / 11
+            if not useBeamShift:
+                pixelSize_nm = self.getPixelSize_nm()
+                overlapFraction = self._stageCalibration.get_overlap_fraction(
+                    self.getMagnification(), (pixelSize_nm * self._xPixelSize, pixelSize_nm * self._yPixelSize),
+                    pixelSize_nm)
+                x_step_nm, y_step_nm = get_grid_steps_nm(self._magnification, overlapFraction)
+            self._overlapValidator.overlapFraction = overlapFraction
+            tiles = None
+            tileGroups = None
+            tileRegions = None
+            if regionCapture and self._frameAveraging is not None:
+                logging.info('Region capture is not used with frame averaging')
+                regionCapture = False
+            if regionCapture and adaptiveDwell:
+                logging.info('Adaptive dwell is not used with region capture')
+                adaptiveDwell = False
+            if sparse or adaptiveDwell or regionCapture:
+                occupancyPlanner = OccupancyPlanner.from_file(f'{savedirLowMag}full_image_{low_mag}_1.tiff', low_mag,
+                                                              foregroundFraction=foregroundFraction)
+            if sparse:
+                tiles = set(occupancyPlanner.plan(self.getMagnification(), x_step_nm, y_step_nm, x, y))
+            if adaptiveDwell and self._frameAveraging is not None:
+                logging.info('Adaptive dwell is not used with frame averaging')
+            elif adaptiveDwell:
+                dwellPlanner = DwellPlanner(occupancyPlanner, commands, self.estimator.captureSettingsTable)
+                tileGroups, _ = dwellPlanner.plan(self._captureSettings, self.getMagnification(), x_step_nm,
+                                                  y_step_nm, x, y, tiles)
+            if regionCapture:
+                regionPlanner = RegionPlanner(self._captureSettings, self.getMagnification(),
+                                              self.estimator.captureSettingsTable)
+                tileRegions = regionPlanner.plan_grid(occupancyPlanner, x_step_nm, y_step_nm, x, y, tiles)
+
+            if useBeamShift:
+                tileSettings = None if tileGroups is None else {tile: settings for settings, groupTiles in tileGroups
+                                                                for tile in groupTiles}
+                self.gridAcquisitionBeamShift(x_step_nm, y_step_nm, x, y, tiles=tiles, tileSettings=tileSettings,
+                                              tileRegions=tileRegions)
+            elif tileGroups is not None:
+                # One pass per capture settings from the same grid origin, the tiles of the faster passes have
+                # too little content to validate their overlap
+                origin = commands.get_stage_position()[:2]
+                currentSettings = self._captureSettings
+                for settings, groupTiles in tileGroups:
+                    if settings != currentSettings:
+                        currentSettings = settings
+                        self.setTileCaptureSettings(settings)
+                    self.gridAcquisitionStageShift(x_step_nm, y_step_nm, x, y, tiles=groupTiles, origin=origin,
+                                                   validateOverlap=settings == self._captureSettings)
+                if currentSettings != self._captureSettings:
+                    self.setCaptureSettingsForMicroscope()
             else:
-                self.gridAcquisitionStageShift(x_step_nm, y_step_nm, x, y)
-
-            if stitchFollowingAcquisitions:
+                self.gridAcquisitionStageShift(x_step_nm, y_step_nm, x, y, tiles=tiles,
+                                               validateOverlap=not regionCapture, tileRegions=tileRegions)
+
+            # Tiles of a sparse grid are registered to the low mag image one by one, the connectivity margin of the
+            # occupancy planner keeps the neighbours of the foreground tiles so the kept tiles overlap in the output
+            if stitchFollowingAcquisitions and regionCapture:
+                logging.info('Region capture grid is not stitched to the low mag image')
+            elif stitchFollowingAcquisitions and self._saveStatus == 'All':
+                # Placement of the best signal is applied to the other signal
+                stitchMultiSignalGrid(self.getSignalFolders(), low_mag, self.getMagnification(), x, y,
+                                      self._xPixelSize, self._yPixelSize, overlapFraction, tiles)
+            elif stitchFollowingAcquisitions:
                 stitchHighMagToLowMag(self._filePath, "", low_mag, self.getMagnification(),
-                                      x, y, self._xPixelSize, self._yPixelSize)
-
-    def gridAcquisitionBeamShift(self, xStep, yStep, numImagesX, numImagesY):
+                                      x, y, self._xPixelSize, self._yPixelSize, overlapFraction=overlapFraction,
+                                      tiles=tiles)
+
+            if self._denoiser is not None:
+                self._denoiser.report()
+            self.exportTimeline(f'timeline_grid_{x}x{y}.json')
+
+    def gridAcquisitionBeamShift(self, xStep, yStep, numImagesX, numImagesY, tiles=None, tileSettings=None,
+                                 tileRegions=None):
+        """tiles : (xIndex, yIndex) of the tiles to capture, all tiles if None
+            tileSettings : capture settings by (xIndex, yIndex), the present settings if None. Image shifts are
+            relative so tiles are captured in path order, settings only change between tiles with different settings.
+            tileRegions : sub-frames by (xIndex, yIndex) (RegionPlanner), full frames if None
+        """
         commands = self.get_microscope_commands()
         if commands is None:
             return
 
-        pixelSize_nm = 127 / self.getMagnification() / self._xPixelSize * 10 ** 6
-        # Find number of beam shifts needed : 1 beam shift = 3.4 * pixel size (nm) and max beam shift is 127
-        singleBeamShift = 3.4 * pixelSize_nm  # in nm
-        # for X
-        numberOfBeamShifts = xStep / singleBeamShift
-        numberToChange = numberOfBeamShifts / 127
-        fullNumber_X = floor(numberToChange)
-        # Convert decimal to image shift
-        decimalNumber_X = round((numberToChange % 1) * 127)
-        # for Y
-        numberOfBeamShifts = yStep / singleBeamShift
-        numberToChange = numberOfBeamShifts / 127
-        fullNumber_Y = floor(numberToChange)
-        # Convert decimal to image shift
-        decimalNumber_Y = round((numberToChange % 1) * 127)
+        currentSettings = self._captureSettings
+
+        def captureGridTile(xIndex, yIndex, n):
+            nonlocal currentSettings
+            if tileSettings is not None and tileSettings.get((xIndex, yIndex), currentSettings) != currentSettings:
+                currentSettings = tileSettings[(xIndex, yIndex)]
+                self.setTileCaptureSettings(currentSettings)
+            regions = None if tileRegions is None else tileRegions.get((xIndex, yIndex))
+            return self.captureTile(f'grid_mag{self._magnification}_{n}', regions)
+
+        # Loops below reuse the names of the steps
+        x_step_nm, y_step_nm = xStep, yStep
         n = 1
         snakeValue = -1
         for xStep in range(numImagesX):
             snakeValue *= -1
-            savedir = commands.set_capture_and_save(arg=self._saveStatus, project_name=self._filePath,
-                                                    newFileName=f'grid_mag{self._magnification}_{n}')
+            yIndex = 0 if snakeValue == 1 else numImagesY - 1
+            if tiles is None or (xStep, yIndex) in tiles:
+                savedir = captureGridTile(xStep, yIndex, n)
             n += 1
             for yStep in range(1, numImagesY):
-                for aYImageShift in range(fullNumber_Y):
-                    commands.set_image_shift_Y(snakeValue * 127)
-
-                commands.set_image_shift_Y(snakeValue * decimalNumber_Y)
-                savedir = commands.set_capture_and_save(arg=self._saveStatus, project_name=self._filePath,
-                                                        newFileName=f'grid_mag{self._magnification}_{n}')
+                # Units of each step depend on the total shift, the calibration is not linear near the range limits
+                self.sendImageShift(1, self.getImageShiftUnits(1, snakeValue * y_step_nm))
+                # Image shifts are relative, skipped tiles are still shifted over
+                yIndex = yStep if snakeValue == 1 else numImagesY - 1 - yStep
+                if tiles is None or (xStep, yIndex) in tiles:
+                    savedir = captureGridTile(xStep, yIndex, n)
                 n += 1
-            for aXImageShift in range(fullNumber_X):
-                commands.set_image_shift_X(-127)
-
-            commands.set_image_shift_X(-decimalNumber_X)
-
-    def gridAcquisitionStageShift(self, xStepNm, yStepNm, numImagesX, numImagesY):
+            self.sendImageShift(0, self.getImageShiftUnits(0, -x_step_nm))
+        if currentSettings != self._captureSettings:
+            self.setCaptureSettingsForMicroscope()
+
+    def gridAcquisitionStageShift(self, xStepNm, yStepNm, numImagesX, numImagesY, pathOrder=None, tiles=None,
+                                  origin=None, validateOverlap=True, tileRegions=None):
+        """pathOrder : raster, snake or hilbert, otherwise the fastest order given the stage model and backlash
+            tiles : (xIndex, yIndex) of the tiles to capture, all tiles if None
+            origin : stage position (x, y) of the first tile, the current position if None
+            validateOverlap : checks the overlap of neighbour tiles and recaptures the tile without overlap
+            tileRegions : sub-frames by (xIndex, yIndex) (RegionPlanner), full frames if None
+        """
         commands = self.get_microscope_commands()
         if commands is None:
             return
 
         # Current stage position is the center of the image
-        cur_x, cur_y, _, _, _ = commands.get_stage_position()
-        n = 1
-        snakeValue = 1
-        for xStep in range(numImagesX):
-            for yStep in range(numImagesY):
-                # Go in y direction
-                isInMovableRange = commands.set_stage_XY(cur_x, cur_y)
-
-                # Do not capture if the new positions were not in movable range
-                if isInMovableRange:
-                    savedir = commands.set_capture_and_save(arg=self._saveStatus, project_name=self._filePath,
-                                                                newFileName=f'grid_mag{self._magnification}_{n}')
-                    # Section for stitching checkup
-                    # Use two consecutive images - Columns
-                    if n > (xStep-1)*numImagesX + 1:
-                        self.validateStitchingBetweenImages(savedir + f'grid_mag{self._magnification}_{n}',
-                                                                      savedir + f'grid_mag{self._magnification}_{n-1}',
-                                                                      isYShift=True)
-
-                    # Use two consecutive images - Rows
-                    if n > yStep * numImagesY:
-                        self.validateStitchingBetweenImages(savedir + f'grid_mag{self._magnification}_{n}',
-                                                                      savedir + f'grid_mag{self._magnification}_{n - 1}',
-                                                                      isYShift=False)
-                cur_y += snakeValue*yStepNm
-                n += 1
+        cur_x, cur_y = commands.get_stage_position()[:2] if origin is None else origin
+        # Backlash under 2 pixels is tolerated by stitching
+        pixelSize_nm = self.getPixelSize_nm()
+        planner = StagePathPlanner.from_estimator(self.estimator, self.getTileCaptureSettings(),
+                                                  self._stageCalibration.get_backlash_nm(),
+                                                  backlashTolerance_nm=2 * pixelSize_nm)
+        # Tile offsets corrected for the stage axes errors measured at this magnification
+        moves, _, _ = planner.plan(cur_x, cur_y, xStepNm, yStepNm, numImagesX, numImagesY,
+                                   orders=ORDERS if pathOrder is None else (pathOrder,), tiles=tiles,
+                                   correction=lambda offset: self._stageCalibration.get_command(
+                                       self.getMagnification(), offset))
+        # Every move is validated against the movable range before the first move
+        plan = MotionPlan.for_path(commands, moves)
+        plan.report()
+        previousTile = None
+        previousImage = None
+        previousFile = None
+        previousTarget = None
+        previousArrival = None
+        for index, move in enumerate(moves):
+            # Do not move nor capture if the new positions are not in movable range
+            if not plan.is_feasible(index):
+                continue
 
-            cur_x += xStepNm
-            snakeValue *= -1
-            cur_y += snakeValue * yStepNm
-            # Backlash correction
-            # if self._magnification >= 90000:
-            #     # Handling back lash at every column
-            #     _ = commands.set_stage_XY(cur_x + xStep * xStepNm, cur_y - 2 * yStepNm)
+            commands.set_stage_XY(*plan.get_target(index))
+            # Approach moves only reach the tile from the approach direction
+            if move['tile'] is None:
+                continue
+
+            # Images are numbered in snake order whatever the path
+            xIndex, yIndex = move['tile']
+            n = get_snake_index(xIndex, yIndex, numImagesY) + 1
+            savedir = self.captureTile(f'grid_mag{self._magnification}_{n}',
+                                       None if tileRegions is None else tileRegions.get((xIndex, yIndex)))
+            tileFile = f'{savedir}grid_mag{self._magnification}_{n}_1.tiff'
+            image = load_tile(tileFile)
+            # Section for stitching checkup
+            # Use two consecutive images that are neighbours, same column for a y shift
+            if validateOverlap and previousTile is not None and \
+                    abs(xIndex - previousTile[0]) + abs(yIndex - previousTile[1]) == 1:
+                isValid, validatedImage = self.validateStitchingBetweenImages(
+                    tileFile, previousFile, xIndex == previousTile[0], image, previousImage,
+                    xIndex - previousTile[0] + yIndex - previousTile[1])
+                # A recaptured tile is beam shifted, only tiles placed by the stage alone measure the stage
+                if isValid and validatedImage is image:
+                    target = plan.get_target(index)
+                    self.recordStageMove(previousImage, image, (target[0] - previousTarget[0],
+                                                                target[1] - previousTarget[1]), pixelSize_nm,
+                                         previousArrival, move['arrival'])
+                image = validatedImage
+            previousTile = (xIndex, yIndex)
+            previousImage = image
+            previousFile = tileFile
+            previousTarget = plan.get_target(index)
+            previousArrival = move['arrival']
+        self._stageCalibration.save()
+
+    def recordStageMove(self, previousImage, image, commanded_nm, pixelSize_nm, previousArrival=(0, 0),
+                        arrival=(0, 0)):
+        """Adds the displacement between two neighbour tiles, measured by registration, to the stage calibration
+            previousArrival, arrival : direction of the last motion of each axis (+1, -1 or 0 if unknown) when the
+            tiles were captured, a pair is not recorded if the direction of an axis that moved is unknown
+        """
+        if any((previousArrival[axis] == 0) != (arrival[axis] == 0) for axis in range(2)):
+            return
+
+        diagnostics = {}
+        translation, _ = getTransformationFromArrays(previousImage, image, diagnostics, REGISTRATION_THRESHOLD_PX)
+        if translation is None or diagnostics.get('inliers', 0) < MIN_INLIERS:
+            return
 
-    def validateStitchingBetweenImages(self, filePath1, filePath2, isYShift):
+        self._stageCalibration.record(self.getMagnification(), commanded_nm,
+                                      (translation.getX() * pixelSize_nm, translation.getY() * pixelSize_nm),
+                                      [(arrival[axis] - previousArrival[axis]) / 2 for axis in range(2)])
+
+    def validateStitchingBetweenImages(self, filePath1, filePath2, isYShift, image1=None, image2=None, direction=1):
+        """Checks the overlap of the tile just captured (filePath1) with its neighbour (filePath2), images are read
+            from the files if not given. Without overlap, the tile is recaptured with an increasing beam shift back
+            toward the neighbour, up to the retry budget of the validator. The beam shift is sent back after the last
+            retry, the next tiles are placed by the stage alone.
+            direction : +1 if the tile index along the axis is the neighbour's plus one, -1 if minus one
+            return : True if the overlap is valid, image of the tile (recaptured or not)
+        """
         commands = self.get_microscope_commands()
         if commands is None:
-            return False
-
-        photo_size_x = self._xPixelSize
-        photo_size_y = self._yPixelSize
-        pixelSize_m = 127 / self.getMagnification() / self._xPixelSize / 1000
-        listChannels_SE = OrsImageLoader.createDatasetFromFiles(list(filePath1, filePath2), photo_size_x, photo_size_y,
-                                                                2, 1, 0, photo_size_x - 1, 0,
-                                                                photo_size_y - 1, 0, 2 - 1, 1, 1, 1, 1, pixelSize_m,
-                                                                pixelSize_m, pixelSize_m, 1, 0, '', False, False,
-                                                                False, 0, '', False, 0.0, 0.0, 1, '')
-        translation, _ = getTransformation(listChannels_SE[0], listChannels_SE[1])
-        # Check if there is a transformation
-        while translation is None:
-            # without transformation - beam shift back for more overlap
-            # TODO verify what is the optimal beam shift value
-            commands.set_image_shift_Y(-50) if isYShift else commands.set_image_shift_X(-50)
-            savedir = commands.set_capture_and_save(arg=self._saveStatus,
-                                                    project_name=self._filePath,
-                                                    newFileName=filePath2)
-            listChannels_SE = OrsImageLoader.createDatasetFromFiles(list(filePath1, filePath2), photo_size_x,
-                                                                    photo_size_y,
-                                                                    2, 1, 0, photo_size_x - 1, 0,
-                                                                    photo_size_y - 1, 0, 2 - 1, 1, 1, 1, 1, pixelSize_m,
-                                                                    pixelSize_m, pixelSize_m, 1, 0, '', False, False,
-                                                                    False, 0, '', False, 0.0, 0.0, 1, '')
-            translation, _ = getTransformation(listChannels_SE[0], listChannels_SE[1])
-
-    def tracking(self, project_name=None):
+            return False, image1
+
+        image1 = load_tile(filePath1) if image1 is None else image1
+        image2 = load_tile(filePath2) if image2 is None else image2
+        if self._overlapValidator.validate(image1, image2, isYShift):
+            return True, image1
+
+        axis = 1 if isYShift else 0
+        # Image shift commands are relative, each retry only sends the difference from the previous one
+        totalShift = 0
+        isValid = False
+        for shift in self._overlapValidator.get_retry_shifts():
+            # without transformation - beam shift back toward the neighbour for more overlap
+            self.sendImageShift(axis, -direction * shift - totalShift)
+            totalShift = -direction * shift
+            savedir = self.captureTile(os.path.basename(filePath1)[:-len('_1.tiff')])
+            image1 = load_tile(filePath1)
+            if self._overlapValidator.validate(image1, image2, isYShift):
+                isValid = True
+                break
+
+        self.sendImageShift(axis, -totalShift)
+        if not isValid:
+            logging.info(f'No overlap found between {filePath1} and {filePath2} after '
+                         f'{self._overlapValidator.maxRetries} retries, acquisition continues')
+        return isValid, image1
+
+    def tracking(self, project_name=None, regionCapture=False):
+        """regionCapture only scans sub-frames along the skeleton of the low mag image in each image (RegionPlanner)
+        """
         commands: Su8230Commands = self.get_microscope_commands()
         if commands is None:
             return
 
-        isValid = impl.setCaptureSettingsForMicroscope()
+        TRACE_RECORDER.clear()
+        isValid = self.setCaptureSettingsForMicroscope()
         if isValid:
             low_mag = 20000
             commands.set_magnification(low_mag)
             # Take low mag pic
-            savedir = commands.set_capture_and_save(arg=impl._saveStatus, project_name=impl._filePath,
-                                                    newFileName=f'full_image_{low_mag}')
+            savedir = self.captureTile(f'full_image_{low_mag}')
 
         # Segment CNT with thresholding
-        pixelSize_m = 127 / low_mag / self._xPixelSize / 1000
-        lowMagChannel = OrsImageLoader.createDatasetFromFiles(list(savedir), self._xPixelSize, self._yPixelSize,
+        pixelSize_m = self.getPixelSize_nm(low_mag) * 10 ** -9
+        lowMagChannel = OrsImageLoader.createDatasetFromFiles([f'{savedir}full_image_{low_mag}_1.tiff'], self._xPixelSize, self._yPixelSize,
                                                                 1, 1, 0, self._xPixelSize - 1, 0,
                                                                 self._yPixelSize - 1, 0, 0, 1, 1, 1, 1, pixelSize_m,
                                                                 pixelSize_m, pixelSize_m, 1, 0, '', False, False,
@@ -395,7 +749,7 @@ class Su8230Impl(AbstractImpl):
         skeletonROI.setAutoDelete(True)
         # Graph computation
         aGraph = skeletonROI.computeGraph(None)
-        commands.set_magnification(impl.getMagnification())
+        commands.set_magnification(self.getMagnification())
         timeIndex = 0
         # get the vertices map to select positions
         predAndSuccMap = aGraph.getVerticesPredecessorAndSuccessor(timeIndex).getNDArray()
@@ -412,8 +766,8 @@ class Su8230Impl(AbstractImpl):
         currentPosition = overviewImage.getBox().getCenter()
         curX = currentPosition.getX()
         curY = currentPosition.getY()
-        imageCount = 1
-        # vertices are position in space, position microscope at vertices
+        # vertices are position in space, steps to position microscope at vertices
+        steps_nm = []
         for aVertex in validVertices:
             xPos = vertices.at(3 * aVertex)
             yPos = vertices.at(3 * aVertex + 1)
@@ -425,16 +779,71 @@ class Su8230Impl(AbstractImpl):
             if abs(x_step_nm) < 600 and abs(y_step_nm) < 400:
                 continue
 
-            impl.beamShift(-x_step_nm, y_step_nm, imageCount) if (abs(y_step_nm) < 900 or abs(x_step_nm) < 900) \
-                else impl.stageShift(x_step_nm, y_step_nm, imageCount)
-            imageCount += 1
+            steps_nm.append((x_step_nm, y_step_nm))
             curX = xPos
             curY = yPos
 
+        # Stage moves of the whole path are validated against the movable range before the first move
+        isStageShift = [abs(y_step_nm) >= 900 and abs(x_step_nm) >= 900 for x_step_nm, y_step_nm in steps_nm]
+        stage_x, stage_y, _, _, _ = commands.get_stage_position()
+        MotionPlan.for_relative_steps(commands, stage_x, stage_y,
+                                      [step for step, isStage in zip(steps_nm, isStageShift) if isStage]).report()
+        # Sub-frames of each image from its footprint on the skeleton, images are centered on the vertices
+        imageRegions = [None] * len(steps_nm)
+        if regionCapture and self._frameAveraging is not None:
+            logging.info('Region capture is not used with frame averaging')
+        elif regionCapture:
+            occupancyPlanner = OccupancyPlanner.from_file(f'{savedir}full_image_{low_mag}_1.tiff', low_mag)
+            skeleton = get_skeleton(occupancyPlanner.foreground)
+            regionPlanner = RegionPlanner(self._captureSettings, self.getMagnification(),
+                                          self.estimator.captureSettingsTable)
+            offsets_nm = np.cumsum(steps_nm, axis=0) if len(steps_nm) > 0 else []
+            imageRegions = [regionPlanner.plan_footprint(occupancyPlanner, xOffset_nm, yOffset_nm, skeleton)
+                            for xOffset_nm, yOffset_nm in offsets_nm]
+            regionPlanner.report()
+        # Each image is placed in the low mag image by the descriptor index, its position error is taken off the
+        # next step so the errors of the stage and beam shifts do not add up along the path
+        overviewIndex = OverviewDescriptorIndex(load_tile(f'{savedir}full_image_{low_mag}_1.tiff'),
+                                                self.getPixelSize_nm(low_mag))
+        target_nm = np.zeros(2)
+        position_nm = np.zeros(2)
+        imageCount = 1
+        for (x_step_nm, y_step_nm), isStage, regions in zip(steps_nm, isStageShift, imageRegions):
+            target_nm += (x_step_nm, y_step_nm)
+            x_step_nm, y_step_nm = (int(round(float(step) / 25)) * 25 for step in target_nm - position_nm)
+            imageDir = self.stageShift(x_step_nm, y_step_nm, imageCount, regions) if isStage \
+                else self.beamShift(-x_step_nm, y_step_nm, imageCount, regions)
+            # The stage does not move to a position out of the movable range
+            if imageDir is not None or not isStage:
+                position_nm += (x_step_nm, y_step_nm)
+            # Sub-frame images are mostly blank
+            if imageDir is not None and regions is None:
+                tileFile = f'{imageDir}image_{self._magnification}_{imageCount}_1.tiff'
+                position_nm = self.locateInOverview(overviewIndex, tileFile, position_nm)
+            imageCount += 1
+
         stitchHighMagToLowMagWithGraph(project_name, overviewImage, aGraph, low_mag, self.getMagnification(), self._xPixelSize, self._yPixelSize,
                                        imageCount)
+        self.exportTimeline('timeline_tracking.json')
 
-    def stageShift(self, x_step_nm, y_step_nm, n):
+    def locateInOverview(self, overviewIndex, tileFile, predicted_nm):
+        """Position of the tile in nm from the overview center, found by the overview index or by NCC around the
+            predicted position, the predicted position if not found
+        """
+        tilePixelSize_nm = self.getPixelSize_nm()
+        found_nm, confidence, method = overviewIndex.locate_nm(
+            load_tile(tileFile), tilePixelSize_nm, tuple(predicted_nm),
+            SEED_SEARCH_RADIUS_TILES * self._xPixelSize * tilePixelSize_nm)
+        if found_nm is None or (method == 'ncc' and confidence < SEED_MIN_CONFIDENCE):
+            logging.info(f'{tileFile} not found in the overview, predicted position kept')
+            return predicted_nm
+
+        error_nm = np.subtract(found_nm, predicted_nm)
+        logging.info(f'{tileFile} found by {method} {np.round(error_nm).tolist()} nm from its predicted position')
+        return np.asarray(found_nm, dtype=np.float64)
+
+    def stageShift(self, x_step_nm, y_step_nm, n, regions=None):
+        """return : save dir of the image, None if the position is out of the movable range"""
         commands: Su8230Commands = self.get_microscope_commands()
         if commands is None:
             return
@@ -443,46 +852,83 @@ class Su8230Impl(AbstractImpl):
         cur_x, cur_y, _, _, _ = commands.get_stage_position()
         cur_x += x_step_nm
         cur_y += y_step_nm
-        isInMovableRange = commands.set_stage_XY(cur_x, cur_y)
+        # Do not move nor capture if the new positions are not in movable range (cached, no round trip per move)
+        if commands.getIsInMovableRange(cur_x, cur_y):
+            commands.set_stage_XY(cur_x, cur_y)
+            return self.captureTile(f'image_{self._magnification}_{n}', regions)
 
-        # Do not capture if the new positions were not in movable range
-        if isInMovableRange:
-            savedir = commands.set_capture_and_save(arg=self._saveStatus, project_name=self._filePath,
-                                                    newFileName=f'image_{self._magnification}_{n}')
+    def beamShift(self, x_step_nm, y_step_nm, n, regions=None):
+        commands: Su8230Commands = self.get_microscope_commands()
+        if commands is None:
+            return
 
-    def beamShift(self, x_step_nm, y_step_nm, n):
+        self.sendImageShift(1, self.getImageShiftUnits(1, y_step_nm))
+        self.sendImageShift(0, self.getImageShiftUnits(0, x_step_nm))
+        return self.captureTile(f'image_{self._magnification}_{n}', regions)
+
+    def getPixelSize_nm(self, magnification=None, xPixelSize=None):
+        """Pixel size in nm from the field of view calibration, present magnification and resolution by default"""
+        magnification = self.getMagnification() if magnification is None else magnification
+        xPixelSize = self._xPixelSize if xPixelSize is None else xPixelSize
+        return get_pixel_size_nm(magnification, xPixelSize, self._workingDistance)
+
+    def getImageShiftUnits(self, axis, step_nm, magnification=None):
+        """Relative image shift moving the field of view by step_nm (positive along positive shift values) from the
+        present total shift, at the present magnification by default. Without calibration, 1 beam shift = 3.4 * pixel
+        size (nm)
+        """
+        magnification = self.getMagnification() if magnification is None else magnification
+        pixelSize_nm = self.getPixelSize_nm(magnification)
+        currentUnits = self.get_microscope_commands().get_image_shift_units()[axis]
+        return self._beamShiftCalibration.get_shift_units(magnification, axis, currentUnits, step_nm,
+                                                          NOMINAL_UNIT_PX * pixelSize_nm)
+
+    def sendImageShift(self, axis, units):
+        """Relative image shift on the axis (0 : x, 1 : y), max beam shift is 127 per command"""
+        commands = self.get_microscope_commands()
+        for value in split_image_shift(units):
+            commands.set_image_shift_X(value) if axis == 0 else commands.set_image_shift_Y(value)
+
+    def calibrateBeamShift(self, magnifications=None, rangeUnits=IMAGE_SHIFT_RANGE):
+        """Measures the image shift of both axes with Rapid 640x480 frames at each magnification (the present one by
+        default), up to rangeUnits on each side. The total image shift is brought back to 0 first, it must have been
+        zeroed with set_image_shift_zero since the connection.
+        """
         commands: Su8230Commands = self.get_microscope_commands()
         if commands is None:
             return
+        if not commands.is_image_shift_zeroed():
+            logging.error('Reset the image shift on the SEM and call set_image_shift_zero before the beam shift '
+                          'calibration, the total image shift cannot be read')
+            return
 
-        pixelSize_nm = 127 / impl.getMagnification() / impl._xPixelSize * 10 ** 6
-        isXNeg = x_step_nm < 0
-        isYNeg = y_step_nm < 0
-        # Find number of beam shifts needed : 1 beam shift = 3.4 * pixel size (nm) and max beam shift is 127
-        singleBeamShift = 3.4 * pixelSize_nm  # in nm
-        # for X
-        numberOfBeamShifts = x_step_nm / singleBeamShift
-        numberToChange = numberOfBeamShifts / 127
-        fullNumber_X = floor(abs(numberToChange))
-        # Convert decimal to image shift
-        decimalNumber_X = round((numberToChange % 1) * 127)
-        # for Y
-        numberOfBeamShifts = y_step_nm / singleBeamShift
-        numberToChange = numberOfBeamShifts / 127
-        fullNumber_Y = floor(abs(numberToChange))
-        # Convert decimal to image shift
-        decimalNumber_Y = round((numberToChange % 1) * 127)
-        for aYImageShift in range(fullNumber_Y):
-            commands.set_image_shift_Y(-127 if isYNeg else 127)
-
-        commands.set_image_shift_Y(-decimalNumber_Y if isYNeg else decimalNumber_Y)
-
-        for aXImageShift in range(fullNumber_X):
-            commands.set_image_shift_X(-127 if isXNeg else 127)
-
-        commands.set_image_shift_X(-decimalNumber_X if isXNeg else decimalNumber_X)
-        savedir = commands.set_capture_and_save(arg=self._saveStatus, project_name=self._filePath,
-                                                newFileName=f'image_{impl._magnification}_{n}')
+        frameFolder = os.path.join(self._filePath, 'beam_shift_calibration') + os.sep
+        if not commands.set_capture_settings(scan_mode='Rapid', resolution='640x480', scan_time='10',
+                                             integration_number='8'):
+            return
+
+        for axis, units in enumerate(commands.get_image_shift_units()):
+            self.sendImageShift(axis, -units)
+        frames = []
+
+        def capture():
+            name = f'frame_{len(frames)}'
+            savedir = commands.set_capture_and_save(arg='Single', project_name=frameFolder, newFileName=name)
+            frames.append(name)
+            return load_tile(f'{savedir}{name}_1.tiff')
+
+        for magnification in magnifications if magnifications is not None else [self.getMagnification()]:
+            commands.set_magnification(magnification)
+            pixelSize_nm = self.getPixelSize_nm(magnification, 640)
+            for axis, frameSize in enumerate((640, 480)):
+                # Frames move by 30 % at the nominal shift, phase correlation is ambiguous beyond half a frame
+                stepUnits = min(127, int(0.3 * frameSize / NOMINAL_UNIT_PX))
+                self._beamShiftCalibration.calibrate_axis(
+                    magnification, axis, pixelSize_nm, capture, lambda units: self.sendImageShift(axis, units),
+                    stepUnits, rangeUnits)
+        self._beamShiftCalibration.save()
+        commands.set_magnification(self.getMagnification())
+        self.setCaptureSettingsForMicroscope()
 
     def captureImageToPredictParameters(self):
         commands: Su8230Commands = self.get_microscope_commands()
@@ -501,8 +947,7 @@ class Su8230Impl(AbstractImpl):
         magnification = 100000
         photo_size_x = 1280
         photo_size_y = 960
-        photo_size_x_mm = 127 / magnification
-        spacing = photo_size_x_mm / photo_size_x * 10 ** -3
+        spacing = self.getPixelSize_nm(magnification, photo_size_x) * 10 ** -9
         listChannels_BSE = OrsImageLoader.createDatasetFromFiles([savedir + f'image_5kV_emission10uA_modeNorm_cond1_measured51pA_1.tiff'],
             # listChannels_BSE = OrsImageLoader.createDatasetFromFiles([savedir+f'imageForModel_{initialEnergy}keV_{initialCurrent}pA.tiff'],
                                                                  photo_size_x, photo_size_y,
@@ -0,0 +1,53 @@
+import logging
+import numpy as np
+
+"""
+Stage targets of a grid or tracking run, validated against the movable range before any motion. The movable range is
+read once (cached by Su8230Commands) and every target is checked in one pass, infeasible tiles are reported before the
+run starts and skipped.
+"""
+
+
+class MotionPlan:
+    def __init__(self, targets_nm, movableRange):
+        """targets_nm : (x, y) stage positions in nm, in the order of the run
+            movableRange : Xmin, Xmax, Ymin, Ymax, ... as returned by get_movable_range_stage
+        """
+        self.targets = np.asarray(targets_nm, dtype=float).reshape(-1, 2)
+        xMin, xMax, yMin, yMax = movableRange[:4]
+        low = np.array([xMin, yMin], dtype=float)
+        high = np.array([xMax, yMax], dtype=float)
+        self.feasible = np.all((self.targets >= low) & (self.targets <= high), axis=1)
+
+    @classmethod
+    def for_path(cls, commands, moves):
+        """Targets of the moves of a StagePathPlanner path, approach moves included"""
+        return cls([move['target'] for move in moves], commands.get_cached_movable_range())
+
+    @classmethod
+    def for_relative_steps(cls, commands, start_x, start_y, steps_nm):
+        """Stage positions after each relative (x, y) step"""
+        steps = np.asarray(steps_nm, dtype=float).reshape(-1, 2)
+        targets = np.array([start_x, start_y], dtype=float) + np.cumsum(steps, axis=0)
+        return cls(targets, commands.get_cached_movable_range())
+
+    def __len__(self):
+        return len(self.targets)
+
+    def is_feasible(self, index):
+        return bool(self.feasible[index])
+
+    def get_target(self, index):
+        x, y = self.targets[index]
+        return int(round(x)), int(round(y))
+
+    def get_infeasible_indices(self):
+        return np.flatnonzero(~self.feasible).tolist()
+
+    def report(self):
+        """Logs the targets out of the movable range, return : True if all targets are feasible"""
+        infeasible = self.get_infeasible_indices()
+        if len(infeasible) > 0:
+            logging.info(f'{len(infeasible)} of {len(self)} stage targets out of movable range, skipped : '
+                         f'{[index + 1 for index in infeasible]}')
+        return len(infeasible) == 0
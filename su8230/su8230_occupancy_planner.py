@@ -0,0 +1,136 @@
+import logging
+import cv2
+import numpy as np
+from PIL import Image
+from internalProject.microscopeControl.su8230.su8230_field_of_view import get_image_XY_size_for_magnification
+
+"""
+Tiles of a sparse grid, chosen from the low mag overview. The overview is thresholded (Otsu by default), the footprint
+of each high mag tile is projected on it and only the tiles whose foreground fraction is over the threshold are kept,
+with their neighbours up to the connectivity margin so the kept tiles still overlap for stitching.
+The overview is centered on the first tile of the grid, columns along stage x and rows along stage y. Tiles outside of
+the overview are kept, their content is unknown.
+"""
+DEFAULT_FOREGROUND_FRACTION = 0.02
+
+
+def load_overview(filePath):
+    return np.asarray(Image.open(filePath), dtype=np.float32)
+
+
+def get_otsu_threshold(image, bins=256):
+    """Threshold maximizing the between-class variance of the histogram"""
+    histogram, edges = np.histogram(image, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weightBackground = np.cumsum(histogram)
+    weightForeground = weightBackground[-1] - weightBackground
+    sumBackground = np.cumsum(histogram * centers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        meanBackground = sumBackground / weightBackground
+        meanForeground = (sumBackground[-1] - sumBackground) / weightForeground
+        variance = weightBackground * weightForeground * (meanBackground - meanForeground) ** 2
+    return centers[np.nanargmax(variance[:-1])]
+
+
+def dilate_tiles(keep, margin):
+    """Adds the 8 neighbours of the kept tiles, margin times"""
+    for _ in range(margin):
+        padded = np.pad(keep, 1)
+        keep = np.zeros_like(keep)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                keep |= padded[1 + dx:padded.shape[0] - 1 + dx, 1 + dy:padded.shape[1] - 1 + dy]
+    return keep
+
+
+class OccupancyPlanner:
+    def __init__(self, overview, overviewMagnification, threshold=None, brightForeground=True,
+                 foregroundFraction=DEFAULT_FOREGROUND_FRACTION, margin=1):
+        """overview : 2d array of the low mag image
+            threshold : foreground intensity threshold, Otsu threshold of the overview if None
+            brightForeground : foreground is over the threshold, under otherwise
+        """
+        self.overview = np.asarray(overview, dtype=np.float32)
+        if self.overview.ndim == 3:
+            self.overview = self.overview.mean(axis=2)
+        self.threshold = get_otsu_threshold(self.overview) if threshold is None else threshold
+        self.foreground = self.overview > self.threshold if brightForeground else self.overview < self.threshold
+        self.foregroundFraction = foregroundFraction
+        self.margin = margin
+        height, width = self.overview.shape
+        overviewSize_x_nm, overviewSize_y_nm = get_image_XY_size_for_magnification(overviewMagnification, width)
+        self.pixelSize_x_nm = overviewSize_x_nm / width
+        self.pixelSize_y_nm = overviewSize_y_nm / height
+        # Summed area table, foreground pixels of any rectangle in 4 lookups
+        self.integral = np.pad(np.cumsum(np.cumsum(self.foreground, axis=0), axis=1), ((1, 0), (1, 0)))
+
+    @classmethod
+    def from_file(cls, filePath, overviewMagnification, **kwargs):
+        return cls(load_overview(filePath), overviewMagnification, **kwargs)
+
+    def get_footprint_bounds(self, xOffset_nm, yOffset_nm, size_x_nm, size_y_nm):
+        """Overview pixel bounds (colMin, rowMin, colMax, rowMax) of a tile centered at the offset from the overview
+        center, None if outside of it"""
+        height, width = self.foreground.shape
+        colMin = width / 2 + (xOffset_nm - size_x_nm / 2) / self.pixelSize_x_nm
+        colMax = width / 2 + (xOffset_nm + size_x_nm / 2) / self.pixelSize_x_nm
+        rowMin = height / 2 + (yOffset_nm - size_y_nm / 2) / self.pixelSize_y_nm
+        rowMax = height / 2 + (yOffset_nm + size_y_nm / 2) / self.pixelSize_y_nm
+        if colMin < 0 or rowMin < 0 or colMax > width or rowMax > height:
+            return None
+
+        return colMin, rowMin, colMax, rowMax
+
+    def get_footprint_fraction(self, xOffset_nm, yOffset_nm, size_x_nm, size_y_nm, integral=None):
+        """Foreground fraction of a tile centered at the offset from the overview center, None if outside of it.
+        integral : summed area table of another map of the overview (edges), the foreground one if None"""
+        integral = self.integral if integral is None else integral
+        bounds = self.get_footprint_bounds(xOffset_nm, yOffset_nm, size_x_nm, size_y_nm)
+        if bounds is None:
+            return None
+
+        colMin, rowMin, colMax, rowMax = bounds
+        # At least one overview pixel per tile
+        colMin, rowMin = int(np.floor(colMin)), int(np.floor(rowMin))
+        colMax, rowMax = max(int(np.ceil(colMax)), colMin + 1), max(int(np.ceil(rowMax)), rowMin + 1)
+        count = integral[rowMax, colMax] - integral[rowMin, colMax] - integral[rowMax, colMin] + \
+            integral[rowMin, colMin]
+        return count / ((rowMax - rowMin) * (colMax - colMin))
+
+    def get_footprint_mask(self, xOffset_nm, yOffset_nm, size_x_nm, size_y_nm, width, height, mask=None):
+        """Foreground of a tile centered at the offset from the overview center sampled at the width x height pixels of
+        the tile, None if outside of the overview.
+        mask : another map of the overview (skeleton), the foreground if None"""
+        mask = self.foreground if mask is None else mask
+        bounds = self.get_footprint_bounds(xOffset_nm, yOffset_nm, size_x_nm, size_y_nm)
+        if bounds is None:
+            return None
+
+        colMin, rowMin, colMax, rowMax = bounds
+        scaleX = (colMax - colMin) / width
+        scaleY = (rowMax - rowMin) / height
+        # Center of each tile pixel in overview pixels
+        matrix = np.float32([[scaleX, 0, colMin + 0.5 * scaleX - 0.5], [0, scaleY, rowMin + 0.5 * scaleY - 0.5]])
+        return cv2.warpAffine(np.asarray(mask, dtype=np.uint8), matrix, (width, height),
+                              flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP) > 0
+
+    def get_occupancy(self, magnification, x_step_nm, y_step_nm, numImagesX, numImagesY, integral=None):
+        """Foreground fraction of each tile indexed [xIndex, yIndex], nan outside of the overview"""
+        size_x_nm, size_y_nm = get_image_XY_size_for_magnification(magnification)
+        occupancy = np.full((numImagesX, numImagesY), np.nan)
+        for xIndex in range(numImagesX):
+            for yIndex in range(numImagesY):
+                fraction = self.get_footprint_fraction(xIndex * x_step_nm, yIndex * y_step_nm, size_x_nm, size_y_nm,
+                                                       integral)
+                if fraction is not None:
+                    occupancy[xIndex, yIndex] = fraction
+        return occupancy
+
+    def plan(self, magnification, x_step_nm, y_step_nm, numImagesX, numImagesY):
+        """Tiles to capture : list of (xIndex, yIndex)"""
+        occupancy = self.get_occupancy(magnification, x_step_nm, y_step_nm, numImagesX, numImagesY)
+        outside = np.isnan(occupancy)
+        keep = dilate_tiles(np.nan_to_num(occupancy) >= self.foregroundFraction, self.margin) | outside
+        logging.info(f'Sparse grid : {int(keep.sum())} of {keep.size} tiles kept, {int(outside.sum())} outside of '
+                     f'the overview')
+        return [(int(xIndex), int(yIndex)) for xIndex, yIndex in zip(*np.nonzero(keep))]
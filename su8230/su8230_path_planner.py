@@ -0,0 +1,157 @@
+import logging
+from math import hypot
+
+"""
+Order of the stage moves of a grid. Backlash shifts the sample by a constant offset for each direction of arrival, so
+tiles reached from different directions don't line up and stitching validation retries. The planner visits the tiles
+in raster, snake (boustrophedon) or Hilbert order, optionally inserts approach moves so every tile is reached from the
+same direction, and keeps the variant with the shortest predicted time : stage moves from the measured stage model plus
+a capture retry for each tile reached from another direction when the backlash is over the tolerance.
+"""
+ORDERS = ('raster', 'snake', 'hilbert')
+DEFAULT_STAGE_OVERHEAD_S = 1.0
+DEFAULT_STAGE_SPEED_NM_S = 500000
+
+
+def hilbert_index_to_xy(size, index):
+    """Coordinates of a Hilbert curve index, size is a power of 2"""
+    x = y = 0
+    step = 1
+    while step < size:
+        rx = 1 & (index // 2)
+        ry = 1 & (index ^ rx)
+        if ry == 0:
+            if rx == 1:
+                x = step - 1 - x
+                y = step - 1 - y
+            x, y = y, x
+        x += step * rx
+        y += step * ry
+        index //= 4
+        step *= 2
+    return x, y
+
+
+def get_grid_order(order, numImagesX, numImagesY):
+    """(xIndex, yIndex) of the tiles in visiting order"""
+    if order == 'raster':
+        return [(xIndex, yIndex) for xIndex in range(numImagesX) for yIndex in range(numImagesY)]
+
+    if order == 'snake':
+        return [(xIndex, yIndex if xIndex % 2 == 0 else numImagesY - 1 - yIndex)
+                for xIndex in range(numImagesX) for yIndex in range(numImagesY)]
+
+    if order == 'hilbert':
+        size = 1
+        while size < max(numImagesX, numImagesY):
+            size *= 2
+        tiles = [hilbert_index_to_xy(size, index) for index in range(size * size)]
+        return [(xIndex, yIndex) for xIndex, yIndex in tiles if xIndex < numImagesX and yIndex < numImagesY]
+
+    raise ValueError(f'Unknown grid order {order}')
+
+
+def get_snake_index(xIndex, yIndex, numImagesY):
+    """Index of a tile in the snake order, used to name the grid images"""
+    return xIndex * numImagesY + (yIndex if xIndex % 2 == 0 else numImagesY - 1 - yIndex)
+
+
+class StagePathPlanner:
+    def __init__(self, backlash_nm=0, stageOverhead_s=DEFAULT_STAGE_OVERHEAD_S, stageSpeed_nm_s=DEFAULT_STAGE_SPEED_NM_S,
+                 retryPenalty_s=0, backlashTolerance_nm=25, approachDirection=(1, 1)):
+        self.backlash_nm = backlash_nm
+        self.stageOverhead_s = stageOverhead_s
+        self.stageSpeed_nm_s = stageSpeed_nm_s
+        self.retryPenalty_s = retryPenalty_s
+        self.backlashTolerance_nm = backlashTolerance_nm
+        self.approachDirection = approachDirection
+
+    @classmethod
+    def from_estimator(cls, estimator, captureSettings, backlash_nm=0, backlashTolerance_nm=25):
+        """Stage model measured by the estimator, a retry costs a capture and its transfer"""
+        stageOverhead_s, stageSpeed_nm_s = estimator.get_stage_model()
+        retry = estimator.new_breakdown()
+        estimator.add_capture(retry, captureSettings)
+        return cls(backlash_nm, stageOverhead_s, stageSpeed_nm_s, estimator.finalize(retry)['total'],
+                   backlashTolerance_nm)
+
+    def get_approach_distance(self):
+        # Twice the backlash, at least a minimum stage step
+        return max(2 * self.backlash_nm, 25)
+
+    def build_path(self, order, start_x, start_y, x_step_nm, y_step_nm, numImagesX, numImagesY, useApproach,
+                   tiles=None, correction=None):
+        """Moves of the grid : list of dict with target (x, y) in nm and tile (xIndex, yIndex), None for approach moves
+            tiles : (xIndex, yIndex) of the tiles to visit, all tiles if None
+            correction : function of the tile offset (x, y) from the start returning the stage move to send
+        """
+        moves = []
+        position = (start_x, start_y)
+        # Direction of the last motion of each axis, unknown before the first move
+        directions = [0, 0]
+        approach = self.get_approach_distance()
+        for xIndex, yIndex in get_grid_order(order, numImagesX, numImagesY):
+            if tiles is not None and (xIndex, yIndex) not in tiles:
+                continue
+
+            offset = (xIndex * x_step_nm, yIndex * y_step_nm)
+            if correction is not None:
+                offset = correction(offset)
+            target = (start_x + offset[0], start_y + offset[1])
+            arrival = [self.get_direction(target[axis] - position[axis], directions[axis]) for axis in range(2)]
+            if useApproach and arrival != list(self.approachDirection):
+                approachPoint = tuple(target[axis] - self.approachDirection[axis] * approach
+                                      if arrival[axis] != self.approachDirection[axis] else target[axis]
+                                      for axis in range(2))
+                moves.append({'target': approachPoint, 'tile': None})
+                directions = [self.get_direction(approachPoint[axis] - position[axis], directions[axis])
+                              for axis in range(2)]
+                position = approachPoint
+                arrival = [self.get_direction(target[axis] - position[axis], directions[axis]) for axis in range(2)]
+
+            moves.append({'target': target, 'tile': (xIndex, yIndex), 'arrival': tuple(arrival)})
+            directions = arrival
+            position = target
+        return moves
+
+    @staticmethod
+    def get_direction(delta, lastDirection):
+        if delta > 0:
+            return 1
+        if delta < 0:
+            return -1
+        return lastDirection
+
+    def evaluate(self, moves, start_x, start_y):
+        """Predicted stage time and backlash retries of a path"""
+        position = (start_x, start_y)
+        distance = 0.0
+        for move in moves:
+            distance += hypot(move['target'][0] - position[0], move['target'][1] - position[1])
+            position = move['target']
+
+        # Tiles reached from another direction than the approach direction are offset by the backlash
+        reversedTiles = sum(1 for move in moves if move['tile'] is not None and
+                            any(move['arrival'][axis] not in (0, self.approachDirection[axis]) for axis in range(2)))
+        retries = reversedTiles if self.backlash_nm > self.backlashTolerance_nm else 0
+        stageTime = len(moves) * self.stageOverhead_s + distance / self.stageSpeed_nm_s
+        return {'moves': len(moves), 'distance_nm': distance, 'stage_s': stageTime, 'reversed_tiles': reversedTiles,
+                'retry_s': retries * self.retryPenalty_s, 'total': stageTime + retries * self.retryPenalty_s}
+
+    def plan(self, start_x, start_y, x_step_nm, y_step_nm, numImagesX, numImagesY, orders=ORDERS, tiles=None,
+             correction=None):
+        """Fastest variant of order and approach moves
+            return : moves, name of the variant, evaluation
+        """
+        best = None
+        for order in orders:
+            for useApproach in (False, True):
+                moves = self.build_path(order, start_x, start_y, x_step_nm, y_step_nm, numImagesX, numImagesY,
+                                        useApproach, tiles, correction)
+                evaluation = self.evaluate(moves, start_x, start_y)
+                name = f'{order} with approach' if useApproach else order
+                if best is None or evaluation['total'] < best[2]['total']:
+                    best = (moves, name, evaluation)
+
+        logging.info(f'Grid path {best[1]} : {best[2]}')
+        return best
@@ -0,0 +1,185 @@
+import logging
+import cv2
+import numpy as np
+from internalProject.microscopeControl.su8230.su8230_capture_settings import CAPTURE_RESOLUTIONS, CAPTURE_SCAN_TIMES, \
+    NOMINAL_FRAME_TIME_S, FEASIBILITY_TABLE, CaptureSettingsTable, get_capture_setting_indices
+from internalProject.microscopeControl.su8230.su8230_field_of_view import get_image_XY_size_for_magnification
+
+"""
+Region capture : only the parts of a tile with features are scanned. The features of the tile footprint on the low mag
+overview (foreground, or its skeleton for the CNT tracking) grown by a margin are bounded by rectangles, and the
+rectangles are covered by sub-frames captured at a lower capture resolution and a higher magnification, so their pixel
+size is the one of the tile, each one centered by image shift. Slow scans keep the pixel dwell of the tile (scan time
+scaled by the pixel count) and integrated scans already last in proportion to the pixel count, so the scan time follows
+the area imaged. The sub-frames are pasted into the tile at their position, the rest of the tile is left at 0.
+The external communication has no command to place or size the Area Scan box (it stays at the screen center with the
+size set on the SEM), so the sub-frames are captured in Normal Scan with a smaller field of view.
+"""
+# Margin around the features in tile pixels, covers the overview resolution and the stage error
+DEFAULT_MARGIN_PX = 24
+
+
+def get_skeleton(mask):
+    """Morphological skeleton of a mask (union of each erosion minus its opening)"""
+    element = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+    image = np.asarray(mask, dtype=np.uint8)
+    skeleton = np.zeros_like(image)
+    while image.any():
+        eroded = cv2.erode(image, element)
+        skeleton |= image - cv2.dilate(eroded, element)
+        image = eroded
+    return skeleton > 0
+
+
+def get_bounding_rectangles(mask, margin_px):
+    """Rectangles (x, y, width, height) bounding the features of the mask grown by margin_px, merged while they
+    overlap"""
+    if not np.any(mask):
+        return []
+
+    kernel = np.ones((2 * margin_px + 1, 2 * margin_px + 1), dtype=np.uint8)
+    grown = cv2.dilate(np.asarray(mask, dtype=np.uint8), kernel)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(grown, connectivity=8)
+    rectangles = [tuple(int(value) for value in stats[label, :4]) for label in range(1, count)]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rectangles)):
+            for j in range(i + 1, len(rectangles)):
+                x1, y1, w1, h1 = rectangles[i]
+                x2, y2, w2, h2 = rectangles[j]
+                if x1 < x2 + w2 and x2 < x1 + w1 and y1 < y2 + h2 and y2 < y1 + h1:
+                    left, top = min(x1, x2), min(y1, y2)
+                    rectangles[i] = (left, top, max(x1 + w1, x2 + w2) - left, max(y1 + h1, y2 + h2) - top)
+                    del rectangles[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return rectangles
+
+
+def get_subframe_settings(captureSettings, resolution):
+    """Capture settings of a sub-frame at a lower resolution with the pixel dwell of the tile"""
+    settings = dict(captureSettings, resolution=resolution)
+    if captureSettings['scan_mode'] not in NOMINAL_FRAME_TIME_S:
+        # Slow and CSS frames last scan_time whatever the resolution, shortest scan time not under the tile dwell
+        tileWidth, tileHeight = [int(value) for value in captureSettings['resolution'].split('x')]
+        width, height = [int(value) for value in resolution.split('x')]
+        scanTime = float(captureSettings['scan_time']) * width * height / (tileWidth * tileHeight)
+        scanTimes = [value for value in CAPTURE_SCAN_TIMES if float(value) >= scanTime]
+        settings['scan_time'] = min(scanTimes, key=float) if len(scanTimes) > 0 else captureSettings['scan_time']
+    return settings
+
+
+def assemble_tile(width, height, subframes, images):
+    """Tile of width x height pixels from the sub-frame images pasted at their position, 0 elsewhere"""
+    tile = np.zeros((height, width), dtype=np.float32)
+    for subframe, image in zip(subframes, images):
+        frameWidth, frameHeight = subframe['size_px']
+        left = width // 2 + subframe['center_px'][0] - frameWidth // 2
+        top = height // 2 + subframe['center_px'][1] - frameHeight // 2
+        tile[top:top + frameHeight, left:left + frameWidth] = image[:frameHeight, :frameWidth]
+    return tile
+
+
+class RegionPlanner:
+    def __init__(self, captureSettings, magnification, captureSettingsTable=None, margin_px=DEFAULT_MARGIN_PX):
+        """captureSettings : capture settings of the tiles, the sub-frames have the same pixel size"""
+        self.captureSettings = captureSettings
+        self.magnification = magnification
+        self.captureSettingsTable = captureSettingsTable if captureSettingsTable is not None else \
+            CaptureSettingsTable()
+        self.margin_px = margin_px
+        self.width, self.height = [int(value) for value in captureSettings['resolution'].split('x')]
+        self.fullDuration = self.get_duration(captureSettings)
+        # Feasible sub-frames smaller than the tile : (width, height, capture settings, duration)
+        self.subframeSizes = []
+        for resolution in CAPTURE_RESOLUTIONS:
+            width, height = [int(value) for value in resolution.split('x')]
+            settings = get_subframe_settings(captureSettings, resolution)
+            if width < self.width and FEASIBILITY_TABLE.get(get_capture_setting_indices(
+                    settings['scan_mode'], settings['resolution'], settings['scan_time'],
+                    settings['integration_number']), False):
+                self.subframeSizes.append((width, height, settings, self.get_duration(settings)))
+        self.tiles = 0
+        self.imagedPixels = 0
+        self.plannedTime_s = 0.0
+        self.fullTime_s = 0.0
+
+    def get_duration(self, captureSettings):
+        return self.captureSettingsTable.get_duration(captureSettings['scan_mode'], captureSettings['resolution'],
+                                                      captureSettings['scan_time'],
+                                                      captureSettings['integration_number'])
+
+    def cover_rectangle(self, rectangle, frameWidth, frameHeight, settings):
+        """Sub-frames of frameWidth x frameHeight pixels centered on the rectangle, within the tile"""
+        x, y, width, height = rectangle
+        countX = max(int(np.ceil(width / frameWidth)), 1)
+        countY = max(int(np.ceil(height / frameHeight)), 1)
+        subframes = []
+        for i in range(countX):
+            for j in range(countY):
+                centerX = np.clip(x + width / 2 + (i - (countX - 1) / 2) * frameWidth, frameWidth / 2,
+                                  self.width - frameWidth / 2)
+                centerY = np.clip(y + height / 2 + (j - (countY - 1) / 2) * frameHeight, frameHeight / 2,
+                                  self.height - frameHeight / 2)
+                # Whole pixel offsets from the tile center, the sub-frames are pasted without resampling
+                subframes.append({'center_px': (int(round(centerX)) - self.width // 2,
+                                                int(round(centerY)) - self.height // 2),
+                                  'size_px': (frameWidth, frameHeight),
+                                  'magnification': int(round(self.magnification * self.width / frameWidth)),
+                                  'captureSettings': settings})
+        return subframes
+
+    def plan(self, mask):
+        """Sub-frames of a tile from its feature mask (height x width tile pixels), the sub-frame size with the
+        shortest total duration
+            return : list of {'center_px' : (x, y) from the tile center, 'size_px', 'magnification', 'captureSettings'},
+                     None to capture the full frame (outside of the overview or not faster)
+        """
+        self.tiles += 1
+        self.fullTime_s += self.fullDuration
+        best = None
+        if mask is not None:
+            rectangles = get_bounding_rectangles(mask, self.margin_px)
+            for frameWidth, frameHeight, settings, duration in self.subframeSizes:
+                subframes = [subframe for rectangle in rectangles
+                             for subframe in self.cover_rectangle(rectangle, frameWidth, frameHeight, settings)]
+                if best is None or len(subframes) * duration < best[0]:
+                    best = (len(subframes) * duration, subframes, frameWidth * frameHeight)
+
+        if best is None or best[0] >= self.fullDuration:
+            self.imagedPixels += self.width * self.height
+            self.plannedTime_s += self.fullDuration
+            return None
+
+        self.imagedPixels += len(best[1]) * best[2]
+        self.plannedTime_s += best[0]
+        return best[1]
+
+    def plan_footprint(self, occupancyPlanner, xOffset_nm, yOffset_nm, mask=None):
+        """Sub-frames of the tile centered at the offset from the overview center, see plan
+            mask : map of the overview (skeleton), the foreground of occupancyPlanner if None
+        """
+        size_x_nm, size_y_nm = get_image_XY_size_for_magnification(self.magnification, self.width)
+        return self.plan(occupancyPlanner.get_footprint_mask(xOffset_nm, yOffset_nm, size_x_nm, size_y_nm, self.width,
+                                                             self.height, mask))
+
+    def plan_grid(self, occupancyPlanner, x_step_nm, y_step_nm, numImagesX, numImagesY, tiles=None):
+        """Sub-frames of each tile of a grid starting at the overview center, by (xIndex, yIndex)"""
+        tileRegions = {}
+        for xIndex in range(numImagesX):
+            for yIndex in range(numImagesY):
+                if tiles is None or (xIndex, yIndex) in tiles:
+                    tileRegions[(xIndex, yIndex)] = self.plan_footprint(occupancyPlanner, xIndex * x_step_nm,
+                                                                        yIndex * y_step_nm)
+        self.report()
+        return tileRegions
+
+    def report(self):
+        if self.tiles > 0:
+            logging.info(f'Region capture : {self.tiles} tiles, '
+                         f'{round(100 * self.imagedPixels / (self.tiles * self.width * self.height), 1)} % of the '
+                         f'area imaged, beam time {round(self.plannedTime_s, 1)} s instead of '
+                         f'{round(self.fullTime_s, 1)} s')
@@ -0,0 +1,503 @@
+import os
+import sys
+import time
+import socket
+import asyncio
+import logging
+import threading
+from math import ceil, log2
+import numpy as np
+from PIL import Image
+from internalProject.microscopeControl.abstract_external_communication import AbstractExternalCommunication
+from internalProject.microscopeControl.su8230.su8230_capture_settings import CAPTURE_SCAN_MODES, \
+    CAPTURE_RESOLUTIONS, CAPTURE_SCAN_TIMES, CAPTURE_INTEGRATION_NUMBERS, FEASIBILITY_TABLE, \
+    estimate_capture_duration
+
+"""
+Simulated SU8230 speaking the text protocol of Su8230ExternalCommunication. Like the PC SEM, the simulator connects
+to the external PC (LAPTOP_IP, SEM_PORT) and reconnects after the external PC closes each connection.
+
+    Command : (Send unit ID)(Receive unit ID)(Status code)(Main code)(Sub code)(Ext code)(Data)(CR)(LF)
+    Reply   : (Send unit ID)(Receive unit ID)(Status code)(Main code)(Sub code)(Ext code)(Data)(Return status)(CR)(LF)
+    Return status : OK, NG, PARAMERROR, and IDLE or BUSY for 'Get InstructName ALL'
+
+Models command latency, stage travel time and settling, stage backlash, beam shift and drift. Captures are cropped
+from a periodic ground-truth texture at the true stage position, beam shift and magnification, and written as
+C_Image_*.bmp in the SEM temp folder. All physical durations are multiplied by timeScale.
+"""
+PHOTO_SIZE_NM = 127 * 10 ** 6
+# Image shift values are relative, total shift in units is limited to this range
+IMAGE_SHIFT_RANGE = 20 * 127
+SIGNAL_SCREENS = ('screen1', 'screen2', 'screen3', 'screen4')
+
+
+def _inverse(dictionary):
+    return {value: key for key, value in dictionary.items()}
+
+
+class Su8230Simulator:
+    SEM_unit_ID = '0300'
+    EXT_unit_ID = '0303'
+    status_code = '0000'
+    BUFF_SIZE = 1024
+
+    def __init__(self, sem_dir_temp, host=AbstractExternalCommunication.LAPTOP_IP,
+                 port=AbstractExternalCommunication.SEM_PORT, commandLatency_s=0.005, stageSpeed_nm_s=500000,
+                 stageSettle_s=0.2, backlash_nm=0, beamShiftUnitPixels=3.4, beamShiftNonlinearity=0.0,
+                 drift_nm_s=(0.0, 0.0), noiseLevel=0.08, timeScale=1.0, textureSize=4096, texturePixelSize_nm=2.0,
+                 particleCount=4000, curveCount=20, seed=0, stageMatrix=((1.0, 0.0), (0.0, 1.0))):
+        self.sem_dir_temp = sem_dir_temp
+        self.host = host
+        self.port = port
+        self.commandLatency_s = commandLatency_s
+        self.stageSpeed_nm_s = stageSpeed_nm_s
+        self.stageSettle_s = stageSettle_s
+        self.backlash_nm = backlash_nm
+        self.beamShiftUnitPixels = beamShiftUnitPixels
+        self.beamShiftNonlinearity = beamShiftNonlinearity
+        self.drift_nm_s = drift_nm_s
+        # Scale error, rotation and non-orthogonality of the stage axes around the start position
+        self.stageMatrix = np.asarray(stageMatrix, dtype=np.float64)
+        self.noiseLevel = noiseLevel
+        self.timeScale = timeScale
+        self.texturePixelSize_nm = texturePixelSize_nm
+        self.rng = np.random.default_rng(seed)
+        self.texturePyramid = self.generate_texture_pyramid(textureSize, particleCount, curveCount)
+
+        self.lock = threading.RLock()
+        self.running = False
+        self.thread = None
+        self.connection = None
+        self.startTime = time.perf_counter()
+        self.statistics = {'connections': 0, 'commands': 0, 'idle_polls': 0, 'bytes_received': 0, 'bytes_sent': 0,
+                           'captures': 0, 'bytes_written': 0}
+        # Ground truth of every capture, used as oracle for stitching
+        self.captureLog = []
+        self.initialize_state()
+
+    # Ground truth
+    def generate_texture_pyramid(self, size, particleCount, curveCount):
+        """Periodic texture : smooth background, particles (disks) and CNT-like curves. Levels are averaged by 2."""
+        x = np.arange(size, dtype=np.float32)
+        texture = 0.15 + 0.04 * np.sin(2 * np.pi * 3 * x / size)[None, :] + \
+            0.04 * np.cos(2 * np.pi * 2 * x / size)[:, None]
+        texture = texture.astype(np.float32)
+        for _ in range(particleCount):
+            self.stamp_disk(texture, self.rng.uniform(0, size), self.rng.uniform(0, size),
+                            self.rng.uniform(4, 30), self.rng.uniform(0.5, 0.9))
+
+        for _ in range(curveCount):
+            posX, posY = self.rng.uniform(0, size, 2)
+            angle = self.rng.uniform(0, 2 * np.pi)
+            for _ in range(int(self.rng.uniform(200, 600))):
+                angle += self.rng.normal(0, 0.08)
+                posX += 3 * np.cos(angle)
+                posY += 3 * np.sin(angle)
+                self.stamp_disk(texture, posX, posY, 5, 0.75)
+
+        pyramid = [texture]
+        while pyramid[-1].shape[0] > 256:
+            level = pyramid[-1]
+            pyramid.append(0.25 * (level[::2, ::2] + level[1::2, ::2] + level[::2, 1::2] + level[1::2, 1::2]))
+        return pyramid
+
+    @staticmethod
+    def stamp_disk(texture, centerX, centerY, radius, intensity):
+        size = texture.shape[0]
+        offsets = np.arange(-ceil(radius), ceil(radius) + 1)
+        rows = (int(centerY) + offsets) % size
+        cols = (int(centerX) + offsets) % size
+        inside = (offsets[:, None] + int(centerY) - centerY) ** 2 + (offsets[None, :] + int(centerX) - centerX) ** 2 \
+            <= radius ** 2
+        patch = texture[np.ix_(rows, cols)]
+        texture[np.ix_(rows, cols)] = np.where(inside, np.maximum(patch, intensity), patch)
+
+    def render(self, centerX_nm, centerY_nm, pixelSize_nm, width, height, signal='SE'):
+        """Bilinear sampling of the texture level closest to the pixel size, wrapping around the period"""
+        level = int(np.clip(np.floor(log2(max(pixelSize_nm / self.texturePixelSize_nm, 1))), 0,
+                            len(self.texturePyramid) - 1))
+        texture = self.texturePyramid[level]
+        size = texture.shape[0]
+        texelSize_nm = self.texturePixelSize_nm * 2 ** level
+        u = (centerX_nm + (np.arange(width) - width / 2 + 0.5) * pixelSize_nm) / texelSize_nm
+        v = (centerY_nm + (np.arange(height) - height / 2 + 0.5) * pixelSize_nm) / texelSize_nm
+        u0 = np.floor(u)
+        v0 = np.floor(v)
+        fu = (u - u0).astype(np.float32)[None, :]
+        fv = (v - v0).astype(np.float32)[:, None]
+        u0 = u0.astype(np.int64) % size
+        v0 = v0.astype(np.int64) % size
+        u1 = (u0 + 1) % size
+        v1 = (v0 + 1) % size
+        image = (texture[np.ix_(v0, u0)] * (1 - fu) * (1 - fv) + texture[np.ix_(v0, u1)] * fu * (1 - fv) +
+                 texture[np.ix_(v1, u0)] * (1 - fu) * fv + texture[np.ix_(v1, u1)] * fu * fv)
+        if 'BSE' not in signal:
+            # SE signal enhances edges
+            gradientY, gradientX = np.gradient(image)
+            image = 0.7 * image + 1.5 * np.hypot(gradientX, gradientY)
+        return image
+
+    # State of the microscope
+    def initialize_state(self):
+        self.state = {'hv_status': 1, 'vacc': 5000, 'vdec': 0, 'emission': (100, 100), 'mag_mode': 0,
+                      'magnification': 100000, 'wd': 7000, 'focus': (1200, 2047), 'signals': ['SE', 'LA-BSE', '*', '*'],
+                      'scan_status': 'RUN', 'scan_speed': (20, 0), 'scan_mode': 0, 'selected_screen': 0,
+                      'stigma': (32768, 32768), 'raster_rotation': (0, 0), 'lens_mode': (0, 50),
+                      'capture': (2, 1, 3, 0), 'image_shift': [0, 0], 'alignment': [2048] * 12}
+        self.limits = (0, 110000000, 0, 110000000, 1500000, 40000000, -5000, 70000, 1)
+        # Commanded stage position and motion
+        self.stagePosition = [55000000.0, 55000000.0, 8000000.0, 0.0, 0.0]
+        self.stageStart = list(self.stagePosition)
+        self.stageTarget = list(self.stagePosition)
+        self.moveStart = 0.0
+        self.moveEnd = 0.0
+        self.stageDirection = [0, 0]
+        self.busyUntil = 0.0
+
+    def now(self):
+        return time.perf_counter()
+
+    def is_busy(self):
+        return self.now() < self.busyUntil
+
+    def get_commanded_stage_position(self):
+        """Stage coordinates read by the controller, interpolated while moving"""
+        now = self.now()
+        if now >= self.moveEnd or self.moveEnd == self.moveStart:
+            return list(self.stageTarget)
+
+        fraction = max(0.0, (now - self.moveStart) / (self.moveEnd - self.moveStart))
+        return [start + fraction * (target - start) for start, target in zip(self.stageStart, self.stageTarget)]
+
+    def get_true_stage_position(self):
+        """Physical position of the sample under the beam : axis errors, backlash and drift included"""
+        commanded = np.asarray(self.get_commanded_stage_position()[:2]) - self.stagePosition[:2]
+        x, y = self.stagePosition[:2] + self.stageMatrix @ commanded
+        elapsed = self.now() - self.startTime
+        x += -self.stageDirection[0] * self.backlash_nm / 2 + self.drift_nm_s[0] * elapsed / self.timeScale
+        y += -self.stageDirection[1] * self.backlash_nm / 2 + self.drift_nm_s[1] * elapsed / self.timeScale
+        return x, y
+
+    def get_pixel_size_nm(self, width):
+        return PHOTO_SIZE_NM / self.state['magnification'] / width
+
+    def get_image_shift_nm(self):
+        """Beam shift in nm, units are beamShiftUnitPixels pixels of a 640 wide image, less effective near the range
+        limits"""
+        shifts = []
+        for units in self.state['image_shift']:
+            effective = units * (1 - self.beamShiftNonlinearity * (units / IMAGE_SHIFT_RANGE) ** 2)
+            shifts.append(effective * self.beamShiftUnitPixels * self.get_pixel_size_nm(640))
+        return shifts
+
+    def move_stage(self, target):
+        current = self.get_commanded_stage_position()
+        for axis in range(2):
+            delta = target[axis] - current[axis]
+            if delta != 0:
+                self.stageDirection[axis] = 1 if delta > 0 else -1
+
+        distance = float(np.hypot(target[0] - current[0], target[1] - current[1]))
+        duration = (distance / self.stageSpeed_nm_s + self.stageSettle_s) * self.timeScale
+        self.stageStart = current
+        self.stageTarget = [float(value) for value in target]
+        self.moveStart = self.now()
+        self.moveEnd = self.moveStart + duration
+        self.busyUntil = max(self.busyUntil, self.moveEnd)
+
+    def stop_stage(self):
+        position = self.get_commanded_stage_position()
+        self.stageStart = position
+        self.stageTarget = position
+        self.moveStart = self.moveEnd = self.now()
+        self.busyUntil = self.now()
+
+    def capture(self, all_screens):
+        scanMode, resolution, scanTime, integration = self.state['capture']
+        names = (_inverse(CAPTURE_SCAN_MODES)[scanMode], _inverse(CAPTURE_RESOLUTIONS)[resolution],
+                 _inverse(CAPTURE_SCAN_TIMES)[scanTime], _inverse(CAPTURE_INTEGRATION_NUMBERS)[integration])
+        duration = estimate_capture_duration(*names)
+        width, height = [int(value) for value in names[1].split('x')]
+        pixelSize_nm = self.get_pixel_size_nm(width)
+        trueX, trueY = self.get_true_stage_position()
+        shiftX, shiftY = self.get_image_shift_nm()
+        # Drift during the capture blurs the image, rendered at positions along the drift and averaged
+        drift_px = np.hypot(*self.drift_nm_s) * duration / pixelSize_nm
+        offsets = np.linspace(0, duration, int(np.clip(ceil(2 * drift_px), 1, 32)))[:, None] * \
+            np.asarray(self.drift_nm_s)[None, :]
+        centerX = trueX + shiftX + float(offsets[:, 0].mean())
+        centerY = trueY + shiftY + float(offsets[:, 1].mean())
+        screens = range(4) if all_screens else [self.state['selected_screen']]
+        # Longer dwell gives less noise, reference is a 10 s capture
+        sigma = self.noiseLevel / np.sqrt(max(duration, 0.01) / 10)
+        os.makedirs(self.sem_dir_temp, exist_ok=True)
+        for screen in screens:
+            signal = self.state['signals'][screen]
+            if signal == '*':
+                continue
+
+            image = np.mean([self.render(trueX + shiftX + offsetX, trueY + shiftY + offsetY, pixelSize_nm, width,
+                                         height, signal) for offsetX, offsetY in offsets], axis=0)
+            image = image + self.rng.normal(0, sigma, image.shape).astype(np.float32)
+            image = np.clip(image * 255, 0, 255).astype(np.uint8)
+            filePath = os.path.join(self.sem_dir_temp, f'C_Image_{screen + 1}.bmp')
+            Image.fromarray(image).save(filePath, format='BMP')
+            self.statistics['bytes_written'] += os.path.getsize(filePath)
+            self.captureLog.append({'file': filePath, 'screen': screen + 1, 'signal': signal,
+                                    'center_nm': (centerX, centerY), 'pixel_size_nm': pixelSize_nm,
+                                    'resolution': (width, height), 'capture_settings': names,
+                                    'magnification': self.state['magnification']})
+
+        self.statistics['captures'] += 1
+        self.busyUntil = max(self.busyUntil, self.now() + duration * self.timeScale)
+
+    # Protocol
+    def handle_command(self, command):
+        """Returns the reply text of one command line"""
+        items = command.split()
+        if len(items) < 6:
+            return f'{self.SEM_unit_ID} {self.EXT_unit_ID} {self.status_code} * * * * PARAMERROR\r\n'
+
+        main_code, sub_code, ext_code = items[3], items[4], items[5]
+        data = items[6] if len(items) > 6 else '*'
+        with self.lock:
+            try:
+                if main_code == 'Get':
+                    data, status = self.handle_get(sub_code, ext_code)
+                elif main_code == 'Set':
+                    status = self.handle_set(sub_code, ext_code, data)
+                else:
+                    status = 'NG'
+            except (ValueError, IndexError, KeyError):
+                status = 'PARAMERROR'
+
+        return f'{self.SEM_unit_ID} {self.EXT_unit_ID} {self.status_code} {main_code} {sub_code} {ext_code} ' \
+               f'{data} {status}\r\n'
+
+    def handle_get(self, sub_code, ext_code):
+        state = self.state
+        if sub_code == 'InstructName':
+            self.statistics['idle_polls'] += 1
+            return 'SU8230', 'BUSY' if self.is_busy() else 'IDLE'
+
+        if sub_code == 'STAGEUNIT':
+            x, y, z, t, r = self.get_commanded_stage_position()
+            return f'{int(round(x))},{int(round(y))},{int(z)},{int(t)},{int(r)}', 'OK'
+
+        values = {'Version': 'SIM-1.0',
+                  'HVONOFF': state['hv_status'],
+                  'HVCONTROL': f'{state["vacc"]},{state["vdec"]}',
+                  'EMISSION': f'{state["emission"][0]},{state["emission"][1]}',
+                  'MAGNIFICATION': f'{state["mag_mode"]},{state["magnification"]}',
+                  'WD': state['wd'],
+                  'FOCUS': f'{state["focus"][0]},{state["focus"][1]}',
+                  'STAGESETTING': ','.join(str(value) for value in self.limits),
+                  'SPECIMEN': '10,0',
+                  'SCREEN': state['selected_screen'],
+                  'PHOTOSIZE': '0,1270',
+                  'ALIGNMENT': ','.join(str(value) for value in state['alignment']),
+                  'LENSMODE': f'{state["lens_mode"][0]},{state["lens_mode"][1]}',
+                  'STIGMAXY': f'{state["stigma"][0]},{state["stigma"][1]}',
+                  'RROTATION': f'{state["raster_rotation"][0]},{state["raster_rotation"][1]}'}
+        if sub_code == 'DETECTOR':
+            detectors = {'SIGNAL': ','.join(state['signals']), 'HIGHMAG': 'SE,LA-BSE,HA-BSE,SE(L),AUX,NONE',
+                         'LOWMAG': 'SE(LM),AUX,NONE', 'OPTION': 'YAG-BSE,PD-BSE'}
+            return detectors[ext_code], 'OK'
+
+        if sub_code == 'SCAN':
+            scan = {'NOW': state['scan_status'], 'SCANSPEED': f'{state["scan_speed"][0]},{state["scan_speed"][1]}',
+                    'SCANMODE': state['scan_mode']}
+            return scan[ext_code], 'OK'
+
+        if sub_code in values:
+            return values[sub_code], 'OK'
+
+        return '*', 'NG'
+
+    def handle_set(self, sub_code, ext_code, data):
+        state = self.state
+        values = data.split(',')
+        # Stop, freeze and HV off are accepted while busy, other commands are refused
+        if sub_code == 'HVONOFF' and values[0] == 'OFF':
+            state['hv_status'] = 0
+            return 'OK'
+
+        if sub_code == 'STAGE' and ext_code == 'STOP':
+            self.stop_stage()
+            return 'OK'
+
+        if sub_code == 'SCAN' and ext_code == 'EXECUTE':
+            state['scan_status'] = 'RUN' if values[0] in ('0', 'RUN') else 'FREEZE'
+            return 'OK'
+
+        if self.is_busy():
+            return 'NG'
+
+        if sub_code == 'STAGEUNIT':
+            x, y, z, t, r = self.get_commanded_stage_position()
+            if ext_code == 'MOVEXYZTR':
+                target = [float(value) for value in values]
+            elif ext_code == 'MOVEXYR':
+                target = [float(values[0]), float(values[1]), z, t, float(values[2])]
+            elif ext_code == 'MOVEXY':
+                target = [float(values[0]), float(values[1]), z, t, r]
+            elif ext_code == 'RELATIVEXY':
+                target = [x + float(values[0]), y + float(values[1]), z, t, r]
+            elif ext_code == 'MOVEHOME':
+                target = [55000000.0, 55000000.0, z, t, r]
+            else:
+                return 'OK'
+
+            if not (self.limits[0] <= target[0] <= self.limits[1] and self.limits[2] <= target[1] <= self.limits[3]):
+                return 'PARAMERROR'
+
+            self.move_stage(target)
+        elif sub_code == 'CAPTURESAVE' and ext_code == 'CAPTURESPEED':
+            capture = tuple(int(value) for value in values)
+            if not FEASIBILITY_TABLE.get(capture, False):
+                return 'PARAMERROR'
+            state['capture'] = capture
+        elif sub_code in ('CAPTURESAVE', 'DIRECTSAVE'):
+            self.capture(all_screens=values[0] == '1')
+        elif sub_code == 'PANEL' and ext_code in ('IMAGESHIFTX', 'IMAGESHIFTY'):
+            axis = 0 if ext_code == 'IMAGESHIFTX' else 1
+            value = int(float(values[0]))
+            if abs(value) > 127:
+                return 'PARAMERROR'
+            # Image does not move when exceeding the range
+            if abs(state['image_shift'][axis] + value) <= IMAGE_SHIFT_RANGE:
+                state['image_shift'][axis] += value
+        elif sub_code == 'MAGNIFICATION':
+            state['magnification'] = int(np.clip(float(values[0]), 5, 8000000))
+        elif sub_code == 'MAGMODE':
+            state['mag_mode'] = int(values[0])
+        elif sub_code == 'HVONOFF':
+            state['hv_status'] = 1 if values[0] == 'ON' else 0
+        elif sub_code == 'HVCONTROL':
+            state['vacc'] = int(float(values[0]))
+        elif sub_code == 'EMISSION':
+            state['emission'] = (int(float(values[0])), int(float(values[0])))
+        elif sub_code == 'WD':
+            state['wd'] = int(float(values[0]))
+        elif sub_code == 'FOCUS':
+            state['focus'] = (int(values[0]), int(values[1]))
+        elif sub_code == 'DETECTOR':
+            # First value is repeated by set_detectors, then 4 screens, low mag signal and SE suppress
+            state['signals'] = values[1:5]
+        elif sub_code == 'SCAN' and ext_code == 'SCANSPEED':
+            state['scan_speed'] = (int(values[0]), 0)
+        elif sub_code == 'SCAN' and ext_code == 'SCANMODE':
+            state['scan_mode'] = int(values[0])
+        elif sub_code == 'SCREEN':
+            state['selected_screen'] = int(values[0])
+        elif sub_code == 'STIGMAXY':
+            state['stigma'] = (int(float(values[0])), int(float(values[1])))
+        elif sub_code == 'RROTATION':
+            state['raster_rotation'] = (int(values[0]), int(float(values[1])))
+        elif sub_code == 'LENSMODE':
+            state['lens_mode'] = (int(values[0]), int(float(values[1])))
+        elif sub_code == 'ALIGNMENT':
+            mode = int(values[0])
+            state['alignment'][2 * mode] = int(values[1])
+            state['alignment'][2 * mode + 1] = int(values[2])
+
+        return 'OK'
+
+    # Transport
+    def start(self, useAsyncio=False):
+        self.running = True
+        target = (lambda: asyncio.run(self.serve_async())) if useAsyncio else self.serve
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.connection is not None:
+            self.connection.close()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+
+    def serve(self):
+        while self.running:
+            try:
+                self.connection = socket.create_connection((self.host, self.port), timeout=1)
+            except OSError:
+                time.sleep(0.005)
+                continue
+
+            self.statistics['connections'] += 1
+            self.serve_connection(self.connection)
+            self.connection.close()
+
+    def serve_connection(self, connection):
+        buffer = b''
+        connection.settimeout(0.5)
+        while self.running:
+            try:
+                received = connection.recv(self.BUFF_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+
+            if not received:
+                return
+
+            self.statistics['bytes_received'] += len(received)
+            buffer += received
+            while b'\r\n' in buffer:
+                line, buffer = buffer.split(b'\r\n', 1)
+                self.statistics['commands'] += 1
+                time.sleep(self.commandLatency_s * self.timeScale)
+                reply = self.handle_command(line.decode('UTF-8')).encode('UTF-8')
+                try:
+                    connection.sendall(reply)
+                except OSError:
+                    return
+                self.statistics['bytes_sent'] += len(reply)
+
+    async def serve_async(self):
+        """asyncio transport, keeps one connection open until the external PC closes it"""
+        while self.running:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError:
+                await asyncio.sleep(0.005)
+                continue
+
+            self.statistics['connections'] += 1
+            await self.serve_connection_async(reader, writer)
+            writer.close()
+
+    async def serve_connection_async(self, reader, writer):
+        while self.running:
+            try:
+                line = await asyncio.wait_for(reader.readline(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            except OSError:
+                return
+
+            if not line:
+                return
+
+            self.statistics['bytes_received'] += len(line)
+            self.statistics['commands'] += 1
+            await asyncio.sleep(self.commandLatency_s * self.timeScale)
+            reply = self.handle_command(line.decode('UTF-8').strip()).encode('UTF-8')
+            try:
+                writer.write(reply)
+                await writer.drain()
+            except OSError:
+                return
+            self.statistics['bytes_sent'] += len(reply)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('--')]
+    simulator = Su8230Simulator(arguments[0] if len(arguments) > 0 else 'V:/SemImage/temp')
+    simulator.start(useAsyncio='--asyncio' in sys.argv)
+    logging.info(f'Simulated SU8230 connecting to {simulator.host}:{simulator.port}')
+    while True:
+        time.sleep(1)
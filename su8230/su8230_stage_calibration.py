@@ -0,0 +1,172 @@
+import os
+import json
+import logging
+import numpy as np
+
+"""
+Stage to image calibration learned from the grids : for every pair of neighbour tiles, the commanded stage move and
+the displacement measured by registering the tiles are recorded. A linear model measured = M @ commanded is fitted for
+each magnification range, M holds the scale error of the axes, their rotation relative to the raster and their
+non-orthogonality. Samples and models are stored as json.
+Planners send M^-1 @ step so the tiles land where they are expected, and the overlap is reduced to what registration
+needs plus the spread left after correction.
+Backlash offsets the sample against the arrival direction of each axis. Pairs whose second tile is reached from the
+other direction along an axis are left out of the fit, their residual along that axis measures the backlash.
+"""
+DEFAULT_STAGE_CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                              'su8230_stage_calibration.json')
+# Upper bounds of the magnification ranges sharing a model
+MAGNIFICATION_RANGES = (10000, 30000, 60000, 120000, 250000, 500000, 1000000)
+MIN_SAMPLES = 6
+MAX_SAMPLES = 500
+# Registration of a tile pair : RANSAC threshold in pixels and inliers needed to record the pair
+REGISTRATION_THRESHOLD_PX = 1.5
+MIN_INLIERS = 8
+# Reversed pairs needed to measure the backlash
+MIN_BACKLASH_SAMPLES = 3
+# Overlap is never larger than the uncalibrated 1/11 of the image, nor smaller than this
+DEFAULT_OVERLAP_FRACTION = 1 / 11
+MIN_OVERLAP_FRACTION = 1 / 25
+# Registration needs this overlap in pixels on top of the stage error
+MIN_OVERLAP_PX = 32
+ERROR_SIGMAS = 3
+# Stage axes errors are a few percent at most, a model further from identity (largest singular value of M - I) or with
+# a negative diagonal comes from mismatched registrations and is not used
+MAX_MATRIX_DEVIATION = 0.05
+
+
+def is_plausible_matrix(matrix):
+    """True if the stage matrix is close to identity"""
+    matrix = np.asarray(matrix, dtype=np.float64)
+    return bool(np.all(np.diag(matrix) > 0) and np.linalg.norm(matrix - np.eye(2), 2) <= MAX_MATRIX_DEVIATION)
+
+
+def get_magnification_range(magnification):
+    """Key of the model used for the magnification"""
+    lower = 0
+    for upper in MAGNIFICATION_RANGES:
+        if magnification < upper:
+            return f'{lower}-{upper}'
+        lower = upper
+    return f'{lower}-'
+
+
+def fit_stage_matrix(commanded, measured, regularization=1e-3):
+    """Least squares M of measured = M @ commanded, pulled toward identity for the directions without samples
+    (a grid with one column only moves along y)
+        return : M, residual of each sample in nm
+    """
+    commanded = np.asarray(commanded, dtype=np.float64)
+    measured = np.asarray(measured, dtype=np.float64)
+    normal = commanded.T @ commanded
+    damping = regularization * max(np.trace(normal) / 2, 1.0)
+    matrix = np.linalg.solve(normal + damping * np.eye(2), commanded.T @ measured + damping * np.eye(2)).T
+    residuals = np.hypot(*(measured - commanded @ matrix.T).T)
+    return matrix, residuals
+
+
+class StageCalibration:
+    def __init__(self, filePath=DEFAULT_STAGE_CALIBRATION_FILE):
+        self.filePath = filePath
+        # Magnification range : list of (commanded x, commanded y, measured x, measured y) in nm and (reversal x,
+        # reversal y) : +1 or -1 if the second tile is reached from the other direction along the axis, 0 otherwise
+        self.samples = {}
+        self.models = {}
+        self.load()
+
+    def load(self):
+        if self.filePath is not None and os.path.exists(self.filePath):
+            with open(self.filePath, 'r') as file:
+                data = json.load(file)
+            # Samples saved before the reversals were recorded have none
+            self.samples = {key: [sample + [0.0] * (6 - len(sample)) for sample in samples]
+                            for key, samples in data.get('samples', {}).items()}
+            self.models = data.get('models', {})
+
+    def save(self):
+        if self.filePath is None:
+            return
+
+        for key in self.samples:
+            self.get_model_of_range(key)
+        with open(self.filePath, 'w') as file:
+            json.dump({'samples': self.samples, 'models': self.models, 'backlash_nm': self.get_backlash_nm()}, file,
+                      indent=2, sort_keys=True)
+
+    def record(self, magnification, commanded_nm, measured_nm, reversal=(0, 0)):
+        """commanded_nm : stage move between two tiles, measured_nm : displacement of the second tile found by
+        registration, reversal : half the change of arrival direction of each axis between the tiles"""
+        key = get_magnification_range(magnification)
+        samples = self.samples.setdefault(key, [])
+        samples.append([float(commanded_nm[0]), float(commanded_nm[1]), float(measured_nm[0]), float(measured_nm[1]),
+                        float(reversal[0]), float(reversal[1])])
+        del samples[:-MAX_SAMPLES]
+        self.models.pop(key, None)
+
+    def get_model_of_range(self, key):
+        if key in self.models:
+            return self.models[key]
+
+        samples = np.asarray(self.samples.get(key, []), dtype=np.float64).reshape(-1, 6)
+        # Reversed pairs are offset by the backlash
+        samples = samples[np.all(samples[:, 4:] == 0, axis=1)]
+        if len(samples) < MIN_SAMPLES:
+            return None
+
+        matrix, residuals = fit_stage_matrix(samples[:, :2], samples[:, 2:4])
+        # Pairs badly registered are dropped, model fitted again on the others
+        keep = residuals <= max(ERROR_SIGMAS * 1.4826 * float(np.median(residuals)), 1.0)
+        if MIN_SAMPLES <= keep.sum() < len(samples):
+            matrix, residuals = fit_stage_matrix(samples[keep, :2], samples[keep, 2:4])
+        model = {'matrix': matrix.tolist(), 'residual_nm': float(np.sqrt(np.mean(residuals ** 2))),
+                 'samples': int(len(residuals)), 'plausible': is_plausible_matrix(matrix)}
+        self.models[key] = model
+        logging.info(f'Stage calibration {key} : {model}')
+        if not model['plausible']:
+            logging.info(f'Stage calibration {key} is too far from identity, nominal moves and overlap are used')
+        return model
+
+    def get_model(self, magnification):
+        """Model of the magnification range, None until enough tile pairs were measured or if the model is too far
+        from identity"""
+        model = self.get_model_of_range(get_magnification_range(magnification))
+        if model is None or not model.get('plausible', is_plausible_matrix(model['matrix'])):
+            return None
+
+        return model
+
+    def get_backlash_nm(self):
+        """Median backlash of the reversed pairs of all magnification ranges, residual against the stage model of
+        their range (identity until it is measured), 0 until enough reversed pairs were recorded"""
+        backlashes = []
+        for key, samples in self.samples.items():
+            samples = np.asarray(samples, dtype=np.float64).reshape(-1, 6)
+            model = self.get_model_of_range(key)
+            matrix = np.asarray(model['matrix']) if model is not None and model['plausible'] else np.eye(2)
+            residuals = samples[:, 2:4] - samples[:, :2] @ matrix.T
+            # The second tile is offset by -reversal * backlash along each reversed axis
+            isReversed = samples[:, 4:] != 0
+            backlashes.extend((-residuals[isReversed] * samples[:, 4:][isReversed]).tolist())
+        if len(backlashes) < MIN_BACKLASH_SAMPLES:
+            return 0.0
+
+        return max(float(np.median(backlashes)), 0.0)
+
+    def get_command(self, magnification, step_nm):
+        """Stage move to send for the displacement step_nm of the field of view"""
+        model = self.get_model(magnification)
+        if model is None:
+            return float(step_nm[0]), float(step_nm[1])
+
+        command = np.linalg.solve(np.asarray(model['matrix']), np.asarray(step_nm, dtype=np.float64))
+        return float(command[0]), float(command[1])
+
+    def get_overlap_fraction(self, magnification, imageSize_nm, pixelSize_nm):
+        """Overlap of the grid tiles moved by stage : registration margin plus the stage error left after correction,
+        the default overlap until the stage is calibrated"""
+        model = self.get_model(magnification)
+        if model is None:
+            return DEFAULT_OVERLAP_FRACTION
+
+        overlap_nm = MIN_OVERLAP_PX * pixelSize_nm + ERROR_SIGMAS * model['residual_nm']
+        return min(max(overlap_nm / min(imageSize_nm), MIN_OVERLAP_FRACTION), DEFAULT_OVERLAP_FRACTION)
@@ -1,6 +1,9 @@
+import time
 import logging
 from internalProject.microscopeControl.abstract_tests import AbstractTests
 from internalProject.microscopeControl.su8230.su8230_commands import Su8230Commands
+from internalProject.microscopeControl.su8230.su8230_capture_settings import CaptureSettingsTable, \
+    get_feasible_capture_settings
 
 
 class Su8230Tests(AbstractTests):
@@ -20,17 +23,25 @@ class Su8230Tests(AbstractTests):
         # commands.set_direct_save('Single')
         project_name = f'D:\\'
 
-        # For the same position
+        # For the same position, only valid combinations are sent to the microscope
+        # Each capture is timed once to fill the duration table saved on disk
+        durationTable = CaptureSettingsTable()
         n = 0
-        for aScanMode in commands.capture_scan_mode:
-            for aResolution in commands.capture_resolution:
-                for aScanTime in commands.capture_scan_time:
-                    for anIntegrationNumber in commands.capture_integration_number:
-                        isValid = commands.set_capture_settings(scan_mode=aScanMode,
-                                                      resolution=aResolution,
-                                                      scan_time=aScanTime,
-                                                      integration_number=anIntegrationNumber)
-                        if isValid:
-                            savedir = commands.set_capture_and_save(arg='Single', project_name=project_name,
-                                                                    newFileName=f'scanMode_{aScanMode}_resolution_{aResolution}_scanTime_{aScanTime}_integrationNumber_{anIntegrationNumber}_{n}')
-                            n += 1
\ No newline at end of file
+        for aScanMode, aResolution, aScanTime, anIntegrationNumber in get_feasible_capture_settings():
+            if durationTable.is_measured(aScanMode, aResolution, aScanTime, anIntegrationNumber):
+                continue
+
+            isValid = commands.set_capture_settings(scan_mode=aScanMode,
+                                                    resolution=aResolution,
+                                                    scan_time=aScanTime,
+                                                    integration_number=anIntegrationNumber)
+            if isValid:
+                startTime = time.perf_counter()
+                savedir = commands.set_capture_and_save(arg='Single', project_name=project_name,
+                                                        newFileName=f'scanMode_{aScanMode}_resolution_{aResolution}_scanTime_{aScanTime}_integrationNumber_{anIntegrationNumber}_{n}')
+                durationTable.record_duration(aScanMode, aResolution, aScanTime, anIntegrationNumber,
+                                              time.perf_counter() - startTime)
+                durationTable.save()
+                n += 1
+
+        logging.info(f'Fastest setting for 1280x960: {durationTable.get_fastest_setting(min_resolution="1280x960")}')
\ No newline at end of file
@@ -0,0 +1,153 @@
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from internalProject.microscopeControl.overview_context import OverviewContext, get_gradient_magnitude
+from internalProject.microscopeControl.tracing import traced
+
+"""
+Position of a high mag tile in the low mag overview by normalized cross-correlation, without Dragonfly.
+The tile is downsampled to the pixel size of the overview, then matched coarse to fine : the overview pyramid is built
+once per run (OverviewContext), the coarsest level searches the whole window around the predicted position and each
+finer level only refines the position of the level above, on a small window of the level. The peak of the finest level
+is refined to sub-pixel with a parabola fit.
+Positions are tile centers in overview pixels, columns along x and rows along y.
+"""
+# Search radius of the levels after the coarsest one, in pixels of the level
+REFINE_RADIUS_PX = 2
+
+
+def to_float_image(image):
+    image = np.asarray(image, dtype=np.float32)
+    return image.mean(axis=2) if image.ndim == 3 else image
+
+
+def get_subpixel_peak(correlation, peakX, peakY):
+    """Vertex of the parabola through the peak and its neighbours, on each axis"""
+    offsets = []
+    for axis, peak in ((1, peakX), (0, peakY)):
+        if peak == 0 or peak == correlation.shape[axis] - 1:
+            offsets.append(0.0)
+            continue
+
+        before, center, after = (correlation[peakY, peak - 1:peak + 2] if axis == 1 else
+                                 correlation[peak - 1:peak + 2, peakX])
+        denominator = before - 2 * center + after
+        offsets.append(float(np.clip(0.5 * (before - after) / denominator, -0.5, 0.5)) if denominator < 0 else 0.0)
+    return peakX + offsets[0], peakY + offsets[1]
+
+
+class PyramidNccLocalizer:
+    def __init__(self, overview, overviewPixelSize_nm, minTemplateSize=16, useGradient=False):
+        """overview : 2d array of the low mag image
+            minTemplateSize : smallest size in pixels of the tile on the coarsest level searched
+            useGradient : matches gradient magnitudes, for tiles of another signal than the overview
+        """
+        self.context = None
+        self.minTemplateSize = minTemplateSize
+        self.useGradient = useGradient
+        if overview is not None:
+            self.set_context(OverviewContext.build(overview, overviewPixelSize_nm, minTemplateSize))
+
+    @classmethod
+    def from_context(cls, context, minTemplateSize=16, useGradient=False):
+        localizer = cls(None, context.pixelSize_nm, minTemplateSize, useGradient)
+        localizer.set_context(context)
+        return localizer
+
+    def set_context(self, context):
+        self.context = context
+        self.overviewPixelSize_nm = context.pixelSize_nm
+
+    def get_template_pyramid(self, tile, tilePixelSize_nm, searchRadius_px):
+        """Tile at the pixel size of the overview and its levels, down to the coarsest level usable for the search"""
+        tile = to_float_image(tile)
+        scale = tilePixelSize_nm / self.overviewPixelSize_nm
+        size = (max(1, int(round(tile.shape[1] * scale))), max(1, int(round(tile.shape[0] * scale))))
+        templates = [cv2.resize(tile, size, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)]
+        # Coarser levels while the tile keeps enough pixels and the search window is more than the refine radius
+        while len(templates) < self.context.levels and min(templates[-1].shape) >= 2 * self.minTemplateSize and \
+                searchRadius_px / 2 ** len(templates) > REFINE_RADIUS_PX:
+            templates.append(cv2.pyrDown(templates[-1]))
+        if self.useGradient:
+            templates = [get_gradient_magnitude(template) for template in templates]
+        return templates
+
+    @traced('stitching')
+    def locate(self, tile, tilePixelSize_nm, predictedCenter_px, searchRadius_px):
+        """Tile center in the overview, searched within searchRadius_px of the predicted center (overview pixels)
+            return : offset (x, y) in overview pixels of the tile center from the predicted center, confidence (NCC
+            peak, -1 to 1). Offset is None if the search window is outside of the overview or the tile is flat.
+        """
+        templates = self.get_template_pyramid(tile, tilePixelSize_nm, searchRadius_px)
+        # Correlation of a flat tile is undefined
+        if float(templates[0].std()) < 1e-6:
+            return None, -1.0
+
+        centerX, centerY = predictedCenter_px
+        radius = searchRadius_px / 2 ** (len(templates) - 1)
+        confidence = -1.0
+        for level in range(len(templates) - 1, -1, -1):
+            template = templates[level]
+            levelHeight, levelWidth = self.context.get_shape(level)
+            height, width = template.shape
+            # Window of the template top left corners, in pixels of the level
+            left = int(np.floor(centerX / 2 ** level - width / 2 - radius))
+            top = int(np.floor(centerY / 2 ** level - height / 2 - radius))
+            right = int(np.ceil(centerX / 2 ** level - width / 2 + radius))
+            bottom = int(np.ceil(centerY / 2 ** level - height / 2 + radius))
+            left, top = max(left, 0), max(top, 0)
+            right, bottom = min(right, levelWidth - width), min(bottom, levelHeight - height)
+            if right < left or bottom < top:
+                return None, -1.0
+
+            window = self.context.get_crop(level, left, top, right - left + width, bottom - top + height,
+                                           'gradient' if self.useGradient else 'image')
+            correlation = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+            _, confidence, _, (peakX, peakY) = cv2.minMaxLoc(correlation)
+            if level == 0:
+                peakX, peakY = get_subpixel_peak(correlation, peakX, peakY)
+            centerX = (left + peakX + width / 2) * 2 ** level
+            centerY = (top + peakY + height / 2) * 2 ** level
+            radius = REFINE_RADIUS_PX
+
+        return (centerX - predictedCenter_px[0], centerY - predictedCenter_px[1]), float(confidence)
+
+    def locate_nm(self, tile, tilePixelSize_nm, predictedOffset_nm, searchRadius_nm):
+        """Same as locate with positions in nm from the overview center
+            return : offset (x, y) in nm of the tile center from the predicted position, confidence
+        """
+        height, width = self.context.get_shape()
+        predictedCenter_px = (width / 2 + predictedOffset_nm[0] / self.overviewPixelSize_nm,
+                              height / 2 + predictedOffset_nm[1] / self.overviewPixelSize_nm)
+        offset_px, confidence = self.locate(tile, tilePixelSize_nm, predictedCenter_px,
+                                            searchRadius_nm / self.overviewPixelSize_nm)
+        if offset_px is None:
+            return None, confidence
+
+        return (offset_px[0] * self.overviewPixelSize_nm, offset_px[1] * self.overviewPixelSize_nm), confidence
+
+
+# Localizer of a worker process, attached to the shared overview context
+_workerLocalizer = None
+
+
+def _attach_worker(descriptor, minTemplateSize, useGradient):
+    global _workerLocalizer
+    _workerLocalizer = PyramidNccLocalizer.from_context(OverviewContext.attach(descriptor), minTemplateSize,
+                                                        useGradient)
+
+
+def _locate_in_worker(arguments):
+    return _workerLocalizer.locate_nm(*arguments)
+
+
+def locate_tiles_parallel(context, tiles, tilePixelSize_nm, predictedOffsets_nm, searchRadius_nm, workers=4,
+                          minTemplateSize=16, useGradient=False):
+    """Locates tiles in worker processes attached to the overview context in shared memory (OverviewContext.build with
+        shared=True), the overview is not copied to the workers
+        return : list of (offset in nm, confidence) in the order of the tiles
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=_attach_worker,
+                             initargs=(context.get_descriptor(), minTemplateSize, useGradient)) as executor:
+        return list(executor.map(_locate_in_worker, [(tile, tilePixelSize_nm, predictedOffset_nm, searchRadius_nm)
+                                                     for tile, predictedOffset_nm in zip(tiles, predictedOffsets_nm)]))
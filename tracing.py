@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+"""
+Timeline of an acquisition run. Spans are kept in a fixed size ring buffer (oldest dropped first) and exported as
+Chrome trace-event json, open it in chrome://tracing or https://ui.perfetto.dev
+Commands in flight at the same time (pipelined Gets run on the same event loop thread) are recorded on command tracks
+instead of their thread, a track holds spans that do not overlap.
+"""
+# Trace thread id of the first command track, thread ids of python are much larger
+COMMAND_TRACK_BASE = 1
+
+
+class TraceRecorder:
+    def __init__(self, capacity=200000):
+        self.events = deque(maxlen=capacity)
+        self.origin = time.perf_counter()
+        self.enabled = True
+        # End of the last span of each command track
+        self.trackEnds = []
+        self.trackLock = threading.Lock()
+
+    def clear(self):
+        self.events.clear()
+        self.origin = time.perf_counter()
+        with self.trackLock:
+            self.trackEnds = []
+
+    def record_span(self, name, category, start, end, args=None, threadId=None):
+        """start and end are time.perf_counter() values, threadId : track of the span, the calling thread if None"""
+        if self.enabled:
+            self.events.append((name, category, start, end, threading.get_ident() if threadId is None else threadId,
+                                args))
+
+    def get_command_track(self, start, end):
+        """Thread id of a command track free from start, the span up to end is reserved on it"""
+        with self.trackLock:
+            for index, trackEnd in enumerate(self.trackEnds):
+                if trackEnd <= start:
+                    self.trackEnds[index] = end
+                    return COMMAND_TRACK_BASE + index
+
+            self.trackEnds.append(end)
+            return COMMAND_TRACK_BASE + len(self.trackEnds) - 1
+
+    @contextmanager
+    def span(self, name, category='pipeline', **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, category, start, time.perf_counter(), args)
+
+    def get_chrome_trace_events(self):
+        processId = os.getpid()
+        traceEvents = []
+        for name, category, start, end, threadId, args in list(self.events):
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': processId, 'tid': threadId,
+                     'ts': (start - self.origin) * 10 ** 6, 'dur': (end - start) * 10 ** 6}
+            if args:
+                event['args'] = args
+            traceEvents.append(event)
+        for index in range(len(self.trackEnds)):
+            traceEvents.append({'name': 'thread_name', 'ph': 'M', 'pid': processId, 'tid': COMMAND_TRACK_BASE + index,
+                                'args': {'name': f'SEM command {index + 1}'}})
+        return traceEvents
+
+    def export_chrome_trace(self, filePath):
+        with open(filePath, 'w') as file:
+            json.dump({'traceEvents': self.get_chrome_trace_events(), 'displayTimeUnit': 'ms'}, file)
+        return filePath
+
+
+# Recorder shared by the communication, acquisition and stitching
+TRACE_RECORDER = TraceRecorder()
+
+
+def traced(category='pipeline'):
+    """Decorator recording each call of the function as a span of TRACE_RECORDER"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with TRACE_RECORDER.span(function.__name__, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,68 @@
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import numpy as np
+
+"""
+Content-addressed store of registration results in a SQLite file, so stitching reruns (blending, output path, Otsu
+step) reuse the registrations instead of recomputing them. An entry is keyed by the hashes of the tile data and the
+registration parameters, a tile recaptured or a parameter changed gives a new key and only that registration runs again.
+"""
+CACHE_VERSION = 1
+REGISTRATION_CACHE_FILE = 'registration_cache.sqlite'
+
+
+def hash_array(array):
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha256(f'{array.shape}{array.dtype}'.encode('UTF-8'))
+    digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+class TransformCache:
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.connection = sqlite3.connect(filePath)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS transforms '
+                                    '(key TEXT PRIMARY KEY, kind TEXT, value TEXT NOT NULL, created REAL)')
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(kind, inputHashes, parameters):
+        """kind : registration method, inputHashes : hash_array of the registered data, parameters : json-able dict"""
+        description = json.dumps([CACHE_VERSION, kind, list(inputHashes), parameters], sort_keys=True, default=str)
+        return hashlib.sha256(description.encode('UTF-8')).hexdigest()
+
+    def get(self, key):
+        """return : True and the stored value, False and None if not stored"""
+        row = self.connection.execute('SELECT value FROM transforms WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False, None
+
+        return True, json.loads(row[0])
+
+    def put(self, key, kind, value):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO transforms VALUES (?, ?, ?, ?)',
+                                    (key, kind, json.dumps(value), time.time()))
+
+    def get_or_compute(self, kind, inputHashes, parameters, compute):
+        """Stored value of the registration, computed and stored if missing. compute returns a json-able value"""
+        key = self.make_key(kind, inputHashes, parameters)
+        isStored, value = self.get(key)
+        if isStored:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = compute()
+        self.put(key, kind, value)
+        return value
+
+    def close(self):
+        logging.info(f'Registration cache {self.filePath} : {self.hits} reused, {self.misses} computed')
+        self.connection.close()